@@ -0,0 +1,62 @@
+from artiq.coredevice.rtio import rtio_input_timestamped_data
+from artiq.language import TInt32
+from artiq.language.core import kernel, delay_mu
+from elhep_cores.helpers.decoding import decode_cfd
+from numpy import int32
+
+
+class ConstantFractionDiscriminator:
+
+    """List-mode readout of elhep_cores.cores.dsp.cfd.ConstantFractionDiscriminator"""
+
+    kernel_invariants = {"channel", "core", "ref_period_mu", "fine_width", "fraction_width"}
+
+    def __init__(self, dmgr, channel, csr_device, fine_width=8, fraction_width=8, core_device="core"):
+        self.channel = channel
+        self.core = dmgr.get(core_device)
+        self.csr = dmgr.get(csr_device)
+        self.ref_period_mu = self.core.seconds_to_mu(
+            self.core.coarse_ref_period)
+        self.fine_width = fine_width
+        self.fraction_width = fraction_width
+
+    @kernel
+    def configure(self, offset, threshold, fraction=0.5, delay=2, negative=False):
+        """Sets baseline offset, arming threshold (above offset), fraction
+        and delay (in samples); enables the discriminator"""
+        self.csr.offset.write_rt(offset)
+        delay_mu(self.ref_period_mu)
+        self.csr.threshold.write_rt(threshold)
+        delay_mu(self.ref_period_mu)
+        self.csr.fraction.write_rt(int32(round(fraction*(1 << self.fraction_width))))
+        delay_mu(self.ref_period_mu)
+        self.csr.delay.write_rt(delay)
+        delay_mu(self.ref_period_mu)
+        self.csr.negative.write_rt(1 if negative else 0)
+        delay_mu(self.ref_period_mu)
+        self.csr.enabled.write_rt(1)
+
+    @kernel
+    def disable(self):
+        self.csr.enabled.write(0)
+
+    @kernel
+    def read_timestamps(self, buffer) -> TInt32:
+        """Reads timestamp words available in RTIO input into buffer
+
+        Stops when RTIO input is empty or buffer is full, returns number of
+        words read.
+        """
+        count = 0
+        while count < len(buffer):
+            timestamp, word = \
+                rtio_input_timestamped_data(self.core.get_rtio_counter_mu(), self.channel)
+            if timestamp < 0:
+                break
+            buffer[count] = word
+            count += 1
+        return count
+
+    def decode(self, words, sample_start=0):
+        """Decodes timestamp words, see elhep_cores.helpers.decoding.decode_cfd"""
+        return decode_cfd(words, self.fine_width, sample_start)
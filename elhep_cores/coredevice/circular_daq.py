@@ -4,25 +4,99 @@ from artiq.language.core import kernel, delay_mu, now_mu
 from artiq.language.core import rpc
 from artiq.language.units import us, ns, ms
 from elhep_cores.coredevice.rtlink_csr import RtlinkCsr
+from elhep_cores.helpers.decoding import unpack_samples, split_events, decode_samples, \
+    decode_pulse_features
+from elhep_cores.helpers.sample_sink import MemmapSink
 from artiq.coredevice.ttl import TTLOut
 from artiq.coredevice.exceptions import RTIOOverflow
 from numpy import int64, int32
+import numpy as np
+
+
+# Layout of the records stored by the host sink; sample input is not
+# timestamped, use read_windows for trigger timestamps
+SAMPLE_DTYPE = np.dtype("<i4")
+
+
+class CircularDaqTrigger:
+
+    """Timestamped trigger records of CircularDaq (see TriggerRecorder)"""
+
+    kernel_invariants = {"channel", "core"}
+
+    def __init__(self, dmgr, channel, core_device="core"):
+        self.channel = channel
+        self.core = dmgr.get(core_device)
+
+    @kernel
+    def read(self, timeout_mu):
+        """Returns (timestamp, record) of the next record, record holds
+        trigger ID and sub-sample position of the trigger above it
+
+        Timestamp is negative if there was no record until `timeout_mu`
+        (RTIO counter value).
+        """
+        return rtio_input_timestamped_data(timeout_mu, self.channel)
 
 
 class CircularDaq:
 
-    kernel_invariants = {"channel", "core", "ref_period_mu", "buffer_len"}
+    kernel_invariants = {"channel", "core", "ref_period_mu", "buffer_len",
+        "trigger_channel", "sample_width", "trigger_id_mask", "trigger_latency_mu",
+        "window_timeout_mu"}
 
-    def __init__(self, dmgr, channel, buffer_len=1024, core_device="core"):
+    def __init__(self, dmgr, channel, buffer_len=1024, csr_device=None,
+            sample_format=None, framed=False, trigger_device=None,
+            record_format=None, trigger_latency_mu=0, window_timeout=10*us,
+            pulse_features=False, sink_path=None, sink_capacity=1 << 24, core_device="core"):
         self.channel = channel
         self.core = dmgr.get(core_device)
+        if csr_device is not None:
+            self.csr = dmgr.get(csr_device)
         self.ref_period_mu = self.core.seconds_to_mu(
             self.core.coarse_ref_period)
         
+        # Two chunks of buffer_len samples, one is being filled while the
+        # other one is handed off to the host
         self.buffer_len = buffer_len
-        self.data_buffer = [int32(0)]*(buffer_len)
-        self.ts_buffer = [int64(0)]*(buffer_len)
-        self.buffer_ptr = 0
+        self.data_buffer_a = [int32(0)]*(buffer_len)
+        self.data_buffer_b = [int32(0)]*(buffer_len)
+        # Set if samples are packed in the gateware (see SamplePacker)
+        self.sample_format = sample_format
+        # Set if readout windows are framed in the gateware (see EventFramer)
+        self.framed = framed
+
+        # Set if readout can be switched to pulse features
+        self.pulse_features = pulse_features
+
+        # Set if trigger records are timestamped (see read_windows)
+        self.record_format = record_format
+        self.trigger_channel = dmgr.get(trigger_device).channel if trigger_device is not None else 0
+        if record_format is not None:
+            self.sample_width = record_format["sample_width"]
+            self.trigger_id_mask = (1 << record_format["trigger_id_width"]) - 1
+        else:
+            self.sample_width = 0
+            self.trigger_id_mask = 0
+        # RTIO timestamp of the record is delayed from the trigger by CDC
+        # (mean delay, it varies by about one RTIO clock cycle)
+        self.trigger_latency_mu = trigger_latency_mu
+        # How long to wait for samples of the window
+        self.window_timeout_mu = self.core.seconds_to_mu(window_timeout)
+        self.record_ts = [int64(0)]*(buffer_len)
+        self.record_id = [int32(0)]*(buffer_len)
+        self.record_length = [int32(0)]*(buffer_len)
+        # Sample read ahead, i.e. the first one of the next window
+        self.pending = int32(0)
+        self.pending_valid = False
+        # Samples dropped by read_windows as their window was already read
+        self.desyncs = 0
+        self.window_words = []
+        self.window_records = []
+
+        self.sink_path = sink_path
+        self.sink_capacity = sink_capacity
+        self.sink = None
 
     @kernel
     def configure_rt(self, pretrigger, posttrigger):
@@ -31,23 +105,277 @@ class CircularDaq:
         rtio_output((self.channel << 8) | 1, posttrigger)
         delay_mu(self.ref_period_mu)
 
+    @kernel
+    def get_trigger_counters(self):
+        """Returns (accepted, queued, rejected) trigger counters"""
+        accepted = self.csr.trigger_accepted.read()
+        queued = self.csr.trigger_queued.read()
+        rejected = self.csr.trigger_rejected.read()
+        return accepted, queued, rejected
+
+    @kernel
+    def clear_trigger_counters(self):
+        self.csr.trigger_counters_clear.write(1)
+
+    @kernel
+    def get_fifo_status(self):
+        """Returns (overflow, FIFO high-water mark)"""
+        overflow = self.csr.overflow.read()
+        high_water = self.csr.fifo_high_water.read()
+        return overflow, high_water
+
+    @kernel
+    def clear_fifo_status(self):
+        self.csr.fifo_status_clear.write(1)
+
+    @kernel
+    def set_readout_mode(self, features):
+        """Selects pulse feature records (True) or waveforms (False)"""
+        self.csr.readout_mode.write(1 if features else 0)
+
+    @kernel
+    def configure_features(self, offset, threshold, gate_pre, gate_length, negative=False):
+        """Sets baseline offset, threshold (above offset) and charge gate
+        (start before the pulse and length, in samples) of feature extraction"""
+        self.csr.feature_offset.write_rt(offset)
+        delay_mu(self.ref_period_mu)
+        self.csr.feature_threshold.write_rt(threshold)
+        delay_mu(self.ref_period_mu)
+        self.csr.feature_gate_pre.write_rt(gate_pre)
+        delay_mu(self.ref_period_mu)
+        self.csr.feature_gate_length.write_rt(gate_length)
+        delay_mu(self.ref_period_mu)
+        self.csr.feature_negative.write_rt(1 if negative else 0)
+
+    def decode_features(self, words):
+        """Decodes pulse feature records read from the channel
+
+        See elhep_cores.helpers.decoding.decode_pulse_features.
+        """
+        if not self.pulse_features:
+            raise ValueError("Pulse features are not available on this channel")
+        return decode_pulse_features(words)
+
+    def unpack(self, words):
+        """Unpacks words read from the channel with packed samples
+
+        Returns (samples, window_starts, trigger_ids), see
+        elhep_cores.helpers.decoding.unpack_samples.
+        """
+        if self.sample_format is None:
+            raise ValueError("Samples are not packed on this channel")
+        return unpack_samples(words, **self.sample_format)
+
+    def open_sink(self, path=None, capacity=None):
+        """Opens host sink for the samples passed to `store`
+
+        See elhep_cores.helpers.sample_sink.MemmapSink for the file layout.
+        Defaults are taken from device_db (sink_path, sink_capacity).
+        """
+        if self.sink is not None:
+            self.close_sink()
+        path = path if path is not None else self.sink_path
+        if path is None:
+            raise ValueError("Sink path not given")
+        capacity = capacity if capacity is not None else self.sink_capacity
+        self.sink = MemmapSink(path, capacity, dtype=SAMPLE_DTYPE)
+
+    def prepare_sink(self):
+        """Opens the sink with device_db defaults unless it is open
+
+        Called (as a synchronous RPC) by `transfer_samples` before any
+        samples are handed off, so that a missing sink is reported to the
+        kernel instead of being lost in the async `store`.
+        """
+        if self.sink is None:
+            if self.sink_path is None:
+                raise ValueError("Sink path not given, call open_sink() first")
+            self.open_sink()
+
+    def close_sink(self):
+        """Closes the sink and returns its statistics"""
+        if self.sink is None:
+            return None
+        stats = self.sink.close()
+        self.sink = None
+        return stats
+
+    def sink_stats(self):
+        """Returns statistics of the sink (throughput, queue depth, drops)"""
+        if self.sink is None:
+            return None
+        return self.sink.stats()
+
+    def split_events(self, words):
+        """Splits words read from the channel with framed events
+
+        See elhep_cores.helpers.decoding.split_events.
+        """
+        if not self.framed:
+            raise ValueError("Events are not framed on this channel")
+        return split_events(words)
+
     @rpc(flags={"async"})
-    def store(self, samples):
-        raise NotImplementedError
+    def store(self, samples, count):
+        """Passes first `count` samples to the sink
+
+        Sink must be open, see `prepare_sink`.
+        """
+        self.sink.put(np.asarray(samples[:count], dtype=SAMPLE_DTYPE))
 
     @kernel
-    def transfer_samples(self, chunk=200):
+    def transfer_samples(self, max_samples=-1):
+        """Moves samples available in RTIO input to the host sink
+
+        Samples are collected in chunks of buffer_len samples, alternately
+        in two buffers; a full chunk is handed off with an async RPC while
+        the other one is being filled. Stops when RTIO input is empty or
+        after `max_samples` samples (if not negative). Timed input is used
+        only to poll the channel, which is not timestamped, so timestamps
+        are not stored.
+
+        Sink is opened with device_db defaults if it is not open yet (see
+        `open_sink`), ValueError is raised if it cannot be.
+
+        Returns number of samples moved and time it took in machine units.
+        """
+        self.prepare_sink()
+        start = self.core.get_rtio_counter_mu()
+        total = 0
         idx = 0
-        while True:
-            timestamp, sample = \
+        second = False
+        while max_samples < 0 or total < max_samples:
+            status, sample = \
                 rtio_input_timestamped_data(self.core.get_rtio_counter_mu(), self.channel)
-            if timestamp < 0:
+            if status < 0:
                 break
-            self.data_buffer[idx] = sample
+            if second:
+                self.data_buffer_b[idx] = sample
+            else:
+                self.data_buffer_a[idx] = sample
             idx += 1
+            total += 1
+            if idx == self.buffer_len:
+                if second:
+                    self.store(self.data_buffer_b, idx)
+                else:
+                    self.store(self.data_buffer_a, idx)
+                second = not second
+                idx = 0
         if idx:
-            self.store(self.data_buffer[:idx])
-        
+            if second:
+                self.store(self.data_buffer_b, idx)
+            else:
+                self.store(self.data_buffer_a, idx)
+        return total, self.core.get_rtio_counter_mu() - start
+
+    @rpc(flags={"async"})
+    def store_window_words(self, words, count):
+        self.window_words.append(np.array(words[:count], dtype=np.uint32))
+
+    @rpc(flags={"async"})
+    def store_window_records(self, timestamps, trigger_ids, lengths, count):
+        records = np.empty(count, dtype=[("timestamp", np.int64), ("trigger_id", np.int32),
+                                         ("length", np.int32)])
+        records["timestamp"] = timestamps[:count]
+        records["trigger_id"] = trigger_ids[:count]
+        records["length"] = lengths[:count]
+        self.window_records.append(records)
+
+    @kernel
+    def read_windows(self, max_windows=-1) -> TInt32:
+        """Reads trigger records together with samples of their windows
+
+        For every trigger record available, samples carrying its trigger ID
+        are read (waiting up to window_timeout for them to arrive). Samples
+        and records are handed off to the host in chunks of buffer_len with
+        async RPCs, use `windows` to get them. Stops when there are no more
+        trigger records or after `max_windows` windows (if not negative).
+        Samples with an ID behind the current record are dropped and counted
+        in `desyncs`, samples ahead of it are left for a later record.
+
+        Returns number of windows read.
+        """
+        windows = 0
+        records = 0
+        idx = 0
+        while max_windows < 0 or windows < max_windows:
+            timestamp, trigger_id = rtio_input_timestamped_data(
+                self.core.get_rtio_counter_mu(), self.trigger_channel)
+            if timestamp < 0:
+                break
+            length = 0
+            while True:
+                if not self.pending_valid:
+                    ts, word = rtio_input_timestamped_data(
+                        self.core.get_rtio_counter_mu() + self.window_timeout_mu, self.channel)
+                    if ts < 0:
+                        break
+                    self.pending = word
+                    self.pending_valid = True
+                # IDs wrap, samples behind the record (half of the ID range)
+                # belong to a window already read and are dropped
+                difference = ((self.pending >> self.sample_width) - trigger_id) & self.trigger_id_mask
+                if difference != 0:
+                    if difference <= self.trigger_id_mask >> 1:
+                        break
+                    self.pending_valid = False
+                    self.desyncs += 1
+                    continue
+                self.data_buffer_a[idx] = self.pending
+                self.pending_valid = False
+                idx += 1
+                length += 1
+                if idx == self.buffer_len:
+                    self.store_window_words(self.data_buffer_a, idx)
+                    idx = 0
+            self.record_ts[records] = timestamp - self.trigger_latency_mu
+            self.record_id[records] = trigger_id
+            self.record_length[records] = length
+            records += 1
+            windows += 1
+            if records == self.buffer_len:
+                # Samples are always handed off before their records
+                self.store_window_words(self.data_buffer_a, idx)
+                self.store_window_records(self.record_ts, self.record_id,
+                    self.record_length, records)
+                idx = 0
+                records = 0
+        if idx:
+            self.store_window_words(self.data_buffer_a, idx)
+        if records:
+            self.store_window_records(self.record_ts, self.record_id,
+                self.record_length, records)
+        return windows
+
+    def windows(self):
+        """Returns windows read so far by `read_windows`
+
+        Returns list of (timestamp, trigger ID, fine, samples) tuples,
+        timestamp of the trigger is in machine units (good to about one
+        RTIO clock cycle, see TriggerRecorder), fine is the sub-sample
+        position given by the trigger source (0 if there is none), samples
+        are a NumPy array.
+        """
+        if self.record_format is None:
+            raise ValueError("Triggers are not timestamped on this channel")
+        words = np.concatenate(self.window_words) if self.window_words \
+            else np.zeros(0, dtype=np.uint32)
+        records = np.concatenate(self.window_records) if self.window_records \
+            else np.zeros(0, dtype=[("timestamp", np.int64), ("trigger_id", np.int32),
+                                    ("length", np.int32)])
+        ends = np.cumsum(records["length"])
+        total = ends[-1] if len(ends) else 0
+        self.window_words = [words[total:]]
+        self.window_records = []
+        samples = decode_samples(words[:total], **self.record_format)["sample"]
+        # Records carry the fine position above the trigger ID
+        raw = records["trigger_id"].astype(np.int64) & 0xFFFFFFFF
+        trigger_ids = raw & self.trigger_id_mask
+        fine = raw >> self.record_format["trigger_id_width"]
+        return list(zip(records["timestamp"].tolist(), trigger_ids.tolist(), fine.tolist(),
+                        np.split(samples, ends[:-1])))
+
     @kernel
     def drain_channel(self):
         ts, data = rtio_input_timestamped_data(self.core.get_rtio_counter_mu(), int32(self.channel))
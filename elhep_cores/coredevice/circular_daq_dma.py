@@ -0,0 +1,139 @@
+from artiq.language.core import kernel, syscall, delay_mu, portable
+from artiq.language.types import TInt32, TList, TNone
+
+
+EVENT_HEADER_MAGIC = 0xE
+
+
+@syscall(flags={"nounwind"})
+def memory_read(address: TInt32, data: TList(TInt32), offset: TInt32, count: TInt32) -> TNone:
+    """Copies `count` 32-bit words from CPU `address` to `data[offset:]`
+
+    Has to be exported to kernels by the runtime, like the I2C syscalls. Data
+    cache lines over the copied range have to be invalidated first, since
+    the ring is written by the gateware.
+    """
+    raise NotImplementedError("syscall not simulated")
+
+
+class CircularDaqDma:
+
+    """SDRAM-backed event readout for CircularDAQ
+
+    Events are stored by the gateware in a ring buffer in SDRAM, which is
+    read by the CPU directly from memory, one whole event at a time. Each
+    event is preceded by a header word (see `event_length`, `event_source`
+    and `event_truncated`). `memory_base` is the CPU address of SDRAM
+    (`main_ram`), `ring_base` is relative to it. `sources` lists source
+    labels in source index order.
+    """
+
+    kernel_invariants = {"core", "ref_period_mu", "ring_base", "ring_size_log2",
+        "ring_address", "ring_mask"}
+
+    def __init__(self, dmgr, csr_device, ring_base, ring_size_log2,
+            sources=None, memory_base=0x40000000, core_device="core"):
+        self.core = dmgr.get(core_device)
+        self.csr = dmgr.get(csr_device)
+        self.ref_period_mu = self.core.seconds_to_mu(
+            self.core.coarse_ref_period)
+
+        self.sources = sources if sources is not None else []
+        self.ring_base = ring_base
+        self.ring_size_log2 = ring_size_log2
+        self.ring_address = memory_base + ring_base
+        self.ring_mask = (1 << ring_size_log2) - 1
+
+        # Ring offsets (in 32-bit words) of the next event to be read and of
+        # the end of the events published by the gateware
+        self.read_pointer = 0
+        self.write_pointer = 0
+        self.header = [0]
+
+    @kernel
+    def configure(self, max_event_words):
+        """Sets ring location and size and enables event writing
+
+        `max_event_words` should not be shorter than the longest event
+        (readout window) any of the sources can produce, longer events are
+        truncated (see `event_truncated`). Ring must be longer than
+        `max_event_words`. Ring is emptied and status is cleared.
+        """
+        self.core.break_realtime()
+        self.csr.enable.write_rt(0)
+        delay_mu(self.ref_period_mu)
+        self.csr.ring_base.write_rt(self.ring_base)
+        delay_mu(self.ref_period_mu)
+        self.csr.ring_size_log2.write_rt(self.ring_size_log2)
+        delay_mu(self.ref_period_mu)
+        self.csr.max_event_words.write_rt(max_event_words)
+        delay_mu(self.ref_period_mu)
+        self.csr.read_pointer.write_rt(0)
+        delay_mu(self.ref_period_mu)
+        self.csr.enable.write_rt(1)
+        self.read_pointer = 0
+        self.write_pointer = 0
+
+    @kernel
+    def disable(self):
+        """Disables event writing and empties the ring"""
+        self.csr.enable.write(0)
+
+    @kernel
+    def get_status(self):
+        """Returns (write pointer, read pointer, events written, ring full)
+
+        Pointers are ring offsets in 32-bit words.
+        """
+        write_pointer = self.csr.write_pointer.read()
+        read_pointer = self.csr.read_pointer.read()
+        events_written = self.csr.events_written.read()
+        ring_full = self.csr.ring_full.read()
+        return write_pointer, read_pointer, events_written, ring_full
+
+    @portable
+    def event_length(self, header):
+        return header & 0xFFFF
+
+    @portable
+    def event_source(self, header):
+        return (header >> 16) & 0xFF
+
+    @portable
+    def event_truncated(self, header):
+        return (header >> 24) & 1 != 0
+
+    @kernel
+    def _copy(self, pointer, data, offset, count):
+        """Copies `count` ring words starting at `pointer`, wrapping around
+        the end of the ring"""
+        start = pointer & self.ring_mask
+        n = min(count, self.ring_mask + 1 - start)
+        memory_read(self.ring_address + 4*start, data, offset, n)
+        if n < count:
+            memory_read(self.ring_address, data, offset + n, count - n)
+
+    @kernel
+    def read_event(self, buffer) -> TInt32:
+        """Reads next event from the ring into buffer
+
+        Returns event header or 0 if there is no event to be read. Event
+        samples are copied from memory to the beginning of the buffer in one
+        go. Ring space is released with a single CSR write per event. If the
+        event does not fit in the buffer, ValueError is raised and the event
+        is dropped.
+        """
+        if self.read_pointer == self.write_pointer:
+            self.write_pointer = self.csr.write_pointer.read()
+            if self.read_pointer == self.write_pointer:
+                return 0
+        self._copy(self.read_pointer, self.header, 0, 1)
+        header = self.header[0]
+        length = self.event_length(header)
+        if length <= len(buffer):
+            self._copy(self.read_pointer + 1, buffer, 0, length)
+        self.read_pointer += 1 + length
+        self.csr.read_pointer.write(self.read_pointer)
+        if length > len(buffer):
+            raise ValueError("Event does not fit in the buffer")
+        return header
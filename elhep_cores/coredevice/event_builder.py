@@ -0,0 +1,102 @@
+from artiq.coredevice.rtio import rtio_input_timestamped_data
+from artiq.language import TInt32
+from artiq.language.core import kernel, delay_mu, rpc
+from elhep_cores.helpers.decoding import split_built_events
+import numpy as np
+
+
+class EventBuilder:
+
+    """Readout of events merged from many CircularDAQ channels
+
+    All channels are read through a single RTIO input, see
+    elhep_cores.cores.circular_daq.event_builder for the event format.
+    """
+
+    kernel_invariants = {"channel", "core", "ref_period_mu", "buffer_len"}
+
+    def __init__(self, dmgr, channel, csr_device, sources, buffer_len=1024, core_device="core"):
+        self.channel = channel
+        self.core = dmgr.get(core_device)
+        self.csr = dmgr.get(csr_device)
+        self.ref_period_mu = self.core.seconds_to_mu(
+            self.core.coarse_ref_period)
+        self.sources = sources
+
+        self.buffer_len = buffer_len
+        self.buffer_a = np.zeros(buffer_len, dtype=np.int32)
+        self.buffer_b = np.zeros(buffer_len, dtype=np.int32)
+        self.words = []
+
+    @kernel
+    def configure(self, enable_mask, gather_timeout):
+        """Sets sources to be merged and gather timeout (in sys clock cycles)"""
+        self.csr.enable_mask.write_rt(enable_mask)
+        delay_mu(self.ref_period_mu)
+        self.csr.gather_timeout.write_rt(gather_timeout)
+
+    @kernel
+    def get_status(self):
+        """Returns (events built, events closed by gather timeout)"""
+        events_built = self.csr.events_built.read()
+        timeouts = self.csr.timeouts.read()
+        return events_built, timeouts
+
+    @kernel
+    def read_words(self, buffer) -> TInt32:
+        """Reads words available in RTIO input into buffer
+
+        Stops when RTIO input is empty or buffer is full, returns number of
+        words read.
+        """
+        count = 0
+        while count < len(buffer):
+            timestamp, word = \
+                rtio_input_timestamped_data(self.core.get_rtio_counter_mu(), self.channel)
+            if timestamp < 0:
+                break
+            buffer[count] = word
+            count += 1
+        return count
+
+    @rpc(flags={"async"})
+    def store(self, words, count):
+        self.words.append(np.array(words[:count], dtype=np.uint32))
+
+    @kernel
+    def transfer_words(self) -> TInt32:
+        """Moves words available in RTIO input to the host
+
+        Words are collected in chunks of buffer_len, alternately in two
+        buffers; a full chunk is handed off with an async RPC while the
+        other one is being filled. Returns number of words moved, use
+        `events` to decode them.
+        """
+        total = 0
+        second = False
+        while True:
+            if second:
+                count = self.read_words(self.buffer_b)
+                if count:
+                    self.store(self.buffer_b, count)
+            else:
+                count = self.read_words(self.buffer_a)
+                if count:
+                    self.store(self.buffer_a, count)
+            total += count
+            if count < self.buffer_len:
+                break
+            second = not second
+        return total
+
+    def events(self):
+        """Decodes words moved so far
+
+        Returns complete events as split_built_events does; words of the last
+        incomplete event are kept for the next call.
+        """
+        words = np.concatenate(self.words) if self.words else np.zeros(0, dtype=np.uint32)
+        trailers = np.flatnonzero((words >> 30) == 0b11)
+        end = trailers[-1]+1 if len(trailers) else 0
+        self.words = [words[end:]]
+        return split_built_events(words[:end])
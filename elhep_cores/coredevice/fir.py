@@ -0,0 +1,52 @@
+from artiq.language.core import kernel, delay_mu
+from artiq.coredevice.rtio import rtio_output
+from numpy import int32
+
+
+class SymmetricFIR:
+
+    """Coefficient loader of elhep_cores.cores.dsp.fir.RtioSymmetricFIR"""
+
+    kernel_invariants = {"channel", "core", "folded_taps"}
+
+    def __init__(self, dmgr, channel, numtaps, coef_width, core_device="core"):
+        self.channel = channel
+        self.core = dmgr.get(core_device)
+        self.numtaps = numtaps
+        self.folded_taps = (numtaps+1)//2
+        self.coef_width = coef_width
+
+    def quantize(self, coefficients):
+        """Converts coefficients (all taps or first half) to loadable words
+
+        Coefficients must be symmetric and are scaled by 2**(coef_width-1).
+        """
+        if len(coefficients) == self.numtaps:
+            for a, b in zip(coefficients, reversed(coefficients)):
+                if abs(a - b) > 1e-9*max(abs(a), abs(b), 1):
+                    raise ValueError("Coefficients are not symmetric")
+            coefficients = coefficients[:self.folded_taps]
+        elif len(coefficients) != self.folded_taps:
+            raise ValueError(f"Expected {self.numtaps} or {self.folded_taps} coefficients")
+        limit = 2**(self.coef_width-1)
+        words = []
+        for idx, c in enumerate(coefficients):
+            value = max(-limit, min(limit-1, int(round(c*limit))))
+            word = idx << 24 | (value & 0xffffff)
+            # Words are passed to the kernel as int32
+            words.append(int32(word - (1 << 32) if word & (1 << 31) else word))
+        return words
+
+    @kernel
+    def load(self, words):
+        """Loads words returned by `quantize` and makes them active at once"""
+        self.core.break_realtime()
+        for i in range(len(words)):
+            rtio_output(self.channel << 8 | 0, words[i])
+            delay_mu(8)
+        rtio_output(self.channel << 8 | 1, 0)
+        delay_mu(8)
+
+    def set_coefficients(self, coefficients):
+        """Quantizes and loads coefficients (host side)"""
+        self.load(self.quantize(coefficients))
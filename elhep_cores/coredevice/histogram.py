@@ -0,0 +1,76 @@
+from artiq.coredevice.rtio import rtio_output, rtio_input_data
+from artiq.language import TInt32
+from artiq.language.core import kernel, delay_mu
+import numpy as np
+
+
+class Histogram:
+
+    """Control and readout of elhep_cores.cores.histogram.RtioHistogram"""
+
+    kernel_invariants = {"channel", "core", "ref_period_mu", "bins", "chunk"}
+
+    def __init__(self, dmgr, channel, csr_device, bins=1024, chunk=64, core_device="core"):
+        self.channel = channel
+        self.core = dmgr.get(core_device)
+        self.csr = dmgr.get(csr_device)
+        self.ref_period_mu = self.core.seconds_to_mu(
+            self.core.coarse_ref_period)
+        self.bins = bins
+        self.chunk = chunk
+
+    @kernel
+    def configure(self, offset=0, shift=0):
+        """Sets binning, bin is (value >> shift) - offset"""
+        self.csr.offset.write_rt(offset)
+        delay_mu(self.ref_period_mu)
+        self.csr.shift.write_rt(shift)
+
+    @kernel
+    def start(self):
+        self.csr.enabled.write(1)
+
+    @kernel
+    def stop(self):
+        self.csr.enabled.write(0)
+
+    @kernel
+    def clear(self):
+        """Zeroes all bins and counters"""
+        self.csr.clear.write(1)
+
+    @kernel
+    def busy(self) -> TInt32:
+        return self.csr.busy.read()
+
+    @kernel
+    def get_counters(self):
+        """Returns (entries, underflow, overflow) counters"""
+        entries = self.csr.entries.read()
+        underflow = self.csr.underflow.read()
+        overflow = self.csr.overflow.read()
+        return entries, underflow, overflow
+
+    @kernel
+    def read(self, buffer, start=0) -> TInt32:
+        """Reads counts of bins from `start` into buffer
+
+        Bins are read in chunks which fit into RTIO input FIFO. Histogram
+        should be stopped for a consistent snapshot, entries are not
+        accepted during the readout. Returns number of bins read.
+        """
+        count = min(len(buffer), self.bins - start)
+        done = 0
+        while done < count:
+            n = min(self.chunk, count - done)
+            self.core.break_realtime()
+            rtio_output(self.channel << 8, (start + done) | (n << 16))
+            delay_mu(self.ref_period_mu)
+            for i in range(n):
+                buffer[done + i] = rtio_input_data(self.channel)
+            done += n
+        return count
+
+    def snapshot(self, counts):
+        """Converts counts read with `read` to numpy array (unsigned)"""
+        return np.asarray(counts, dtype=np.int64) & 0xFFFFFFFF
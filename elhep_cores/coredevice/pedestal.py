@@ -0,0 +1,51 @@
+from artiq.coredevice.rtio import rtio_output, rtio_input_data
+from artiq.language import TInt32
+from artiq.language.core import kernel, delay_mu
+from elhep_cores.helpers.decoding import decode_pedestals
+
+
+class PedestalAccumulator:
+
+    """Pedestal and noise of elhep_cores.cores.dsp.pedestal.PedestalAccumulator"""
+
+    kernel_invariants = {"channel", "core", "ref_period_mu", "lanes"}
+
+    def __init__(self, dmgr, channel, lanes=16, core_device="core"):
+        self.channel = channel
+        self.core = dmgr.get(core_device)
+        self.ref_period_mu = self.core.seconds_to_mu(
+            self.core.coarse_ref_period)
+        self.lanes = lanes
+
+    @kernel
+    def start(self, samples):
+        """Starts accumulation of `samples` samples on all lanes"""
+        self.core.break_realtime()
+        rtio_output(self.channel << 8, samples)
+        delay_mu(self.ref_period_mu)
+
+    @kernel
+    def read(self, buffer) -> TInt32:
+        """Reads results of all lanes into buffer (4 words per lane)
+
+        Blocks until accumulation is finished on all lanes, returns number
+        of words read.
+        """
+        self.core.break_realtime()
+        rtio_output((self.channel << 8) | 1, 0)
+        delay_mu(self.ref_period_mu)
+        count = 4*self.lanes
+        for i in range(count):
+            buffer[i] = rtio_input_data(self.channel)
+        return count
+
+    @kernel
+    def measure(self, samples, buffer) -> TInt32:
+        """Accumulates `samples` samples and reads the results into buffer"""
+        self.start(samples)
+        return self.read(buffer)
+
+    def decode(self, words, samples):
+        """Returns mean and RMS of every lane, see
+        elhep_cores.helpers.decoding.decode_pedestals"""
+        return decode_pedestals(words, samples)
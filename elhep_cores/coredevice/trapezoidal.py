@@ -0,0 +1,66 @@
+from artiq.coredevice.rtio import rtio_input_timestamped_data
+from artiq.language import TInt32
+from artiq.language.core import kernel, delay_mu
+from elhep_cores.helpers.decoding import decode_trapezoidal_energy
+from numpy import exp, int32
+
+
+class TrapezoidalShaper:
+
+    """Energy readout of elhep_cores.cores.dsp.trapezoidal.TrapezoidalShaper"""
+
+    kernel_invariants = {"channel", "core", "ref_period_mu", "pz_frac"}
+
+    def __init__(self, dmgr, channel, csr_device, pz_frac=8, core_device="core"):
+        self.channel = channel
+        self.core = dmgr.get(core_device)
+        self.csr = dmgr.get(csr_device)
+        self.ref_period_mu = self.core.seconds_to_mu(
+            self.core.coarse_ref_period)
+        self.pz_frac = pz_frac
+
+    def pole_zero(self, tau):
+        """Pole-zero constant for decay time constant `tau` (in samples)"""
+        return int(round((1 << self.pz_frac)/(exp(1/tau) - 1)))
+
+    def gain(self, rise, tau):
+        """Height of the trapezoid for the unit pulse amplitude"""
+        return rise*(self.pole_zero(tau) + (1 << self.pz_frac))
+
+    @kernel
+    def configure(self, rise, flat, pole_zero, energy_shift=0, trigger_delay=16):
+        """Sets rise time and flat top (in samples), pole-zero constant (see
+        `pole_zero`), right shift of the energy and how many samples before
+        the trigger the energy reference is taken (it must precede the rise
+        of the shaped pulse)"""
+        self.csr.rise.write_rt(rise)
+        delay_mu(self.ref_period_mu)
+        self.csr.flat.write_rt(flat)
+        delay_mu(self.ref_period_mu)
+        self.csr.pole_zero.write_rt(int32(pole_zero))
+        delay_mu(self.ref_period_mu)
+        self.csr.energy_shift.write_rt(energy_shift)
+        delay_mu(self.ref_period_mu)
+        self.csr.trigger_delay.write_rt(trigger_delay)
+
+    @kernel
+    def read_energies(self, buffer) -> TInt32:
+        """Reads energy words available in RTIO input into buffer
+
+        Stops when RTIO input is empty or buffer is full, returns number of
+        words read.
+        """
+        count = 0
+        while count < len(buffer):
+            timestamp, word = \
+                rtio_input_timestamped_data(self.core.get_rtio_counter_mu(), self.channel)
+            if timestamp < 0:
+                break
+            buffer[count] = word
+            count += 1
+        return count
+
+    def decode(self, words, energy_shift=0, gain=1.0):
+        """Decodes energy words, see
+        elhep_cores.helpers.decoding.decode_trapezoidal_energy"""
+        return decode_trapezoidal_energy(words, energy_shift, gain)
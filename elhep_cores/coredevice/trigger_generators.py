@@ -1,17 +1,27 @@
 from artiq.language.core import kernel, delay, delay_mu, portable
 from artiq.language.types import *
 from artiq.language.units import ns
-from artiq.coredevice.rtio import rtio_output, rtio_input_data
+from artiq.coredevice.rtio import rtio_output, rtio_input_data, rtio_input_timestamp
 from artiq.language.types import TInt32
+from numpy import int32
 from elhep_cores.coredevice.rtlink_csr import RtlinkCsr
 import json
 
 
 class RtioBaselineTriggerGenerator:
 
-    def __init__(self, dmgr, channel):
-        self.identifier = f"{prefix}_baseline_tg"
-        self.index = index
+    kernel_invariants = {"channel", "core"}
+
+    def __init__(self, dmgr, channel, name="baseline_trigger", core_device="core"):
+        self.channel = channel
+        self.core = dmgr.get(core_device)
+        self.identifier = name
+
+    @kernel
+    def set_level(self, level):
+        self.core.break_realtime()
+        rtio_output(self.channel << 8 | 0 << 1 | 1, level)
+        delay_mu(8)
 
     @property
     def rising_edge(self):
@@ -22,6 +32,57 @@ class RtioBaselineTriggerGenerator:
         return self.identifier + "_fe"
 
 
+class ThresholdTriggerBank:
+
+    """Threshold trigger bank, see elhep_cores.cores.trigger_generators"""
+
+    kernel_invariants = {"channel", "core", "channels"}
+
+    def __init__(self, dmgr, channel, name, channels, core_device="core"):
+        self.channel = channel
+        self.core = dmgr.get(core_device)
+        self.name = name
+        self.channels = channels
+
+    def label(self, index):
+        """Returns trigger label of channel `index` (see mask mapping)"""
+        return f"{self.name}_ch{index}"
+
+    @kernel
+    def set_enabled(self, mask):
+        """Enables channels set in `mask`"""
+        self.core.break_realtime()
+        rtio_output(self.channel << 8 | 0 << 1 | 1, mask)
+        delay_mu(8)
+
+    @kernel
+    def set_negative(self, mask):
+        """Selects detection of data going below level for channels in `mask`"""
+        self.core.break_realtime()
+        rtio_output(self.channel << 8 | 1 << 1 | 1, mask)
+        delay_mu(8)
+
+    @kernel
+    def set_channel(self, index, level, hysteresis=0):
+        """Sets trigger level and hysteresis of channel `index` (in ADC codes)"""
+        self.core.break_realtime()
+        rtio_output(self.channel << 8 | (2+2*index) << 1 | 1, level)
+        delay_mu(8)
+        rtio_output(self.channel << 8 | (3+2*index) << 1 | 1, hysteresis)
+        delay_mu(8)
+
+    @kernel
+    def get_channel(self, index):
+        """Returns (level, hysteresis) of channel `index`"""
+        self.core.break_realtime()
+        rtio_output(self.channel << 8 | (2+2*index) << 1 | 0, 0)
+        delay_mu(8)
+        rtio_output(self.channel << 8 | (3+2*index) << 1 | 0, 0)
+        level = rtio_input_data(self.channel)
+        hysteresis = rtio_input_data(self.channel)
+        return level, hysteresis
+
+
 class RtioTriggerGenerator:
 
     def __init__(self, dmgr, channel, core_device="core"):
@@ -58,9 +119,15 @@ class TriggerGenerator:
 
 class RtioCoincidenceTriggerGenerator:
 
-    kernel_invariants = {"mask_mapping", "channel"}
+    MODE_AND = 0
+    MODE_MAJORITY = 1
+    MODE_TRUTH_TABLE = 2
 
-    def __init__(self, dmgr, mask_mapping, channel, core_device="core"):
+    kernel_invariants = {"mask_mapping", "channel", "mode_adr", "threshold_adr",
+        "group_mask_adr", "truth_table_adr", "truth_table_groups", "mask_words",
+        "input_select_adr", "input_config_adr"}
+
+    def __init__(self, dmgr, mask_mapping, channel, truth_table_groups=0, core_device="core"):
         self.core = dmgr.get(core_device)
         self.mask_mapping = {}
         self.max_mask_adr = 0
@@ -70,6 +137,21 @@ class RtioCoincidenceTriggerGenerator:
                 self.max_mask_adr = max(self.max_mask_adr, adr)
         self.channel = channel
 
+        # Register layout, see RtioCoincidenceTriggerGenerator.get_layout
+        self.mask_words = mask_words = len(mask_mapping)
+        self.truth_table_groups = truth_table_groups
+        self.mode_adr = 2 + mask_words
+        self.threshold_adr = self.mode_adr + 1
+        self.group_mask_adr = self.threshold_adr + 1
+        self.truth_table_adr = self.group_mask_adr + truth_table_groups*mask_words
+        table_words = (2**truth_table_groups + 31)//32 if truth_table_groups else 0
+        self.input_select_adr = self.truth_table_adr + table_words
+        self.input_config_adr = self.input_select_adr + 1
+
+        # Shadow copy of the mask words, valid once written or read back
+        self.mask_shadow = [int32(0)]*mask_words
+        self.shadow_valid = False
+
     @kernel
     def set_pulse_length(self, pulse_length):
         self.core.break_realtime()
@@ -88,14 +170,252 @@ class RtioCoincidenceTriggerGenerator:
         for adr in range(self.max_mask_adr+1):
             rtio_output(self.channel << 8 | (adr+2) << 1 | 1, 0)
             delay_mu(8)
+            self.mask_shadow[adr] = 0
+        self.shadow_valid = True
 
     @kernel
     def enable_source(self, adr, idx):
         self.core.break_realtime()
-        rtio_output(self.channel << 8 | (adr+2) << 1 | 0, 0)
-        delay_mu(8)
-        value = rtio_input_data(self.channel)
-        delay_mu(10000)
+        if self.shadow_valid:
+            value = self.mask_shadow[adr]
+        else:
+            rtio_output(self.channel << 8 | (adr+2) << 1 | 0, 0)
+            delay_mu(8)
+            value = rtio_input_data(self.channel)
+            delay_mu(10000)
         value |= (1 << idx)
         rtio_output(self.channel << 8 | (adr+2) << 1 | 1, value)
         delay_mu(8)       
+        self.mask_shadow[adr] = value
+
+    def masks_for(self, labels):
+        """Returns mask words enabling exactly the sources in `labels`
+
+        Computed on the host, pass the result to `write_masks` (or to
+        `set_group_mask` word by word for truth table groups).
+        """
+        masks = [0]*self.mask_words
+        for label in labels:
+            if label not in self.mask_mapping:
+                raise ValueError(f"Unknown trigger source: {label}")
+            adr, idx = self.mask_mapping[label]
+            masks[adr] |= 1 << idx
+        # Mask words are passed to the kernel as int32
+        return [int32(m - (1 << 32) if m & (1 << 31) else m) for m in masks]
+
+    @kernel
+    def read_masks(self):
+        """Reads all mask words back into the shadow copy"""
+        self.core.break_realtime()
+        # All the requests go first, waiting for the data would put the
+        # timeline behind the wall clock
+        for adr in range(self.mask_words):
+            rtio_output(self.channel << 8 | (adr+2) << 1 | 0, 0)
+            delay_mu(8)
+        for adr in range(self.mask_words):
+            self.mask_shadow[adr] = rtio_input_data(self.channel)
+        self.shadow_valid = True
+
+    @kernel
+    def write_masks(self, masks, verify=False) -> TInt32:
+        """Writes mask words that differ from the shadow copy
+
+        All the writes are packed on the timeline one coarse RTIO cycle
+        apart, without readback. With `verify` the written words are read
+        back afterwards and ValueError is raised on mismatch (shadow copy
+        is then invalidated). Returns number of words written.
+        """
+        self.core.break_realtime()
+        written = 0
+        for adr in range(self.mask_words):
+            if not self.shadow_valid or masks[adr] != self.mask_shadow[adr]:
+                rtio_output(self.channel << 8 | (adr+2) << 1 | 1, masks[adr])
+                delay_mu(8)
+                self.mask_shadow[adr] = masks[adr]
+                written += 1
+        self.shadow_valid = True
+        if verify:
+            for adr in range(self.mask_words):
+                rtio_output(self.channel << 8 | (adr+2) << 1 | 0, 0)
+                delay_mu(8)
+            mismatch = False
+            for adr in range(self.mask_words):
+                if rtio_input_data(self.channel) != masks[adr]:
+                    mismatch = True
+            if mismatch:
+                self.shadow_valid = False
+                raise ValueError("Trigger mask readback mismatch")
+        return written
+
+    def set_sources(self, labels, verify=False):
+        """Enables exactly the sources in `labels` (host side)"""
+        return self.write_masks(self.masks_for(labels), verify)
+
+    @kernel
+    def set_mode(self, mode):
+        """Selects coincidence logic (MODE_AND, MODE_MAJORITY or MODE_TRUTH_TABLE)"""
+        self.core.break_realtime()
+        rtio_output(self.channel << 8 | self.mode_adr << 1 | 1, mode)
+        delay_mu(8)
+
+    @kernel
+    def set_majority(self, threshold):
+        """Triggers when at least `threshold` enabled sources coincide"""
+        self.core.break_realtime()
+        rtio_output(self.channel << 8 | self.threshold_adr << 1 | 1, threshold)
+        delay_mu(8)
+        rtio_output(self.channel << 8 | self.mode_adr << 1 | 1, self.MODE_MAJORITY)
+        delay_mu(8)
+
+    @kernel
+    def set_group_mask(self, group, adr, value):
+        """Sets `adr` word of the membership mask of truth table group"""
+        self.core.break_realtime()
+        rtio_output(self.channel << 8 | (self.group_mask_adr + group*self.mask_words + adr) << 1 | 1,
+            value)
+        delay_mu(8)
+
+    @kernel
+    def set_truth_table(self, table):
+        """Loads truth table and selects truth table mode
+
+        Bit i of the table (bit i%32 of word i//32) is the trigger decision
+        for group state vector i (bit k set if any source of group k is
+        active).
+        """
+        self.core.break_realtime()
+        for i in range(len(table)):
+            rtio_output(self.channel << 8 | (self.truth_table_adr + i) << 1 | 1, table[i])
+            delay_mu(8)
+        rtio_output(self.channel << 8 | self.mode_adr << 1 | 1, self.MODE_TRUTH_TABLE)
+        delay_mu(8)
+
+    def input_index(self, label):
+        """Returns index of input `label` as used by `set_input`"""
+        if label not in self.mask_mapping:
+            raise ValueError(f"Unknown trigger source: {label}")
+        adr, idx = self.mask_mapping[label]
+        return adr*32 + idx
+
+    @kernel
+    def set_input(self, index, prescale=0, holdoff=0, delay=0):
+        """Configures conditioning of input `index`
+
+        Input is delayed by `delay` cycles (up to 31), then edges within
+        `holdoff` cycles (up to 32767) of an accepted edge are ignored and
+        only every (`prescale`+1)-th of the remaining ones (up to 4095) is
+        passed on. All zeros pass the input unchanged.
+        """
+        self.core.break_realtime()
+        rtio_output(self.channel << 8 | self.input_select_adr << 1 | 1, index)
+        delay_mu(8)
+        rtio_output(self.channel << 8 | self.input_config_adr << 1 | 1,
+            (delay & 0x1f) << 27 | (holdoff & 0x7fff) << 12 | (prescale & 0xfff))
+        delay_mu(8)
+
+    def truth_table_from_function(self, function):
+        """Builds truth table words from a function of group state vector"""
+        words = [0]*((2**self.truth_table_groups + 31)//32)
+        for state in range(2**self.truth_table_groups):
+            if function(state):
+                words[state//32] |= 1 << (state % 32)
+        return words
+
+
+class RtioFineCoincidenceTriggerGenerator(RtioCoincidenceTriggerGenerator):
+
+    """Driver of timestamp based coincidence trigger generator
+
+    Source masks are handled as in RtioCoincidenceTriggerGenerator; mode,
+    pulse length, truth table and input settings do not apply.
+    """
+
+    kernel_invariants = RtioCoincidenceTriggerGenerator.kernel_invariants | {"resolution"}
+
+    def __init__(self, dmgr, mask_mapping, channel, serdes_width=8, core_device="core"):
+        super().__init__(dmgr, mask_mapping, channel, core_device=core_device)
+        self.resolution = self.core.coarse_ref_period/serdes_width
+
+    @kernel
+    def set_window(self, window):
+        """Sets maximum distance of the coincident edges (in seconds)"""
+        self.core.break_realtime()
+        rtio_output(self.channel << 8 | 1 << 1 | 1, int32(round(window/self.resolution)))
+        delay_mu(8)
+
+
+class CoincidenceTriggerTimestamps:
+
+    """Trigger timestamps of RtioFineCoincidenceTriggerGenerator
+
+    Timestamps are those of the edges completing the coincidences, at the
+    resolution of the SERDES trigger inputs (pipeline latency of the
+    generator is subtracted).
+    """
+
+    kernel_invariants = {"channel", "core", "latency_mu"}
+
+    def __init__(self, dmgr, channel, latency=3, core_device="core"):
+        self.channel = channel
+        self.core = dmgr.get(core_device)
+        self.latency_mu = latency*self.core.seconds_to_mu(self.core.coarse_ref_period)
+
+    @kernel
+    def timestamp_mu(self, up_to_timestamp_mu) -> TInt64:
+        """Returns timestamp of the next trigger or -1 if there is none
+        until `up_to_timestamp_mu`"""
+        timestamp = rtio_input_timestamp(up_to_timestamp_mu, self.channel)
+        if timestamp >= 0:
+            timestamp -= self.latency_mu
+        return timestamp
+
+
+class TriggerScalers:
+
+    """Scaler bank of coincidence trigger generator
+
+    `labels` are the inputs of the generator followed by its name (output
+    trigger), in the order of the counters.
+    """
+
+    kernel_invariants = {"channel", "core", "ref_period", "burst_length"}
+
+    def __init__(self, dmgr, channel, labels, core_device="core"):
+        self.channel = channel
+        self.core = dmgr.get(core_device)
+        self.ref_period = self.core.coarse_ref_period
+        self.labels = labels
+        self.burst_length = len(labels) + 2
+        self.counts = [int32(0)]*len(labels)
+        self.gate = 0.0
+
+    @kernel
+    def set_gate(self, gate):
+        """Sets gate period (in seconds), 0 stops counting"""
+        self.core.break_realtime()
+        rtio_output(self.channel << 8 | 0, int32(round(gate/self.ref_period)))
+        delay_mu(8)
+        self.gate = gate
+
+    @kernel
+    def read_counts(self, counts) -> TInt32:
+        """Reads counters latched at the end of the last gate into counts
+
+        Counters are read in a single burst, which is repeated if they got
+        latched in the meantime. Returns gate sequence number.
+        """
+        while True:
+            self.core.break_realtime()
+            rtio_output(self.channel << 8 | 1, 0)
+            sequence = rtio_input_data(self.channel)
+            for i in range(len(counts)):
+                counts[i] = rtio_input_data(self.channel)
+            if rtio_input_data(self.channel) == sequence:
+                return sequence
+
+    def rates(self):
+        """Returns rates (in Hz) of the last gate as a dict keyed by label"""
+        if not self.gate:
+            raise ValueError("Gate period is not set")
+        self.read_counts(self.counts)
+        return {label: count/self.gate for label, count in zip(self.labels, self.counts)}
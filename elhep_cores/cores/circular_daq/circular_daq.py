@@ -2,7 +2,7 @@ from migen.build.xilinx.platform import XilinxPlatform
 from migen.build.generic_platform import *
 
 from migen import *
-from migen.genlib.cdc import BusSynchronizer, PulseSynchronizer, ElasticBuffer, MultiReg
+from migen.genlib.cdc import BusSynchronizer, PulseSynchronizer, ElasticBuffer, MultiReg, GrayCounter, GrayDecoder
 from migen.genlib.fifo import AsyncFIFO, AsyncFIFOBuffered
 from migen.fhdl import verilog
 from artiq.gateware.rtio import rtlink, Channel
@@ -11,9 +11,56 @@ from functools import reduce
 from operator import and_
 
 from elhep_cores.cores.circular_daq.triggered_circular_buffer import TriggeredCircularBuffer
+from elhep_cores.cores.circular_daq.sample_packer import SamplePacker
+from elhep_cores.cores.circular_daq.event_framer import EventFramer
+from elhep_cores.cores.circular_daq.pulse_features import PulseFeatureExtractor
+from elhep_cores.cores.rtlink_csr import RtLinkCSR
+from elhep_cores.helpers.ddb_manager import HasDdbManager
 
 
-class CircularDAQ(Module):
+class TriggerRecorder(Module):
+
+    """
+    Timestamped trigger records
+
+    Delivers trigger ID of every trigger pushed to `sink_*` in the `write`
+    clock domain through a timestamped RTIO input, so that the RTIO core
+    stamps the record with the time it arrives in rio_phy. Write and
+    rio_phy clocks are asynchronous, so the CDC delay varies by about one
+    rio_phy cycle between records: `trigger_latency_mu` of the driver
+    removes its mean, RTIO timestamp is good to about +-1 rio_phy cycle.
+    Sub-sample position of the trigger (`sink_fine`, e.g. CFD trigger_fine,
+    which is relative to the sample of the zero crossing), if provided, is
+    taken in the write clock domain and is passed unchanged in the record
+    above the trigger ID ([trigger_id_width:]). RTIO output is not used.
+    """
+
+    def __init__(self, trigger_id_width, fine_width=0, depth=8):
+        assert trigger_id_width + fine_width <= 32, "Trigger ID and fine position must fit in 32 bits"
+        self.sink_stb = Signal()
+        self.sink_id = Signal(max(trigger_id_width, 1))
+        self.sink_fine = Signal(max(fine_width, 1))
+
+        record_width = len(self.sink_id) + fine_width
+        self.rtlink = rtlink_iface = rtlink.Interface(
+            rtlink.OInterface(data_width=1),
+            rtlink.IInterface(data_width=record_width, timestamped=True))
+
+        # # #
+
+        fifo = ClockDomainsRenamer({"write": "write", "read": "rio_phy"})(
+            AsyncFIFO(width=record_width, depth=depth))
+        self.submodules += fifo
+        self.comb += [
+            fifo.we.eq(self.sink_stb),
+            fifo.din.eq(Cat(self.sink_id, self.sink_fine) if fine_width else self.sink_id),
+            fifo.re.eq(1),
+            rtlink_iface.i.stb.eq(fifo.readable),
+            rtlink_iface.i.data.eq(fifo.dout)
+        ]
+
+
+class CircularDAQ(Module, HasDdbManager):
 
     """
     RT Link wrapper for TriggeredCircularBuffer
@@ -25,15 +72,74 @@ class CircularDAQ(Module):
      * 0: pretrigger
      * 1: posttrigger
 
+    Status registers (trigger counters, sticky overflow flag and CDC FIFO
+    high-water mark) are available through `csr`, which is a separate RTIO
+    channel.
+
+    Estimated block RAM cost of the circular buffer (RAMB36 units) is
+    available in `bram_usage`.
+
+    Readout of the circular buffer is paused when the CDC FIFO is full.
+    Overflow is flagged when a readout stalled this way loses its window to
+    the incoming data.
+
+    With `stream_readout` samples are not delivered through RTIO input, but
+    through `source` (stb, ack, eop, data) in the sys clock domain, e.g. to
+    CircularDAQDMA or EventBuilder. All samples of the window (including ones
+    with stb_i deasserted) are passed on and `eop` marks the last sample of
+    the window. Trigger ID of the window is also available in
+    `source.trigger_id` (without packing and framing) and `source.overflow`
+    is set while the readout is being overrun. Data width is not limited to
+    32 bits in this mode.
+
+    With `pack_samples` all samples of the window (including ones with stb_i
+    deasserted) are packed by SamplePacker, several per 32-bit word, before
+    the CDC FIFO, and so the packed words are delivered instead of samples.
+    Use elhep_cores.helpers.decoding.unpack_samples to unpack them.
+
+    With `frame_events` every readout window is delivered as an event of
+    tagged words (header with trigger ID, trigger timestamp in dclk cycles,
+    all samples of the window and trailer with window length and CRC), see
+    EventFramer. Use elhep_cores.helpers.decoding.split_events to split them.
+
+    With `timestamp_triggers` trigger ID of every accepted trigger is also
+    delivered through a separate timestamped RTIO input (see TriggerRecorder),
+    along with sub-sample position of the trigger taken from
+    `trigger_fine_ts_dclk` if the trigger source provides one. Windows are matched with their records by trigger
+    ID, so samples must carry it (`trigger_id_dclk` is required and consecutive
+    triggers must have different IDs, e.g. a trigger counter).
+
+    With `pulse_features` the readout can be switched at runtime (CSR
+    `readout_mode`) from waveforms to pulse feature records (see
+    PulseFeatureExtractor), found in the incoming samples without trigger.
+    Feature extraction is configured through CSR `feature_*` registers.
+    Triggers are ignored in feature mode; switch modes while idle. Use
+    elhep_cores.helpers.decoding.decode_pulse_features to decode records.
+
     No readout is implemented. 
     """
 
     def __init__(self, data_i, stb_i, trigger_dclk, trigger_id_dclk=None, 
-            circular_buffer_length=128):
-
-        iiface_width = len(data_i) + len(trigger_id_dclk)
-        assert iiface_width <= 32, f"Data width summarized with trigger " \
-            "ID width ({iiface_width}) must be <= 32"
+            circular_buffer_length=128, circular_buffer_bank_length=8192,
+            trigger_queue_depth=8, fifo_depth=16, stream_readout=False,
+            pack_samples=False, frame_events=False, timestamp_triggers=False,
+            trigger_fine_ts_dclk=None, pulse_features=False, identifier=None):
+
+        assert not (pack_samples and frame_events), \
+            "Packing samples and framing events are mutually exclusive"
+        assert not timestamp_triggers or (trigger_id_dclk is not None and not
+            (stream_readout or pack_samples or frame_events)), \
+            "Trigger timestamping requires trigger ID and one sample per RTIO input word"
+        trigger_id_width = len(trigger_id_dclk) if trigger_id_dclk is not None else 0
+        if pack_samples or frame_events:
+            iiface_width = 32
+        else:
+            iiface_width = len(data_i) + trigger_id_width
+            assert stream_readout or iiface_width <= 32, f"Data width summarized " \
+                "with trigger ID width ({iiface_width}) must be <= 32"
+        if pulse_features:
+            # Feature records are made of 32-bit words
+            iiface_width = max(iiface_width, 32)
 
         self.data_i = data_i        
         pretrigger_rio_phy = Signal(max=circular_buffer_length)
@@ -44,7 +150,8 @@ class CircularDAQ(Module):
         # Interface - rtlink
         self.rtlink = rtlink_iface = rtlink.Interface(
             rtlink.OInterface(data_width=len(pretrigger_rio_phy), address_width=1),
-            rtlink.IInterface(data_width=iiface_width, timestamped=False))
+            rtlink.IInterface(data_width=iiface_width, timestamped=False)
+                if not stream_readout else None)
 
         self.sync.rio_phy += [
             If(rtlink_iface.o.stb,
@@ -53,6 +160,27 @@ class CircularDAQ(Module):
             )
         ]
 
+        # Control Status Registers
+        regs = [
+            ("trigger_accepted", 32, 0, "ro"),
+            ("trigger_queued", 32, 0, "ro"),
+            ("trigger_rejected", 32, 0, "ro"),
+            ("trigger_counters_clear", 1),
+            ("overflow", 1, 0, "ro"),
+            ("fifo_high_water", log2_int(fifo_depth)+1, 0, "ro"),
+            ("fifo_status_clear", 1)
+        ]
+        if pulse_features:
+            regs += [
+                ("readout_mode", 1),
+                ("feature_offset", len(data_i)),
+                ("feature_threshold", len(data_i), 2**len(data_i)-1),
+                ("feature_negative", 1),
+                ("feature_gate_pre", 4),
+                ("feature_gate_length", 16, 16)
+            ]
+        self.submodules.csr = csr = RtLinkCSR(regs, "circular_daq")
+
         # We're embedding stb into data stream going into the cyclic buffer
         cb_data_in = Signal(len(data_i)+1)
         self.comb += [
@@ -62,35 +190,270 @@ class CircularDAQ(Module):
         self.cbuf = circular_buffer = ClockDomainsRenamer({"sys": "dclk"})(
             TriggeredCircularBuffer(
                 data_width=len(cb_data_in),
-                trigger_id_width=len(trigger_id_dclk),
-                length=circular_buffer_length
+                # Trigger timestamp is passed along with trigger ID
+                trigger_id_width=trigger_id_width + (30 if frame_events else 0),
+                length=circular_buffer_length,
+                trigger_queue_depth=trigger_queue_depth,
+                bank_length=circular_buffer_bank_length
             )
         )
-        async_fifo = ClockDomainsRenamer({"write": "dclk", "read": "rio_phy"})(     
+        # RAMB36 used by the circular buffer of this channel
+        self.bram_usage = circular_buffer.bram_usage
+        readout_cd = "sys" if stream_readout else "rio_phy"
+        # FIFO word is Cat(stb, data, last)
+        async_fifo = ClockDomainsRenamer({"write": "dclk", "read": readout_cd})(     
             AsyncFIFOBuffered(
-                width=len(circular_buffer.data_out), 
-                depth=16
+                width=iiface_width+2, 
+                depth=fifo_depth
             )
         )
         trigger_cdc = PulseSynchronizer("rio_phy", "dclk")
         pretrigger_cdc = MultiReg(pretrigger_rio_phy, pretrigger_dclk, "dclk")
         posttrigger_cdc = MultiReg(posttrigger_rio_phy, posttrigger_dclk, "dclk")
-        self.submodules += [circular_buffer, async_fifo, trigger_cdc]
+        counters_clear_cdc = PulseSynchronizer("rio_phy", "dclk")
+        status_clear_cdc = PulseSynchronizer("rio_phy", "dclk")
+        self.submodules += [circular_buffer, async_fifo, trigger_cdc, counters_clear_cdc,
+            status_clear_cdc]
         self.specials += [pretrigger_cdc, posttrigger_cdc]
 
+        # FIFO level as seen from the write side; read counter is passed
+        # through Gray code, so the level is never underestimated
+        fifo_wr_cnt = Signal(log2_int(fifo_depth)+1)
+        fifo_rd_cnt = ClockDomainsRenamer(readout_cd)(GrayCounter(len(fifo_wr_cnt)))
+        fifo_rd_cnt_dclk = Signal(len(fifo_wr_cnt))
+        fifo_rd_cnt_decoder = GrayDecoder(len(fifo_wr_cnt))
+        self.submodules += [fifo_rd_cnt, fifo_rd_cnt_decoder]
+        self.specials += MultiReg(fifo_rd_cnt.q, fifo_rd_cnt_dclk, "dclk")
+
+        fifo_level = Signal(len(fifo_wr_cnt))
+        fifo_high_water = Signal.like(fifo_level)
+        overflow = Signal()
+        self.comb += [
+            fifo_rd_cnt.ce.eq(async_fifo.re & async_fifo.readable),
+            fifo_rd_cnt_decoder.i.eq(fifo_rd_cnt_dclk),
+            fifo_level.eq(fifo_wr_cnt - fifo_rd_cnt_decoder.o)
+        ]
+        self.sync.dclk += [
+            If(async_fifo.we & async_fifo.writable,
+                fifo_wr_cnt.eq(fifo_wr_cnt+1)
+            ),
+            If(status_clear_cdc.o,
+                fifo_high_water.eq(0),
+                overflow.eq(0)
+            ).Else(
+                If(fifo_level > fifo_high_water,
+                    fifo_high_water.eq(fifo_level)
+                ),
+                If(circular_buffer.overrun,
+                    overflow.eq(1)
+                )
+            )
+        ]
+
+        fifo_high_water_cdc = BusSynchronizer(len(fifo_high_water), "dclk", "rio_phy")
+        self.submodules += fifo_high_water_cdc
+        self.specials += MultiReg(overflow, csr.overflow, "rio_phy")
+        self.comb += [
+            fifo_high_water_cdc.i.eq(fifo_high_water),
+            csr.fifo_high_water.eq(fifo_high_water_cdc.o),
+            status_clear_cdc.i.eq(csr.fifo_status_clear_ld)
+        ]
+
+        for counter in ["trigger_accepted", "trigger_queued", "trigger_rejected"]:
+            counter_cdc = BusSynchronizer(32, "dclk", "rio_phy")
+            self.submodules += counter_cdc
+            self.comb += [
+                counter_cdc.i.eq(getattr(circular_buffer, counter)),
+                getattr(csr, counter).eq(counter_cdc.o)
+            ]
+
         self.comb += [
             circular_buffer.data_in.eq(cb_data_in),
             circular_buffer.we.eq(1),
-            circular_buffer.trigger.eq(trigger_dclk),
-            circular_buffer.trigger_id.eq(trigger_id_dclk),
             circular_buffer.pretrigger.eq(pretrigger_dclk),
             circular_buffer.posttrigger.eq(posttrigger_dclk),
-            async_fifo.din.eq(circular_buffer.data_out),
-            async_fifo.re.eq(async_fifo.readable),
-            async_fifo.we.eq(circular_buffer.stb_out),
-            rtlink_iface.i.data.eq(async_fifo.dout[1:]),
-            rtlink_iface.i.stb.eq(async_fifo.dout[0] & async_fifo.readable)  # stb if there is data and frame
+            counters_clear_cdc.i.eq(csr.trigger_counters_clear_ld),
+            circular_buffer.counters_clear.eq(counters_clear_cdc.o)
         ]
+        if frame_events:
+            trigger_timestamp = Signal(30)
+            self.sync.dclk += trigger_timestamp.eq(trigger_timestamp+1)
+            if trigger_id_dclk is not None:
+                self.comb += circular_buffer.trigger_id.eq(Cat(trigger_id_dclk, trigger_timestamp))
+            else:
+                self.comb += circular_buffer.trigger_id.eq(trigger_timestamp)
+        elif trigger_id_dclk is not None:
+            self.comb += circular_buffer.trigger_id.eq(trigger_id_dclk)
+
+        if timestamp_triggers:
+            fine_width = len(trigger_fine_ts_dclk) if trigger_fine_ts_dclk is not None else 0
+            self.submodules.trigger_recorder = trigger_recorder = \
+                ClockDomainsRenamer({"write": "dclk"})(TriggerRecorder(
+                    trigger_id_width=trigger_id_width,
+                    fine_width=fine_width,
+                    depth=trigger_queue_depth))
+            self.comb += [
+                trigger_recorder.sink_stb.eq(circular_buffer.accepted),
+                trigger_recorder.sink_id.eq(trigger_id_dclk)
+            ]
+            if fine_width:
+                self.comb += trigger_recorder.sink_fine.eq(trigger_fine_ts_dclk)
+
+        # Waveform readout, passed to async_fifo unless in feature mode
+        waveform_din = Signal(len(async_fifo.din))
+        waveform_we = Signal()
+        waveform_writable = Signal()
+
+        if pack_samples:
+            self.submodules.packer = packer = ClockDomainsRenamer({"sys": "dclk"})(
+                SamplePacker(
+                    sample_width=len(data_i),
+                    trigger_id_width=trigger_id_width
+                )
+            )
+            self.comb += [
+                packer.sink_stb.eq(circular_buffer.stb_out),
+                packer.sink_data.eq(circular_buffer.data_out[1:len(data_i)+1]),
+                packer.sink_id.eq(circular_buffer.data_out[len(data_i)+1:]),
+                packer.sink_last.eq(circular_buffer.last_out),
+                circular_buffer.ready.eq(packer.sink_ready),
+                waveform_din.eq(Cat(packer.source_stb, packer.source_data, packer.source_last)),
+                waveform_we.eq(packer.source_stb),
+                packer.source_ready.eq(waveform_writable)
+            ]
+        elif frame_events:
+            self.submodules.framer = framer = ClockDomainsRenamer({"sys": "dclk"})(
+                EventFramer(
+                    data_width=len(cb_data_in),
+                    trigger_id_width=trigger_id_width,
+                    max_window=2**len(pretrigger_dclk) + 2**len(posttrigger_dclk) - 1
+                )
+            )
+            self.comb += [
+                framer.sink_stb.eq(circular_buffer.stb_out),
+                framer.sink_data.eq(circular_buffer.data_out[:len(cb_data_in)]),
+                framer.sink_timestamp.eq(circular_buffer.data_out[-30:]),
+                framer.sink_last.eq(circular_buffer.last_out),
+                circular_buffer.ready.eq(framer.sink_ready),
+                waveform_din.eq(Cat(framer.source_stb, framer.source_data, framer.source_last)),
+                waveform_we.eq(framer.source_stb),
+                framer.source_ready.eq(waveform_writable)
+            ]
+            if trigger_id_width:
+                self.comb += framer.sink_id.eq(circular_buffer.data_out[len(cb_data_in):-30])
+        else:
+            # Last flag goes to the top bit also if data is narrower than the
+            # RTIO input (e.g. with pulse features)
+            self.comb += [
+                waveform_din.eq(circular_buffer.data_out),
+                waveform_din[-1].eq(circular_buffer.last_out),
+                waveform_we.eq(circular_buffer.stb_out),
+                circular_buffer.ready.eq(waveform_writable)
+            ]
+
+        if pulse_features:
+            readout_mode = Signal()
+            self.submodules.feature_extractor = feature_extractor = \
+                ClockDomainsRenamer({"sys": "dclk"})(PulseFeatureExtractor(
+                    sample_width=len(data_i)))
+            self.specials += [
+                MultiReg(csr.readout_mode, readout_mode, "dclk"),
+                MultiReg(csr.feature_offset, feature_extractor.offset, "dclk"),
+                MultiReg(csr.feature_threshold, feature_extractor.threshold, "dclk"),
+                MultiReg(csr.feature_negative, feature_extractor.negative, "dclk"),
+                MultiReg(csr.feature_gate_pre, feature_extractor.gate_pre, "dclk"),
+                MultiReg(csr.feature_gate_length, feature_extractor.gate_length, "dclk")
+            ]
+            # Output of the inactive path is dropped
+            self.comb += [
+                circular_buffer.trigger.eq(trigger_dclk & ~readout_mode),
+                feature_extractor.sink_stb.eq(stb_i & readout_mode),
+                feature_extractor.sink_data.eq(data_i),
+                If(readout_mode,
+                    async_fifo.din.eq(Cat(feature_extractor.source_stb,
+                        feature_extractor.source_data, feature_extractor.source_last)),
+                    async_fifo.we.eq(feature_extractor.source_stb),
+                    waveform_writable.eq(1),
+                    feature_extractor.source_ready.eq(async_fifo.writable)
+                ).Else(
+                    async_fifo.din.eq(waveform_din),
+                    async_fifo.we.eq(waveform_we),
+                    waveform_writable.eq(async_fifo.writable),
+                    feature_extractor.source_ready.eq(1)
+                )
+            ]
+        else:
+            self.comb += [
+                circular_buffer.trigger.eq(trigger_dclk),
+                async_fifo.din.eq(waveform_din),
+                async_fifo.we.eq(waveform_we),
+                waveform_writable.eq(async_fifo.writable)
+            ]
+
+        sample_stb = async_fifo.dout[0]
+        sample_data = async_fifo.dout[1:iiface_width+1]
+        sample_last = async_fifo.dout[-1]
+        if stream_readout:
+            self.source = source = Record([
+                ("stb", 1),
+                ("ack", 1),
+                ("eop", 1),
+                ("data", iiface_width),
+                ("trigger_id", max(trigger_id_width, 1)),
+                ("overflow", 1)
+            ])
+            self.comb += [
+                source.stb.eq(async_fifo.readable & (sample_stb | sample_last)),
+                source.eop.eq(sample_last),
+                source.data.eq(sample_data),
+                async_fifo.re.eq(source.ack | ~(sample_stb | sample_last))
+            ]
+            if trigger_id_width and not (pack_samples or frame_events):
+                self.comb += source.trigger_id.eq(sample_data[len(data_i):])
+            self.specials += MultiReg(circular_buffer.overrun, source.overflow, "sys")
+        else:
+            self.comb += [
+                async_fifo.re.eq(async_fifo.readable),
+                rtlink_iface.i.data.eq(sample_data),
+                rtlink_iface.i.stb.eq(sample_stb & async_fifo.readable)  # stb if there is data and frame
+            ]
+
+        if identifier is not None:
+            self.add_rtio_channels(
+                channel=Channel.from_phy(csr),
+                device_id=f"{identifier}_csr",
+                module="elhep_cores.coredevice.rtlink_csr",
+                class_name="RtlinkCsr",
+                arguments={
+                    "regs": regs
+                })
+            if timestamp_triggers:
+                self.add_rtio_channels(
+                    channel=Channel.from_phy(trigger_recorder, ififo_depth=trigger_queue_depth),
+                    device_id=f"{identifier}_trigger",
+                    module="elhep_cores.coredevice.circular_daq",
+                    class_name="CircularDaqTrigger",
+                    arguments={})
+            self.add_rtio_channels(
+                channel=Channel.from_phy(self),
+                device_id=identifier,
+                module="elhep_cores.coredevice.circular_daq",
+                class_name="CircularDaq",
+                arguments={
+                    "csr_device": f"{identifier}_csr",
+                    "sample_format": {
+                        "sample_width": len(data_i),
+                        "samples_per_word": packer.samples_per_word,
+                        "trigger_id_width": trigger_id_width
+                    } if pack_samples else None,
+                    "framed": frame_events,
+                    "trigger_device": f"{identifier}_trigger" if timestamp_triggers else None,
+                    "record_format": {
+                        "sample_width": len(data_i),
+                        "trigger_id_width": trigger_id_width
+                    } if timestamp_triggers else None,
+                    "pulse_features": pulse_features
+                })
 
 
 class SimulationWrapper(Module):
@@ -0,0 +1,423 @@
+import random
+
+from migen import *
+from migen.genlib.cdc import BusSynchronizer, MultiReg
+from migen.genlib.fsm import FSM
+from migen.genlib.roundrobin import RoundRobin, SP_CE
+from artiq.gateware.rtio import Channel
+
+from elhep_cores.cores.rtlink_csr import RtLinkCSR
+from elhep_cores.helpers.ddb_manager import HasDdbManager
+
+
+EVENT_HEADER_MAGIC = 0xE
+
+
+class _RingAddress(Module):
+
+    """Maps ring offset (in 32-bit words) to memory bus address and lane"""
+
+    def __init__(self, base, size_log2, offset, membus):
+        words_per_beat = len(membus.dat_w)//32
+        lane_bits = log2_int(words_per_beat)
+
+        self.adr = Signal(len(membus.adr))
+        self.lane = Signal(max(lane_bits, 1))
+
+        # # #
+
+        word_adr = Signal(32)
+        mask = Signal(32)
+        self.comb += [
+            mask.eq((C(1, 33) << size_log2) - 1),
+            word_adr.eq(base + (offset & mask)),
+            self.adr.eq(word_adr[lane_bits:])
+        ]
+        if lane_bits:
+            self.comb += self.lane.eq(word_adr[:lane_bits])
+
+
+class CircularDAQDMAWriter(Module):
+
+    """Circular DAQ DMA Writer
+
+    Writes events from CircularDAQ stream sources into a ring buffer in
+    memory. Sources are served round-robin, one whole event (readout window)
+    at a time. Runs in the memory bus (sys) clock domain.
+
+    Ring is `2**size_log2` 32-bit words long and starts at `base` (32-bit
+    word address, must be aligned to memory bus word). Every event starts
+    with a header word:
+     * [31:28] magic (0xE)
+     * [24] truncated
+     * [23:16] source index
+     * [15:0] event length in words (header excluded)
+    followed by event samples, one per word. The header is written last, after
+    which the event is published by updating `write_pointer`. Writer waits
+    (stalling the sources) until there is room for `max_event_words` in the
+    ring, which is set in `ring_full`. Events longer than `max_event_words`
+    are truncated: samples beyond it are dropped up to the end of the window
+    and the truncated flag is set in the header. Pointers are ring offsets in
+    words.
+    """
+
+    def __init__(self, sources, membus):
+        words_per_beat = len(membus.dat_w)//32
+        assert len(membus.dat_w) % 32 == 0, "Memory bus width must be a multiple of 32"
+        assert len(sources) <= 256, "Up to 256 sources are supported"
+
+        self.enable = Signal()
+        self.base = Signal(32)
+        self.size_log2 = Signal(5)
+        self.max_event_words = Signal(16)
+        self.read_pointer = Signal(32)
+
+        self.write_pointer = Signal(32)
+        self.events_written = Signal(32)
+        self.ring_full = Signal()
+        self.ring_full_clear = Signal()
+
+        # # #
+
+        rr = RoundRobin(len(sources), SP_CE)
+        self.submodules += rr
+
+        source_stb = Signal()
+        source_eop = Signal()
+        source_data = Signal(32)
+        source_ack = Signal()
+        self.comb += [
+            rr.request.eq(Cat(*[s.stb for s in sources])),
+            source_stb.eq(Array(s.stb for s in sources)[rr.grant]),
+            source_eop.eq(Array(s.eop for s in sources)[rr.grant]),
+            source_data.eq(Array(s.data for s in sources)[rr.grant])
+        ]
+        for idx, s in enumerate(sources):
+            self.comb += s.ack.eq(source_ack & (rr.grant == idx))
+
+        offset = Signal(32)
+        header_offset = Signal(32)
+        length = Signal(16)
+        eop_seen = Signal()
+        truncated = Signal()
+        source_index = Signal(8)
+        header = Signal(32)
+        self.comb += [
+            source_index.eq(rr.grant),
+            header.eq(Cat(length, source_index, truncated, C(0, 3), C(EVENT_HEADER_MAGIC, 4)))
+        ]
+
+        wr = _RingAddress(self.base, self.size_log2, offset, membus)
+        hdr = _RingAddress(self.base, self.size_log2, header_offset, membus)
+        self.submodules += wr, hdr
+
+        space_available = Signal()
+        self.comb += space_available.eq(
+            (offset - self.read_pointer)[:32] + self.max_event_words + 1 <= (C(1, 33) << self.size_log2))
+
+        beat = Signal(len(membus.dat_w))
+        beat_sel = Signal(len(membus.sel))
+        beat_adr = Signal(len(membus.adr))
+        lane_sel = Array(C(0xF << 4*i, len(membus.sel)) for i in range(words_per_beat))
+        beat_words = Array(beat[32*i:32*(i+1)] for i in range(words_per_beat))
+
+        fsm = FSM("IDLE")
+        self.submodules += fsm
+
+        fsm.act("IDLE",
+            rr.ce.eq(~source_stb),
+            If(~self.enable,
+                NextValue(offset, 0),
+                NextValue(self.write_pointer, 0),
+                NextValue(self.events_written, 0)
+            ).Elif(source_stb,
+                If(space_available,
+                    # Reserve header word
+                    NextValue(header_offset, offset),
+                    NextValue(offset, offset+1),
+                    NextValue(length, 0),
+                    NextValue(eop_seen, 0),
+                    NextValue(truncated, 0),
+                    NextState("DATA")
+                ).Else(
+                    NextValue(self.ring_full, 1)
+                )
+            )
+        )
+        fsm.act("DATA",
+            source_ack.eq(1),
+            If(source_stb,
+                If(length == self.max_event_words,
+                    # No room reserved for the rest of the window
+                    NextValue(truncated, 1),
+                    If(source_eop,
+                        NextValue(eop_seen, 1),
+                        If(beat_sel != 0,
+                            NextState("FLUSH")
+                        ).Else(
+                            NextState("HEADER")
+                        )
+                    )
+                ).Else(
+                    NextValue(beat_words[wr.lane], source_data),
+                    NextValue(beat_sel, beat_sel | lane_sel[wr.lane]),
+                    NextValue(beat_adr, wr.adr),
+                    NextValue(offset, offset+1),
+                    NextValue(length, length+1),
+                    NextValue(eop_seen, source_eop),
+                    If((wr.lane == words_per_beat-1) | source_eop,
+                        NextState("FLUSH")
+                    )
+                )
+            )
+        )
+        fsm.act("FLUSH",
+            membus.cyc.eq(1),
+            membus.stb.eq(1),
+            membus.we.eq(1),
+            membus.adr.eq(beat_adr),
+            membus.dat_w.eq(beat),
+            membus.sel.eq(beat_sel),
+            If(membus.ack,
+                NextValue(beat_sel, 0),
+                If(eop_seen,
+                    NextState("HEADER")
+                ).Else(
+                    NextState("DATA")
+                )
+            )
+        )
+        fsm.act("HEADER",
+            membus.cyc.eq(1),
+            membus.stb.eq(1),
+            membus.we.eq(1),
+            membus.adr.eq(hdr.adr),
+            membus.dat_w.eq(Replicate(header, words_per_beat)),
+            membus.sel.eq(lane_sel[hdr.lane]),
+            If(membus.ack,
+                NextValue(self.write_pointer, offset),
+                NextValue(self.events_written, self.events_written+1),
+                rr.ce.eq(1),
+                NextState("IDLE")
+            )
+        )
+
+        self.sync += If(self.ring_full_clear, self.ring_full.eq(0))
+
+
+class CircularDAQDMA(Module, HasDdbManager):
+
+    """
+    SDRAM-backed event readout for CircularDAQ
+
+    Events from CircularDAQ instances created with `stream_readout=True` are
+    written by CircularDAQDMAWriter into a ring buffer in memory over
+    `write_bus`, e.g. a `get_native_sdram_if()` port of the SoC, the same way
+    as rtio_analyzer does. Ring location and size are set at runtime, ring
+    must be placed in memory not used by the runtime.
+
+    Ring is read by the CPU directly from memory (`memory_base` is the CPU
+    address of the memory bus address 0, i.e. of `main_ram`). CPU releases
+    ring space by writing the offset up to which it has read the ring to
+    `read_pointer`.
+
+    Configuration and status registers are available through `csr`, which
+    is the only RTIO channel of the module.
+    """
+
+    def __init__(self, sources, write_bus, source_labels=None, identifier=None,
+            ring_base=None, ring_size_log2=None, memory_base=0x40000000):
+
+        regs = [
+            ("enable", 1),
+            ("ring_base", 32),
+            ("ring_size_log2", 5),
+            ("max_event_words", 16),
+            ("read_pointer", 32),
+            ("write_pointer", 32, 0, "ro"),
+            ("events_written", 32, 0, "ro"),
+            ("ring_full", 1, 0, "ro")
+        ]
+        self.submodules.csr = csr = RtLinkCSR(regs, "circular_daq_dma")
+
+        # # #
+
+        self.submodules.writer = writer = CircularDAQDMAWriter(sources, write_bus)
+
+        # Configuration
+        enable_sys = Signal()
+        self.specials += MultiReg(csr.enable, enable_sys, "sys")
+        for reg, width in [("ring_base", 32), ("ring_size_log2", 5),
+                           ("max_event_words", 16), ("read_pointer", 32)]:
+            cdc = BusSynchronizer(width, "rio_phy", "sys")
+            self.submodules += cdc
+            self.comb += cdc.i.eq(getattr(csr, reg))
+            if reg == "ring_base":
+                # Bytes to 32-bit words
+                self.comb += writer.base.eq(cdc.o[2:])
+            elif reg == "ring_size_log2":
+                self.comb += writer.size_log2.eq(cdc.o)
+            else:
+                self.comb += getattr(writer, reg).eq(cdc.o)
+        self.comb += writer.enable.eq(enable_sys)
+
+        # Status
+        for reg, signal in [("write_pointer", writer.write_pointer),
+                            ("events_written", writer.events_written)]:
+            cdc = BusSynchronizer(32, "sys", "rio_phy")
+            self.submodules += cdc
+            self.comb += [
+                cdc.i.eq(signal),
+                getattr(csr, reg).eq(cdc.o)
+            ]
+        self.specials += MultiReg(writer.ring_full, csr.ring_full, "rio_phy")
+        ring_full_clear = Signal()
+        self.specials += MultiReg(csr.enable_ld, ring_full_clear, "sys")
+        self.comb += writer.ring_full_clear.eq(ring_full_clear)
+
+        if identifier is not None:
+            self.add_rtio_channels(
+                channel=Channel.from_phy(csr),
+                device_id=f"{identifier}_csr",
+                module="elhep_cores.coredevice.rtlink_csr",
+                class_name="RtlinkCsr",
+                arguments={
+                    "regs": regs
+                })
+            self.register_coredevice(
+                device_id=identifier,
+                module="elhep_cores.coredevice.circular_daq_dma",
+                class_name="CircularDaqDma",
+                arguments={
+                    "csr_device": f"{identifier}_csr",
+                    "sources": source_labels if source_labels is not None else [],
+                    "ring_base": ring_base,
+                    "ring_size_log2": ring_size_log2,
+                    "memory_base": memory_base
+                })
+
+
+@passive
+def memory_model(bus, memory):
+    """Wishbone slave on `memory` (dict of 32-bit words), acks every access"""
+    words_per_beat = len(bus.dat_w)//32
+    while True:
+        yield bus.ack.eq(0)
+        yield
+        if (yield bus.cyc) and (yield bus.stb):
+            adr = yield bus.adr
+            if (yield bus.we):
+                sel = yield bus.sel
+                dat_w = yield bus.dat_w
+                for i in range(words_per_beat):
+                    if (sel >> 4*i) & 0xF:
+                        memory[adr*words_per_beat+i] = (dat_w >> 32*i) & 0xFFFFFFFF
+            else:
+                yield bus.dat_r.eq(sum(memory.get(adr*words_per_beat+i, 0) << 32*i
+                    for i in range(words_per_beat)))
+            yield bus.ack.eq(1)
+            yield
+
+
+def source_model(source, events):
+    for event in events:
+        for i, word in enumerate(event):
+            yield source.stb.eq(1)
+            yield source.data.eq(word)
+            yield source.eop.eq(i == len(event)-1)
+            while True:
+                yield
+                if (yield source.ack):
+                    break
+        yield source.stb.eq(0)
+        for _ in range(random.randint(0, 20)):
+            yield
+
+
+def testbench(dut, events, max_event_words, ring_size_log2=7, ring_base=0x1000):
+    regs = [reg[0] for reg in dut.csr.regs]
+    o = dut.csr.rtlink.o
+    i = dut.csr.rtlink.i
+
+    def write(reg, value):
+        yield o.address.eq(regs.index(reg) << 1 | 1)
+        yield o.data.eq(value)
+        yield o.stb.eq(1)
+        yield
+        yield o.stb.eq(0)
+        yield
+
+    def read(reg):
+        yield o.address.eq(regs.index(reg) << 1)
+        yield o.stb.eq(1)
+        yield
+        yield o.stb.eq(0)
+        for _ in range(1000):
+            yield
+            if (yield i.stb):
+                return (yield i.data)
+        raise AssertionError("Readout timeout")
+
+    received = [[] for _ in events]
+    expected_events = sum(len(e) for e in events)
+
+    def ring(offset):
+        return dut.memory[ring_base//4 + offset % 2**ring_size_log2]
+
+    def cpu():
+        """Reads the ring from memory, the way CircularDaqDma does"""
+        yield from write("ring_base", ring_base)
+        yield from write("ring_size_log2", ring_size_log2)
+        yield from write("max_event_words", max_event_words)
+        yield from write("read_pointer", 0)
+        for _ in range(50):
+            yield
+        yield from write("enable", 1)
+        read_pointer = 0
+        while sum(len(r) for r in received) < expected_events:
+            write_pointer = yield from read("write_pointer")
+            while read_pointer != write_pointer:
+                header = ring(read_pointer)
+                assert header >> 28 == EVENT_HEADER_MAGIC
+                length = header & 0xFFFF
+                words = [ring(read_pointer+1+k) for k in range(length)]
+                received[(header >> 16) & 0xFF].append((words, (header >> 24) & 1))
+                read_pointer = (read_pointer + 1 + length) & 0xFFFFFFFF
+            # Release ring space only after some events, so that the ring
+            # fills up and wraps
+            for _ in range(random.randint(0, 200)):
+                yield
+            yield from write("read_pointer", read_pointer)
+
+    generators = {
+        "rio_phy": cpu(),
+        "sys": [memory_model(dut.writer_bus, dut.memory)] +
+            [source_model(source, e) for source, e in zip(dut.sources, events)]
+    }
+    run_simulation(dut, generators, clocks={"sys": 10, "rio_phy": 8})
+    return received
+
+
+class _TestBench(Module):
+    def __init__(self, sources, width=64):
+        layout = [("adr", 32-log2_int(width//8)), ("dat_w", width), ("dat_r", width),
+                  ("sel", width//8), ("cyc", 1), ("stb", 1), ("ack", 1), ("we", 1)]
+        self.sources = [Record([("stb", 1), ("ack", 1), ("eop", 1), ("data", 32)])
+            for _ in range(sources)]
+        self.writer_bus = Record(layout)
+        self.memory = {}
+        self.submodules.dma = CircularDAQDMA(self.sources, self.writer_bus)
+        self.csr = self.dma.csr
+
+
+if __name__ == "__main__":
+    max_event_words = 32
+    for width in [32, 64]:
+        events = [[[random.randint(0, 2**32-1) for _ in range(random.randint(1, 40))]
+            for _ in range(15)] for _ in range(2)]
+        dut = _TestBench(len(events), width)
+        received = testbench(dut, events, max_event_words)
+        for source_events, source_received in zip(events, received):
+            assert [(e[:max_event_words], int(len(e) > max_event_words)) for e in source_events] \
+                == source_received
+    print("OK")
@@ -0,0 +1,494 @@
+import random
+
+from migen import *
+from migen.genlib.cdc import BusSynchronizer, MultiReg
+from migen.genlib.fifo import AsyncFIFO
+from migen.genlib.fsm import FSM
+from artiq.gateware.rtio import rtlink, Channel
+
+from elhep_cores.cores.rtlink_csr import RtLinkCSR
+from elhep_cores.helpers.ddb_manager import HasDdbManager
+
+
+# Tags in [31:30] of event builder words
+TAG_DATA = 0b00
+TAG_HEADER = 0b01
+TAG_BLOCK = 0b10
+TAG_TRAILER = 0b11
+
+
+class EventBuilder(Module, HasDdbManager):
+
+    """
+    Event Builder
+
+    Merges readout windows with the same trigger ID from many CircularDAQ
+    instances (created with `stream_readout=True`) into a single stream of
+    event records. Runs in the sys clock domain.
+
+    Every source must provide stb, ack, eop, data, trigger_id and overflow
+    (see CircularDAQ.source and TdcWindowSource). Once a window is ready,
+    the builder waits until every enabled source has a window ready or until
+    `gather_timeout` sys cycles elapse. Events are built in trigger order:
+    the oldest trigger ID (modulo trigger ID width) at the heads of the
+    sources defines trigger ID of the event, so no source is starved and a
+    window missing from one source does not split the next events. Windows
+    with matching trigger ID become members of the event, windows with
+    different trigger ID are left for later events. All sources must use
+    trigger IDs of the same width.
+
+    Event is a sequence of 32-bit words, each tagged in [31:30]:
+     * header (01): [29:0] trigger ID
+     * block (10): [4:0] source index, for every member in source index order,
+       followed by the window samples
+     * data (00): [29:0] part of a sample, samples wider than 30 bits are
+       split into 30-bit parts, least significant first
+     * trailer (11): [29:0] mask of sources that overflowed since the
+       previous trailer
+
+    With `rtio_readout` events are delivered through the RTIO input of this
+    module (RTIO output is not used), otherwise through `source` (stb, ack,
+    eop, data) in the sys clock domain, e.g. to CircularDAQDMA.
+
+    Configuration and status registers are available through `csr`, which
+    is a separate RTIO channel. Windows of sources disabled in `enable_mask`
+    are dropped.
+    """
+
+    def __init__(self, sources, rtio_readout=True, fifo_depth=64, identifier=None):
+        n = len(sources)
+        assert 1 <= n <= 30, "Up to 30 sources are supported"
+        id_width = max(len(s.trigger_id) for s in sources)
+        assert id_width <= 30, "Trigger ID must fit in 30 bits"
+        parts = [(len(s.data)+29)//30 for s in sources]
+
+        regs = [
+            ("enable_mask", n, 2**n-1),
+            ("gather_timeout", 16, 1024),
+            ("events_built", 32, 0, "ro"),
+            ("timeouts", 32, 0, "ro")
+        ]
+        self.submodules.csr = csr = RtLinkCSR(regs, "event_builder")
+
+        self.source = source = Record([
+            ("stb", 1),
+            ("ack", 1),
+            ("eop", 1),
+            ("data", 32)
+        ])
+
+        # # #
+
+        enable_mask = Signal(n, reset=2**n-1)
+        gather_timeout = Signal(16, reset=1024)
+        events_built = Signal(32)
+        timeouts = Signal(32)
+        self.specials += MultiReg(csr.enable_mask, enable_mask, "sys", reset=2**n-1)
+        for reg, signal, cd_from, cd_to in [
+                ("gather_timeout", gather_timeout, "rio_phy", "sys"),
+                ("events_built", events_built, "sys", "rio_phy"),
+                ("timeouts", timeouts, "sys", "rio_phy")]:
+            cdc = BusSynchronizer(len(signal), cd_from, cd_to)
+            self.submodules += cdc
+            if cd_from == "sys":
+                self.comb += [cdc.i.eq(signal), getattr(csr, reg).eq(cdc.o)]
+            else:
+                self.comb += [cdc.i.eq(getattr(csr, reg)), signal.eq(cdc.o)]
+
+        ready = Signal(n)
+        matching = Signal(n)
+        event_id = Signal(id_width)
+        members = Signal(n)
+        self.comb += [
+            ready.eq(Cat(*[s.stb for s in sources]) & enable_mask),
+            matching.eq(Cat(*[s.trigger_id == event_id for s in sources]))
+        ]
+
+        # Sticky overflow flags, cleared when reported in the trailer
+        overflow = Signal(n)
+        overflow_clear = Signal()
+        self.sync += overflow.eq(
+            Mux(overflow_clear, 0, overflow) | Cat(*[s.overflow for s in sources]))
+
+        # Output register
+        advance = Signal()
+        load = Signal()
+        load_data = Signal(32)
+        load_last = Signal()
+        self.comb += advance.eq(~source.stb | source.ack)
+        self.sync += If(advance,
+            source.stb.eq(load),
+            If(load,
+                source.data.eq(load_data),
+                source.eop.eq(load_last)
+            )
+        )
+
+        # Currently read member
+        channel = Signal(max=n+1)
+        part = Signal(max=max(parts)+1)
+        member_ack = Signal()
+        member_stb = Signal()
+        member_eop = Signal()
+        member_part = Signal(30)
+        member_last_part = Signal()
+        self.comb += [
+            member_stb.eq(Array(s.stb for s in sources)[channel]),
+            member_eop.eq(Array(s.eop for s in sources)[channel]),
+            member_part.eq(Array(
+                Array(s.data[30*i:30*(i+1)] for i in range(p))[part]
+                for s, p in zip(sources, parts))[channel]),
+            member_last_part.eq(part == Array(C(p-1, len(part)) for p in parts)[channel])
+        ]
+        for idx, s in enumerate(sources):
+            self.comb += s.ack.eq(
+                (member_ack & (channel == idx)) | (s.stb & ~enable_mask[idx]))
+
+        # Once the windows are gathered, the oldest trigger ID is searched for
+        # one source per cycle; ID is older if its difference to the current
+        # one is negative (wraps around)
+        seed_id = Signal(id_width)
+        seed_valid = Signal()
+        seed_older = Signal()
+        seed_difference = Signal(id_width)
+        self.comb += [
+            seed_id.eq(Array(s.trigger_id for s in sources)[channel]),
+            seed_difference.eq(seed_id - event_id),
+            seed_older.eq(~seed_valid | seed_difference[-1])
+        ]
+
+        timer = Signal(16)
+
+        fsm = FSM("IDLE")
+        self.submodules += fsm
+
+        fsm.act("IDLE",
+            NextValue(timer, 0),
+            If(ready != 0,
+                NextState("GATHER")
+            )
+        )
+        fsm.act("GATHER",
+            NextValue(timer, timer+1),
+            NextValue(channel, 0),
+            NextValue(seed_valid, 0),
+            If(ready == enable_mask,
+                NextState("SEED")
+            ).Elif(timer == gather_timeout,
+                NextValue(timeouts, timeouts+1),
+                NextState("SEED")
+            )
+        )
+        # Ready sources hold their heads, so the search sees all of them
+        fsm.act("SEED",
+            If(Array(ready[i] for i in range(n))[channel] & seed_older,
+                NextValue(event_id, seed_id),
+                NextValue(seed_valid, 1)
+            ),
+            NextValue(channel, channel+1),
+            If(channel == n-1,
+                NextState("MEMBERS")
+            )
+        )
+        fsm.act("MEMBERS",
+            NextValue(members, ready & matching),
+            NextValue(channel, 0),
+            If(seed_valid,
+                NextState("HEADER")
+            ).Else(
+                NextState("IDLE")
+            )
+        )
+        fsm.act("HEADER",
+            If(advance,
+                load.eq(1),
+                load_data.eq(event_id | (TAG_HEADER << 30)),
+                NextState("NEXT")
+            )
+        )
+        fsm.act("NEXT",
+            If(channel == n,
+                NextState("TRAILER")
+            ).Elif(Array(members[i] for i in range(n))[channel],
+                NextState("BLOCK")
+            ).Else(
+                NextValue(channel, channel+1)
+            )
+        )
+        fsm.act("BLOCK",
+            If(advance,
+                load.eq(1),
+                load_data.eq(channel | (TAG_BLOCK << 30)),
+                NextValue(part, 0),
+                NextState("DATA")
+            )
+        )
+        fsm.act("DATA",
+            If(advance & member_stb,
+                load.eq(1),
+                load_data.eq(member_part | (TAG_DATA << 30)),
+                If(member_last_part,
+                    member_ack.eq(1),
+                    NextValue(part, 0),
+                    If(member_eop,
+                        NextValue(channel, channel+1),
+                        NextState("NEXT")
+                    )
+                ).Else(
+                    NextValue(part, part+1)
+                )
+            )
+        )
+        fsm.act("TRAILER",
+            If(advance,
+                load.eq(1),
+                load_data.eq(overflow | (TAG_TRAILER << 30)),
+                load_last.eq(1),
+                overflow_clear.eq(1),
+                NextValue(events_built, events_built+1),
+                NextState("IDLE")
+            )
+        )
+
+        if rtio_readout:
+            self.rtlink = rtlink_iface = rtlink.Interface(
+                rtlink.OInterface(data_width=1),
+                rtlink.IInterface(data_width=32, timestamped=False))
+
+            readout_fifo = ClockDomainsRenamer({"write": "sys", "read": "rio_phy"})(
+                AsyncFIFO(width=32, depth=16))
+            self.submodules += readout_fifo
+            self.comb += [
+                readout_fifo.we.eq(source.stb),
+                readout_fifo.din.eq(source.data),
+                source.ack.eq(readout_fifo.writable),
+                readout_fifo.re.eq(1),
+                rtlink_iface.i.stb.eq(readout_fifo.readable),
+                rtlink_iface.i.data.eq(readout_fifo.dout)
+            ]
+
+        if identifier is not None:
+            self.add_rtio_channels(
+                channel=Channel.from_phy(csr),
+                device_id=f"{identifier}_csr",
+                module="elhep_cores.coredevice.rtlink_csr",
+                class_name="RtlinkCsr",
+                arguments={
+                    "regs": regs
+                })
+            if rtio_readout:
+                self.add_rtio_channels(
+                    channel=Channel.from_phy(self, ififo_depth=fifo_depth),
+                    device_id=identifier,
+                    module="elhep_cores.coredevice.event_builder",
+                    class_name="EventBuilder",
+                    arguments={
+                        "csr_device": f"{identifier}_csr",
+                        "sources": len(sources)
+                    })
+
+
+class TdcWindowSource(Module):
+
+    """TDC hits as EventBuilder source
+
+    Collects hits (`stb_i`, `data_i`, e.g. TdcGpx2Phy data_stb_o and data_o)
+    arriving within `gate_length` cycles after `trigger` into a window of
+    `trigger_id`; inputs and `gate_length` are in the dclk clock domain.
+    Window holds the hits followed by the number of hits, which is always
+    there, so that empty windows are delivered too. Windows are available
+    through `source` (stb, ack, eop, data, trigger_id, overflow) in the sys
+    clock domain.
+
+    Triggers arriving while the window is open are ignored. Hits which do
+    not fit into the CDC FIFO are dropped (not counted) and
+    `source.overflow` is set until the next window.
+    """
+
+    def __init__(self, data_i, stb_i, trigger, trigger_id, gate_length=64, fifo_depth=16):
+        data_width = len(data_i)
+        id_width = len(trigger_id)
+
+        self.gate_length = Signal(16, reset=gate_length)
+
+        self.source = source = Record([
+            ("stb", 1),
+            ("ack", 1),
+            ("eop", 1),
+            ("data", data_width),
+            ("trigger_id", id_width),
+            ("overflow", 1)
+        ])
+
+        # # #
+
+        # FIFO word is Cat(data, trigger_id, last)
+        fifo = ClockDomainsRenamer({"write": "dclk", "read": "sys"})(
+            AsyncFIFO(width=data_width+id_width+1, depth=fifo_depth))
+        self.submodules += fifo
+
+        window_id = Signal(id_width)
+        timer = Signal(16)
+        hits = Signal(data_width)
+        overflow = Signal()
+
+        fsm = ClockDomainsRenamer("dclk")(FSM("IDLE"))
+        self.submodules += fsm
+
+        fsm.act("IDLE",
+            If(trigger,
+                NextValue(window_id, trigger_id),
+                NextValue(timer, 0),
+                NextValue(hits, 0),
+                NextValue(overflow, 0),
+                NextState("GATE")
+            )
+        )
+        fsm.act("GATE",
+            fifo.we.eq(stb_i),
+            fifo.din.eq(Cat(data_i, window_id, C(0, 1))),
+            If(stb_i,
+                If(fifo.writable,
+                    NextValue(hits, hits+1)
+                ).Else(
+                    NextValue(overflow, 1)
+                )
+            ),
+            NextValue(timer, timer+1),
+            If(timer >= self.gate_length-1,
+                NextState("CLOSE")
+            )
+        )
+        # Number of hits closes the window, it is never dropped
+        fsm.act("CLOSE",
+            fifo.we.eq(1),
+            fifo.din.eq(Cat(hits, window_id, C(1, 1))),
+            If(fifo.writable,
+                NextState("IDLE")
+            )
+        )
+
+        self.specials += MultiReg(overflow, source.overflow, "sys")
+        self.comb += [
+            source.stb.eq(fifo.readable),
+            source.data.eq(fifo.dout[:data_width]),
+            source.trigger_id.eq(fifo.dout[data_width:data_width+id_width]),
+            source.eop.eq(fifo.dout[-1]),
+            fifo.re.eq(source.ack)
+        ]
+
+
+def window_source_model(source, windows):
+    """Pushes (trigger ID, samples) windows to `source` in the sys clock domain"""
+    for trigger_id, samples in windows:
+        for _ in range(random.randint(0, 30)):
+            yield
+        for i, sample in enumerate(samples):
+            yield source.stb.eq(1)
+            yield source.trigger_id.eq(trigger_id)
+            yield source.data.eq(sample)
+            yield source.eop.eq(i == len(samples)-1)
+            while True:
+                yield
+                if (yield source.ack):
+                    break
+        yield source.stb.eq(0)
+
+
+def tdc_model(dut, triggers, gate_length):
+    """Sends triggers with hits inside and outside of the gate in the dclk
+    clock domain, returns hits expected for every trigger"""
+    expected = []
+    for trigger_id in triggers:
+        for _ in range(random.randint(40, 80)):
+            yield
+        yield dut.trigger.eq(1)
+        yield dut.trigger_id.eq(trigger_id)
+        yield
+        yield dut.trigger.eq(0)
+        hits = []
+        for cycle in range(gate_length + 10):
+            hit = random.random() < 0.3
+            yield dut.tdc_stb.eq(hit)
+            if hit:
+                data = random.randint(0, 2**len(dut.tdc_data)-1)
+                yield dut.tdc_data.eq(data)
+                if cycle < gate_length:
+                    hits.append(data)
+            yield
+        yield dut.tdc_stb.eq(0)
+        expected.append(hits)
+    return expected
+
+
+class _TestBench(Module):
+    def __init__(self, sources, gate_length):
+        self.trigger = Signal()
+        self.trigger_id = Signal(4)
+        self.tdc_data = Signal(20)
+        self.tdc_stb = Signal()
+        self.submodules.tdc = TdcWindowSource(self.tdc_data, self.tdc_stb,
+            self.trigger, self.trigger_id, gate_length)
+        self.sources = [Record([("stb", 1), ("ack", 1), ("eop", 1), ("data", 12),
+            ("trigger_id", 4), ("overflow", 1)]) for _ in range(sources)]
+        self.submodules.builder = EventBuilder(self.sources + [self.tdc.source],
+            rtio_readout=False)
+
+
+def check(triggers=40, gate_length=8, stall=0.3):
+    """Source 0 misses the window of one trigger, IDs wrap around"""
+    dut = _TestBench(2, gate_length)
+    ids = [t % 16 for t in range(triggers)]
+    windows = [[(i, [random.randint(0, 4095) for _ in range(random.randint(1, 5))])
+        for i in ids] for _ in dut.sources]
+    missing = triggers//2
+    del windows[0][missing]
+    tdc_hits = []
+    words = []
+
+    def tdc():
+        for _ in range(100):
+            yield
+        tdc_hits.extend((yield from tdc_model(dut, ids, gate_length)))
+
+    def sources(source, source_windows):
+        for _ in range(100):
+            yield
+        yield from window_source_model(source, source_windows)
+
+    def readout():
+        trailers = 0
+        while trailers < triggers:
+            yield dut.builder.source.ack.eq(random.random() >= stall)
+            yield
+            if (yield dut.builder.source.stb) and (yield dut.builder.source.ack):
+                word = yield dut.builder.source.data
+                words.append((word >> 30, word & (2**30-1)))
+                trailers += word >> 30 == TAG_TRAILER
+
+    run_simulation(dut, {"sys": [sources(*a) for a in zip(dut.sources, windows)] + [readout()], "dclk": tdc()},
+        clocks={"sys": 10, "rio_phy": 8, "dclk": 12})
+
+    events = []
+    for tag, payload in words:
+        if tag == TAG_HEADER:
+            events.append((payload, []))
+        elif tag == TAG_BLOCK:
+            events[-1][1].append((payload, []))
+        elif tag == TAG_DATA:
+            events[-1][1][-1][1].append(payload)
+
+    expected = []
+    for t, trigger_id in enumerate(ids):
+        blocks = []
+        if t != missing:
+            blocks.append((0, windows[0][t - (t > missing)][1]))
+        blocks.append((1, windows[1][t][1]))
+        blocks.append((2, tdc_hits[t] + [len(tdc_hits[t])]))
+        expected.append((trigger_id, blocks))
+    assert events == expected
+
+
+if __name__ == "__main__":
+    check()
+    print("OK")
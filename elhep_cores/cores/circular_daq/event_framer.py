@@ -0,0 +1,200 @@
+import random
+from functools import reduce
+from operator import xor
+
+from migen import *
+from migen.genlib.fsm import FSM
+
+# Tags in [31:30] of framed words and CRC parameters, shared with decoding
+from elhep_cores.helpers.decoding import TAG_DATA, TAG_HEADER, TAG_TIMESTAMP, TAG_TRAILER, \
+    CRC_POLYNOM, CRC_INIT
+
+
+class CRCEngine(Module):
+
+    """Parallel CRC engine
+
+    Computes next CRC value (`crc_next`) from the previous one (`crc_prev`)
+    and `data`, bits of `data` are shifted in MSB first. Purely combinatorial.
+    """
+
+    def __init__(self, data_width, width=16, polynom=CRC_POLYNOM):
+        self.data = Signal(data_width)
+        self.crc_prev = Signal(width)
+        self.crc_next = Signal(width)
+
+        # # #
+
+        # Every CRC bit is XOR of a set of previous CRC and data bits
+        state = [{("crc", i)} for i in range(width)]
+        for n in reversed(range(data_width)):
+            feedback = state[-1] ^ {("data", n)}
+            state = [feedback if i == 0 else state[i-1] for i in range(width)]
+            for i in range(1, width):
+                if (polynom >> i) & 1:
+                    state[i] = state[i] ^ feedback
+
+        sources = {"crc": self.crc_prev, "data": self.data}
+        for i, terms in enumerate(state):
+            bits = [sources[name][n] for name, n in sorted(terms)]
+            self.comb += self.crc_next[i].eq(reduce(xor, bits) if bits else 0)
+
+
+class EventFramer(Module):
+
+    """Event Framer
+
+    Wraps samples of readout windows into self-describing events of 32-bit
+    words, each tagged in [31:30]:
+     * header (01): [29:0] trigger ID
+     * timestamp (10): [29:0] trigger timestamp
+     * data (00): [29:0] sample, one word per sample of the window
+     * trailer (11): [29:16] number of data words, [15:0] CRC-16 (CCITT,
+       initialized with 0xFFFF) of [29:0] of the data words, MSB first
+
+    Input is the readout of TriggeredCircularBuffer (`sink_stb`,
+    `sink_data`, `sink_id`, `sink_timestamp`, `sink_last`, `sink_ready`),
+    output is held in `source_data` (with `source_last` set for the trailer)
+    until it is consumed (`source_stb & source_ready`).
+
+    `max_window` is the longest readout window (in samples) the source can
+    produce, it must fit in the number of data words field of the trailer.
+    """
+
+    def __init__(self, data_width, trigger_id_width=0, timestamp_width=30, max_window=2**14-1):
+        assert data_width <= 30, "Data must fit in 30 bits"
+        assert trigger_id_width <= 30, "Trigger ID must fit in 30 bits"
+        assert timestamp_width <= 30, "Timestamp must fit in 30 bits"
+        assert max_window < 2**14, "Window length must fit in 14 bits of the trailer"
+
+        self.sink_stb = Signal()
+        self.sink_data = Signal(data_width)
+        self.sink_id = Signal(max(trigger_id_width, 1))
+        self.sink_timestamp = Signal(timestamp_width)
+        self.sink_last = Signal()
+        self.sink_ready = Signal()
+
+        self.source_stb = Signal()
+        self.source_data = Signal(32)
+        self.source_last = Signal()
+        self.source_ready = Signal(reset=1)
+
+        # # #
+
+        self.submodules.crc = crc = CRCEngine(30)
+        crc_value = Signal(16, reset=CRC_INIT)
+        count = Signal(14)
+        advance = Signal()
+        self.comb += [
+            advance.eq(~self.source_stb | self.source_ready),
+            crc.data.eq(self.sink_data),
+            crc.crc_prev.eq(crc_value)
+        ]
+
+        # Word loaded into the output register
+        load = Signal()
+        load_data = Signal(32)
+        load_last = Signal()
+        self.sync += If(advance,
+            self.source_stb.eq(load),
+            If(load,
+                self.source_data.eq(load_data),
+                self.source_last.eq(load_last)
+            )
+        )
+
+        fsm = FSM("HEADER")
+        self.submodules += fsm
+
+        fsm.act("HEADER",
+            If(advance & self.sink_stb,
+                load.eq(1),
+                load_data.eq(self.sink_id | (TAG_HEADER << 30)),
+                NextValue(crc_value, CRC_INIT),
+                NextValue(count, 0),
+                NextState("TIMESTAMP")
+            )
+        )
+        fsm.act("TIMESTAMP",
+            If(advance,
+                load.eq(1),
+                load_data.eq(self.sink_timestamp | (TAG_TIMESTAMP << 30)),
+                NextState("DATA")
+            )
+        )
+        fsm.act("DATA",
+            self.sink_ready.eq(advance),
+            If(advance & self.sink_stb,
+                load.eq(1),
+                load_data.eq(self.sink_data | (TAG_DATA << 30)),
+                NextValue(crc_value, crc.crc_next),
+                NextValue(count, count+1),
+                If(self.sink_last,
+                    NextState("TRAILER")
+                )
+            )
+        )
+        fsm.act("TRAILER",
+            If(advance,
+                load.eq(1),
+                load_data.eq(Cat(crc_value, count, C(TAG_TRAILER, 2))),
+                load_last.eq(1),
+                NextState("HEADER")
+            )
+        )
+
+
+def crc16(payloads):
+    value = CRC_INIT
+    for payload in payloads:
+        for n in reversed(range(30)):
+            feedback = ((value >> 15) ^ (payload >> n)) & 1
+            value = (value << 1) & 0xFFFF
+            if feedback:
+                value ^= CRC_POLYNOM
+    return value
+
+
+def testbench(dut, windows, stall=0.0):
+    words = []
+    for trigger_id, timestamp, samples in windows:
+        for i, sample in enumerate(samples):
+            yield dut.sink_stb.eq(1)
+            yield dut.sink_data.eq(sample)
+            yield dut.sink_id.eq(trigger_id)
+            yield dut.sink_timestamp.eq(timestamp)
+            yield dut.sink_last.eq(i == len(samples)-1)
+            while True:
+                yield dut.source_ready.eq(random.random() >= stall)
+                yield
+                if (yield dut.source_stb) and (yield dut.source_ready):
+                    words.append((yield dut.source_data))
+                if (yield dut.sink_ready):
+                    break
+    yield dut.sink_stb.eq(0)
+    for _ in range(8):
+        yield dut.source_ready.eq(1)
+        yield
+        if (yield dut.source_stb) and (yield dut.source_ready):
+            words.append((yield dut.source_data))
+    return words
+
+
+def check(dut, stall=0.0):
+    windows = [(random.randint(0, 15), random.randint(0, 2**30-1),
+                [random.randint(0, 2**len(dut.sink_data)-1) for _ in range(random.randint(1, 20))])
+               for _ in range(20)]
+    words = yield from testbench(dut, windows, stall)
+    expected = []
+    for trigger_id, timestamp, samples in windows:
+        expected += [(TAG_HEADER << 30) | trigger_id, (TAG_TIMESTAMP << 30) | timestamp]
+        expected += samples
+        expected += [(TAG_TRAILER << 30) | (len(samples) << 16) | crc16(samples)]
+    assert words == expected
+
+
+if __name__ == "__main__":
+    for stall in [0.0, 0.3]:
+        dut = EventFramer(11, 4)
+        run_simulation(dut, check(dut, stall))
+    print("OK")
@@ -0,0 +1,232 @@
+import random
+
+from migen import *
+from migen.genlib.fsm import FSM
+
+
+# Words of the pulse feature record
+FEATURE_RECORD_WORDS = 4
+
+
+class PulseFeatureExtractor(Module):
+
+    """Pulse Feature Extractor
+
+    Finds pulses in the sample stream (`sink_stb`, `sink_data`) and reduces
+    each one to a record of 4 words:
+     * 0: [31:0] sample counter of the threshold crossing (pulse start)
+     * 1: [15:0] peak amplitude (above offset), [31:16] peak position
+       (samples after pulse start)
+     * 2: [31:0] charge, signed sum of samples (above offset) over the gate
+     * 3: [15:0] time over threshold (samples), [16] pile-up flag
+
+    Samples are taken relative to `offset` (baseline) and negated with
+    `negative`. Pulse starts when the sample goes above `threshold`. Charge
+    gate opens `gate_pre` samples (up to `max_gate_pre`) before the pulse
+    start and lasts `gate_length` samples. Pulse ends when the gate is
+    closed and the sample is below the threshold; pile-up is flagged if the
+    threshold is crossed again before. Peak is searched until the pulse
+    end. Samples arriving while the record is being sent are not examined.
+
+    Output is held in `source_data` (with `source_last` set for the last
+    word of the record) until it is consumed (`source_stb & source_ready`).
+    """
+
+    def __init__(self, sample_width=10, max_gate_pre=15):
+        assert sample_width <= 14, "Amplitude must fit in 16 bits"
+        self.sink_stb = Signal()
+        self.sink_data = Signal(sample_width)
+
+        self.offset = Signal(sample_width)
+        self.threshold = Signal(sample_width)
+        self.negative = Signal()
+        self.gate_pre = Signal(max=max_gate_pre+1)
+        self.gate_length = Signal(16)
+
+        self.source_stb = Signal()
+        self.source_data = Signal(32)
+        self.source_last = Signal()
+        self.source_ready = Signal(reset=1)
+
+        # # #
+
+        counter = Signal(32)
+        x = Signal((sample_width+2, True))
+        x_stb = Signal()
+        x_counter = Signal(32)
+        self.sync += [
+            If(self.sink_stb, counter.eq(counter+1)),
+            x_stb.eq(self.sink_stb),
+            x_counter.eq(counter),
+            x.eq(Mux(self.negative, self.offset - self.sink_data, self.sink_data - self.offset))
+        ]
+
+        # Samples for the charge gate, delayed by gate_pre
+        pre_samples = [x]
+        for _ in range(max_gate_pre):
+            d = Signal.like(x)
+            self.sync += If(x_stb, d.eq(pre_samples[-1]))
+            pre_samples.append(d)
+        x_gate = Signal.like(x)
+        self.comb += x_gate.eq(Array(pre_samples)[self.gate_pre])
+
+        above = Signal()
+        self.comb += above.eq(x > self.threshold)
+
+        start = Signal(32)
+        peak = Signal.like(x)
+        peak_index = Signal(16)
+        index = Signal(16)
+        charge = Signal((32, True))
+        gate = Signal(16)
+        tot = Signal(16)
+        over = Signal()
+        pileup = Signal()
+
+        words = Array([
+            start,
+            Cat(peak, Replicate(peak[-1], 16-len(peak)), peak_index),
+            charge,
+            Cat(tot, pileup)
+        ])
+        word = Signal(max=FEATURE_RECORD_WORDS)
+
+        fsm = FSM("IDLE")
+        self.submodules += fsm
+
+        fsm.act("IDLE",
+            If(x_stb & above,
+                NextValue(start, x_counter),
+                NextValue(peak, x),
+                NextValue(peak_index, 0),
+                NextValue(index, 1),
+                NextValue(charge, x_gate),
+                NextValue(gate, 1),
+                NextValue(tot, 1),
+                NextValue(over, 1),
+                NextValue(pileup, 0),
+                NextState("PULSE")
+            )
+        )
+        fsm.act("PULSE",
+            If(x_stb,
+                NextValue(index, index+1),
+                If(x > peak,
+                    NextValue(peak, x),
+                    NextValue(peak_index, index)
+                ),
+                If(gate < self.gate_length,
+                    NextValue(charge, charge + x_gate),
+                    NextValue(gate, gate+1)
+                ),
+                If(over,
+                    If(above,
+                        If(tot != 2**16-1, NextValue(tot, tot+1))
+                    ).Else(
+                        NextValue(over, 0)
+                    )
+                ).Elif(above,
+                    NextValue(pileup, 1)
+                ),
+                If(~above & (gate >= self.gate_length),
+                    NextValue(word, 0),
+                    NextState("RECORD")
+                )
+            )
+        )
+        fsm.act("RECORD",
+            self.source_stb.eq(1),
+            self.source_data.eq(words[word]),
+            self.source_last.eq(word == FEATURE_RECORD_WORDS-1),
+            If(self.source_ready,
+                NextValue(word, word+1),
+                If(word == FEATURE_RECORD_WORDS-1,
+                    NextState("IDLE")
+                )
+            )
+        )
+
+
+def features(samples, threshold, gate_pre, gate_length):
+    """Reference records of pulses in `samples` (relative to offset)
+
+    Pulses must be apart enough for the records to be sent in between.
+    """
+    records = []
+    n = gate_pre
+    while n < len(samples):
+        if samples[n] <= threshold:
+            n += 1
+            continue
+        start = n
+        peak, peak_index = samples[n], 0
+        tot, over, pileup = 1, True, False
+        n += 1
+        while n < len(samples):
+            above = samples[n] > threshold
+            if samples[n] > peak:
+                peak, peak_index = samples[n], n-start
+            if over and above:
+                tot += 1
+            elif over:
+                over = False
+            elif above:
+                pileup = True
+            n += 1
+            if not above and n-1-start >= gate_length:
+                break
+        charge = sum(samples[start-gate_pre:start-gate_pre+gate_length])
+        records += [start, (peak & 0xffff) | (peak_index << 16), charge & 0xffffffff,
+                    tot | (pileup << 16)]
+    return records
+
+
+def testbench(dut, samples, stall=0.0):
+    words = []
+
+    def cycle(ready):
+        yield dut.source_ready.eq(ready)
+        yield
+        if (yield dut.source_stb) and (yield dut.source_ready):
+            words.append((yield dut.source_data))
+
+    for sample in samples:
+        while random.random() < stall:
+            yield dut.sink_stb.eq(0)
+            yield from cycle(random.random() >= stall)
+        yield dut.sink_stb.eq(1)
+        yield dut.sink_data.eq(sample)
+        yield from cycle(random.random() >= stall)
+    yield dut.sink_stb.eq(0)
+    for _ in range(16):
+        yield from cycle(1)
+    return words
+
+
+def check(dut, negative=False, offset=200, threshold=40, gate_pre=3, gate_length=12,
+        stall=0.0):
+    x = [random.randint(-5, 5) for _ in range(40*50)]
+    for start in range(20, len(x)-40, 40):
+        amplitude = random.randint(threshold+1, 700)
+        width = random.randint(1, gate_length-2)
+        for i in range(width):
+            x[start+i] += amplitude*(width-i)//width
+        if random.random() < 0.3:
+            # Pile-up within the gate
+            x[start+random.randint(width+1, gate_length-1)] += amplitude
+    yield dut.offset.eq(offset)
+    yield dut.threshold.eq(threshold)
+    yield dut.negative.eq(negative)
+    yield dut.gate_pre.eq(gate_pre)
+    yield dut.gate_length.eq(gate_length)
+    samples = [offset-v if negative else offset+v for v in x]
+    words = yield from testbench(dut, samples, stall)
+    assert words == features(x, threshold, gate_pre, gate_length)
+
+
+if __name__ == "__main__":
+    for negative, offset in [(False, 200), (True, 800)]:
+        for stall in [0.0, 0.3]:
+            dut = PulseFeatureExtractor()
+            run_simulation(dut, check(dut, negative, offset, stall=stall))
+    print("OK")
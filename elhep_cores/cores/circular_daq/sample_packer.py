@@ -0,0 +1,147 @@
+import random
+
+from migen import *
+
+
+class SamplePacker(Module):
+
+    """Sample Packer
+
+    Packs samples of readout windows into 32-bit words, `samples_per_word`
+    samples per word (at most 3 and at most 30 // sample_width):
+     * [W*(i+1)-1:W*i] - i-th sample (W = sample_width)
+     * [31:30] - flags: 0 - all slots valid, window continues; 1..3 - last
+       word of the window with that many valid slots (the rest is zeroed)
+
+    With `trigger_id_width` > 0 every window is preceded by a word carrying
+    trigger ID of the window in [29:0] (flags are 0).
+
+    Input is the readout of TriggeredCircularBuffer (`sink_stb`,
+    `sink_data`, `sink_id`, `sink_last`, `sink_ready`), output is held in
+    `source_data` (with `source_last` set for the last word of the window)
+    until it is consumed (`source_stb & source_ready`).
+    """
+
+    def __init__(self, sample_width=10, samples_per_word=None, trigger_id_width=0):
+        if samples_per_word is None:
+            samples_per_word = min(3, 30 // sample_width)
+        assert 1 <= samples_per_word <= 3, "Up to 3 samples per word are supported"
+        assert samples_per_word*sample_width <= 30, "Packed samples must fit in 30 bits"
+        assert trigger_id_width <= 30, "Trigger ID must fit in 30 bits"
+        self.samples_per_word = samples_per_word
+
+        self.sink_stb = Signal()
+        self.sink_data = Signal(sample_width)
+        self.sink_id = Signal(max(trigger_id_width, 1))
+        self.sink_last = Signal()
+        self.sink_ready = Signal()
+
+        self.source_stb = Signal()
+        self.source_data = Signal(32)
+        self.source_last = Signal()
+        self.source_ready = Signal(reset=1)
+
+        # # #
+
+        packed = Signal(30)
+        packed_d = Signal(30)
+        slot = Signal(max=samples_per_word+1)
+        first = Signal(reset=1)
+        word_done = Signal()
+        emit_id = Signal()
+        advance = Signal()
+
+        self.comb += [
+            advance.eq(~self.source_stb | self.source_ready),
+            emit_id.eq(first & self.sink_stb if trigger_id_width else 0),
+            self.sink_ready.eq(advance & ~emit_id),
+            word_done.eq((slot == samples_per_word-1) | self.sink_last),
+            Case(slot, {
+                i: packed.eq(packed_d | (self.sink_data << sample_width*i))
+                for i in range(samples_per_word)
+            })
+        ]
+
+        self.sync += If(advance,
+            self.source_stb.eq(0),
+            If(emit_id,
+                self.source_stb.eq(1),
+                self.source_data.eq(self.sink_id),
+                self.source_last.eq(0),
+                first.eq(0)
+            ).Elif(self.sink_stb,
+                If(word_done,
+                    self.source_stb.eq(1),
+                    self.source_data.eq(Cat(packed, Mux(self.sink_last, slot+1, 0)[:2])),
+                    self.source_last.eq(self.sink_last),
+                    packed_d.eq(0),
+                    slot.eq(0),
+                    first.eq(self.sink_last)
+                ).Else(
+                    packed_d.eq(packed),
+                    slot.eq(slot+1)
+                )
+            )
+        )
+
+
+def unpack_reference(words, sample_width, samples_per_word, trigger_id):
+    windows = []
+    window = None
+    for word in words:
+        if window is None:
+            window = (word & (2**30-1) if trigger_id else None, [])
+            if trigger_id:
+                continue
+        flags = word >> 30
+        for i in range(flags or samples_per_word):
+            window[1].append((word >> sample_width*i) & (2**sample_width-1))
+        if flags:
+            windows.append(window)
+            window = None
+    return windows
+
+
+def testbench(dut, windows, stall=0.0):
+    words = []
+
+    def collect():
+        if (yield dut.source_stb) and (yield dut.source_ready):
+            words.append((yield dut.source_data))
+
+    for trigger_id, samples in windows:
+        for i, sample in enumerate(samples):
+            yield dut.sink_stb.eq(1)
+            yield dut.sink_data.eq(sample)
+            yield dut.sink_id.eq(trigger_id)
+            yield dut.sink_last.eq(i == len(samples)-1)
+            while True:
+                yield dut.source_ready.eq(random.random() >= stall)
+                yield
+                yield from collect()
+                if (yield dut.sink_ready):
+                    break
+    yield dut.sink_stb.eq(0)
+    for _ in range(4):
+        yield dut.source_ready.eq(1)
+        yield
+        yield from collect()
+    return words
+
+
+def check(dut, samples_per_word, trigger_id, stall=0.0):
+    sample_width = len(dut.sink_data)
+    windows = [(random.randint(0, 15),
+                [random.randint(0, 2**sample_width-1) for _ in range(random.randint(1, 20))])
+               for _ in range(20)]
+    words = yield from testbench(dut, windows, stall)
+    assert unpack_reference(words, sample_width, samples_per_word, trigger_id) == \
+        [(w[0] if trigger_id else None, w[1]) for w in windows]
+
+
+if __name__ == "__main__":
+    for trigger_id_width in [0, 4]:
+        for stall in [0.0, 0.3]:
+            dut = SamplePacker(10, trigger_id_width=trigger_id_width)
+            run_simulation(dut, check(dut, 3, trigger_id_width > 0, stall))
+    print("OK")
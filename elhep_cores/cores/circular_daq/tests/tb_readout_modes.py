@@ -0,0 +1,115 @@
+"""Checks CircularDAQ stream readout with pulse features enabled
+
+Waveform windows must keep the sample, trigger ID and last flag layout of the
+plain readout, feature records come in 4 word frames.
+
+Run with: python -m elhep_cores.cores.circular_daq.tests.tb_readout_modes
+"""
+
+from migen import *
+
+from elhep_cores.cores.circular_daq.circular_daq import CircularDAQ
+from elhep_cores.cores.circular_daq.pulse_features import FEATURE_RECORD_WORDS
+
+
+class _TestBench(Module):
+    def __init__(self, data_width=10, trigger_id_width=4):
+        self.data = Signal(data_width)
+        self.stb = Signal()
+        self.trigger = Signal()
+        self.trigger_id = Signal(trigger_id_width)
+        self.submodules.dut = CircularDAQ(self.data, self.stb, self.trigger, self.trigger_id,
+            stream_readout=True, pulse_features=True)
+
+
+def csr_write(csr, name, value):
+    o = csr.rtlink.o
+    yield o.address.eq([r[0] for r in csr.regs].index(name) << 1 | 1)
+    yield o.data.eq(value)
+    yield o.stb.eq(1)
+    yield
+    yield o.stb.eq(0)
+    yield
+
+
+def configure(tb, pretrigger, posttrigger, feature_mode):
+    o = tb.dut.rtlink.o
+    for address, value in ((0, pretrigger), (1, posttrigger)):
+        yield o.address.eq(address)
+        yield o.data.eq(value)
+        yield o.stb.eq(1)
+        yield
+    yield o.stb.eq(0)
+    if feature_mode:
+        yield from csr_write(tb.dut.csr, "feature_threshold", 500)
+        yield from csr_write(tb.dut.csr, "feature_gate_length", 4)
+        yield from csr_write(tb.dut.csr, "readout_mode", 1)
+
+
+def source(tb, samples, triggers, feature_mode, period=60):
+    """Feeds a ramp of samples (or pulses in feature mode), triggers with
+    incrementing IDs every `period` samples"""
+    for _ in range(50):
+        yield
+    for n in range(period*triggers):
+        if feature_mode:
+            value = 900 if n % period == period//2 else 0
+        else:
+            value = n % 2**len(tb.data)
+        yield tb.data.eq(value)
+        yield tb.stb.eq(1)
+        yield tb.trigger.eq(n % period == period//2)
+        if n % period == period//2:
+            yield tb.trigger_id.eq(n//period)
+        samples.append(value)
+        yield
+    yield tb.stb.eq(0)
+
+
+def sink(tb, words):
+    yield tb.dut.source.ack.eq(1)
+    while True:
+        yield
+        if (yield tb.dut.source.stb):
+            words.append(((yield tb.dut.source.data), (yield tb.dut.source.eop)))
+
+
+def check(feature_mode=False, pretrigger=4, posttrigger=5, triggers=6):
+    tb = _TestBench()
+    samples = []
+    words = []
+    run_simulation(tb, {
+            "rio_phy": configure(tb, pretrigger, posttrigger, feature_mode),
+            "dclk": source(tb, samples, triggers, feature_mode),
+            "sys": passive(sink)(tb, words)
+        }, clocks={"rio_phy": 8, "dclk": 10, "sys": 10})
+
+    data_width = len(tb.data)
+    trigger_id_width = len(tb.trigger_id)
+    frames = []
+    frame = []
+    for data, eop in words:
+        frame.append(data)
+        if eop:
+            frames.append(frame)
+            frame = []
+    assert not frame, "Words after the last frame"
+    assert len(frames) == triggers, f"{len(frames)} of {triggers} frames"
+
+    if feature_mode:
+        assert all(len(f) == FEATURE_RECORD_WORDS for f in frames)
+        return
+    for trigger_id, frame in enumerate(frames):
+        assert len(frame) == pretrigger+posttrigger+1
+        values = [data & (2**data_width-1) for data in frame]
+        assert values == list(range(values[0], values[0]+len(values))), \
+            f"window {trigger_id}: {values}"
+        for data in frame:
+            assert (data >> data_width) & (2**trigger_id_width-1) == trigger_id
+            assert data >> (data_width + trigger_id_width) == 0, f"{data:#x}"
+
+
+if __name__ == "__main__":
+    check(feature_mode=False)
+    check(feature_mode=True)
+    print("OK")
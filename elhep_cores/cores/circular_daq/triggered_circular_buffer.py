@@ -1,7 +1,24 @@
 import random
+from math import ceil
 
 from migen import *
 from migen.genlib.fsm import FSM
+from migen.genlib.fifo import SyncFIFO
+
+
+# Xilinx Series 7 block RAM aspect ratios (depth, width)
+RAMB36_CONFIGS = [(32768, 1), (16384, 2), (8192, 4), (4096, 9), (2048, 18), (1024, 36), (512, 72)]
+RAMB18_CONFIGS = [(16384, 1), (8192, 2), (4096, 4), (2048, 9), (1024, 18), (512, 36)]
+
+
+def bram_usage(width, depth):
+    """Estimates block RAM cost of width x depth memory
+
+    Returns cost in RAMB36 units (RAMB18 counts as half of RAMB36).
+    """
+    ramb36 = min(ceil(depth/d)*ceil(width/w) for d, w in RAMB36_CONFIGS)
+    ramb18 = min(ceil(depth/d)*ceil(width/w) for d, w in RAMB18_CONFIGS)
+    return min(ramb36, ramb18/2)
 
 
 class TriggeredCircularBuffer(Module):
@@ -10,98 +27,247 @@ class TriggeredCircularBuffer(Module):
 
     Implementation of circular buffer with triggered readout and adjustable
     pretrigger / posttrigger and support for trigger ID embedding.
+
+    Every trigger is a readout window of pretrigger+posttrigger+1 samples
+    (samples written pretrigger cycles before the trigger up to posttrigger
+    cycles after it). Triggers that arrive while a window is still being read
+    out are kept in a derandomizer queue (pending window start pointers and
+    trigger IDs), which is drained back-to-back. A trigger is rejected if the
+    queue is full or if its window would be overwritten before it can be read,
+    i.e. when the samples still to be read out plus pretrigger do not fit in
+    the buffer.
+
+    Accepted, queued (accepted while another readout was pending) and rejected
+    triggers are counted in `trigger_accepted`, `trigger_queued` and
+    `trigger_rejected`. Counters are cleared with `counters_clear`.
+    `accepted` is asserted in the cycle an accepted trigger arrives.
+
+    Readout is paused while `ready` is deasserted and the output sample is
+    held in `data_out` until it is consumed (`stb_out & ready`). If readout is
+    stalled for so long that the window being read gets overwritten,
+    `overrun` is asserted.
+
+    Buffers longer than `bank_length` are split into banks of `bank_length`
+    samples, each being a separate memory. Bank outputs are multiplexed in an
+    additional register stage, so that deep buffers close timing. Estimated
+    block RAM cost is available in `bram_usage` after elaboration.
     """
-    
-    def __init__(self, data_width=44, trigger_id_width=0, length=128):
-        
+
+    def __init__(self, data_width=44, trigger_id_width=0, length=128,
+            trigger_queue_depth=8, counter_width=32, bank_length=8192):
+        assert length & (length-1) == 0, "Buffer length must be a power of 2"
+        assert bank_length & (bank_length-1) == 0, "Bank length must be a power of 2"
+
         self.data_in = Signal(data_width)
         self.we = Signal()
 
         self.pretrigger = Signal(max=length-1)
-        self.posttrigger = Signal(max=length-1)  
+        self.posttrigger = Signal(max=length-1)
         self.trigger = Signal()
         # trigger_id will be optimized out if not required
         self.trigger_id = Signal(max(trigger_id_width,1))
 
         # Trigger ID will be embedded into output data
         self.data_out = Signal(data_width+trigger_id_width)
-        self.stb_out = Signal()   
+        self.stb_out = Signal()
+        # Marks the last sample of the readout window
+        self.last_out = Signal()
+        self.ready = Signal(reset=1)
+        self.overrun = Signal()
+
+        self.trigger_accepted = Signal(counter_width)
+        self.trigger_queued = Signal(counter_width)
+        self.trigger_rejected = Signal(counter_width)
+        self.counters_clear = Signal()
+        self.accepted = Signal()
 
         # # #
 
-        buffer = Memory(data_width + trigger_id_width, length)
-        wr_port = buffer.get_port(write_capable=True)
-        rd_port = buffer.get_port(has_re=True)
-        self.specials += [buffer, wr_port, rd_port]
-        
-        self.wr_ptr = wr_ptr = Signal.like(wr_port.adr)
-        self.rd_ptr = rd_ptr = Signal.like(rd_port.adr)
+        bank_length = min(bank_length, length)
+        banks = length//bank_length
+        self.bram_usage = banks*bram_usage(data_width, bank_length)
+
+        # Pointers are two bits wider than memory address, so that caught up
+        # readout can be told apart from the one lagging by whole buffer and
+        # so that readout lag is known even if readout was stalled
+        adr_width = log2_int(length)
+        bank_adr_width = log2_int(bank_length)
+        self.wr_ptr = wr_ptr = Signal(adr_width+2)
+        self.rd_ptr = rd_ptr = Signal.like(wr_ptr)
+
+        wr_ports = []
+        rd_ports = []
+        for bank in range(banks):
+            buffer = Memory(data_width, bank_length)
+            wr_port = buffer.get_port(write_capable=True)
+            rd_port = buffer.get_port(has_re=True)
+            self.specials += [buffer, wr_port, rd_port]
+            wr_ports.append(wr_port)
+            rd_ports.append(rd_port)
+
+        trigger_queue = SyncFIFO(len(wr_ptr)+trigger_id_width, trigger_queue_depth)
+        self.submodules.trigger_queue = trigger_queue
+        window_start = Signal.like(wr_ptr)
+        queue_ptr = Signal.like(wr_ptr)
+        queue_trigger_id = Signal.like(self.trigger_id)
+        self.comb += [
+            window_start.eq(wr_ptr-self.pretrigger),
+            trigger_queue.din.eq(Cat(window_start, self.trigger_id)),
+            Cat(queue_ptr, queue_trigger_id).eq(trigger_queue.dout)
+        ]
+
+        window = Signal(max=2*length)
+        self.comb += window.eq(self.pretrigger+self.posttrigger+1)
+
+        # Samples pending readout: remaining part of the current window and
+        # all the windows waiting in the queue
+        backlog = Signal(max=3*length)
+        # Readout starts no earlier than two cycles after the trigger,
+        # hence the margin
+        window_fits = Signal()
+        self.comb += window_fits.eq(backlog + self.pretrigger + 3 <= length)
+
+        accept = Signal()
+        readout_pending = Signal()
+        self.comb += [
+            accept.eq(self.trigger & trigger_queue.writable & window_fits),
+            self.accepted.eq(accept)
+        ]
 
+        readout_cnt = Signal.like(window)
         trigger_id_d = Signal.like(self.trigger_id)
-        readout_cnt = Signal(max=length-1)
+        read = Signal()
+        sample_available = Signal()
+        advance = Signal()
+        lag = Signal.like(wr_ptr)
+        self.comb += [
+            sample_available.eq(rd_ptr != wr_ptr),
+            # Output register is either empty or being consumed
+            advance.eq(~self.stb_out | self.ready),
+            lag.eq(wr_ptr - rd_ptr),
+            self.overrun.eq(readout_pending & (lag >= length))
+        ]
+
         readout_fsm = FSM("IDLE")
         self.submodules += readout_fsm
 
+        pop_trigger = [
+            trigger_queue.re.eq(1),
+            NextValue(rd_ptr, queue_ptr),
+            NextValue(trigger_id_d, queue_trigger_id),
+            NextValue(readout_cnt, window)
+        ]
+
         readout_fsm.act("IDLE",
-            If(self.trigger == 1, 
-                NextState("READOUT"),
-                NextValue(trigger_id_d, self.trigger_id),
-                NextValue(rd_port.re, 1),
-                NextValue(readout_cnt, self.pretrigger+self.posttrigger+1))
-            .Else(
-                NextValue(rd_port.re, 0)
-            )
+            If(trigger_queue.readable,
+                *pop_trigger,
+                NextState("READOUT"))
         )
 
         readout_fsm.act("READOUT",
-            If(readout_cnt != 0, 
+            readout_pending.eq(1),
+            If(advance & sample_available,
+                read.eq(1),
+                NextValue(rd_ptr, rd_ptr+1),
                 NextValue(readout_cnt, readout_cnt-1),
-                NextValue(rd_port.re, 1),
-                NextValue(self.stb_out, 1))
-            .Else(
-                NextState("IDLE"),
-                NextValue(rd_port.re, 0),
-                NextValue(self.stb_out, 0)
+                If(readout_cnt == 1,
+                    # Drain the queue back-to-back
+                    If(trigger_queue.readable,
+                        *pop_trigger
+                    ).Else(
+                        NextState("IDLE")
+                    )
+                )
             )
         )
 
-        self.comb += [
-            wr_port.we.eq(self.we),
-            wr_port.adr.eq(wr_ptr),
+        self.comb += trigger_queue.we.eq(accept)
+        wr_bank = wr_ptr[bank_adr_width:adr_width]
+        rd_bank = rd_ptr[bank_adr_width:adr_width]
+        for bank, (wr_port, rd_port) in enumerate(zip(wr_ports, rd_ports)):
+            self.comb += [
+                wr_port.we.eq(self.we & ((wr_bank == bank) if banks > 1 else 1)),
+                wr_port.adr.eq(wr_ptr[:bank_adr_width]),
+                wr_port.dat_w.eq(self.data_in),
+                rd_port.adr.eq(rd_ptr[:bank_adr_width]),
+                rd_port.re.eq(advance)
+            ]
+
+        # Trigger ID is registered along with the memory read. The whole read
+        # pipeline advances only if the output is empty or being consumed.
+        stb_mem = Signal()
+        last_mem = Signal()
+        trigger_id_mem = Signal.like(self.trigger_id)
+        self.sync += If(advance,
+            stb_mem.eq(read),
+            last_mem.eq(readout_cnt == 1),
+            trigger_id_mem.eq(trigger_id_d)
+        )
+        if banks == 1:
             # Will be truncated from left (MSB)
-            wr_port.dat_w.eq(Cat(self.data_in, trigger_id_d)),
-            rd_port.adr.eq(rd_ptr),
-            self.data_out.eq(rd_port.dat_r)
-        ]
+            self.comb += [
+                self.data_out.eq(Cat(rd_ports[0].dat_r, trigger_id_mem)),
+                self.stb_out.eq(stb_mem),
+                self.last_out.eq(last_mem)
+            ]
+        else:
+            rd_bank_mem = Signal.like(rd_bank)
+            bank_dat_r = Array(rd_port.dat_r for rd_port in rd_ports)
+            self.sync += If(advance,
+                rd_bank_mem.eq(rd_bank),
+                # Will be truncated from left (MSB)
+                self.data_out.eq(Cat(bank_dat_r[rd_bank_mem], trigger_id_mem)),
+                self.stb_out.eq(stb_mem),
+                self.last_out.eq(last_mem)
+            )
+
         self.sync += [
-            If(self.we, 
-                rd_ptr.eq(wr_ptr-self.pretrigger),
+            If(self.we,
                 wr_ptr.eq(wr_ptr+1)
+            ),
+            backlog.eq(backlog + Mux(accept, window, 0) - read),
+            If(self.counters_clear,
+                self.trigger_accepted.eq(0),
+                self.trigger_queued.eq(0),
+                self.trigger_rejected.eq(0)
+            ).Elif(accept,
+                self.trigger_accepted.eq(self.trigger_accepted+1),
+                If(readout_pending | trigger_queue.readable,
+                    self.trigger_queued.eq(self.trigger_queued+1))
+            ).Elif(self.trigger,
+                self.trigger_rejected.eq(self.trigger_rejected+1)
             )
         ]
 
-def test_daq(dut, pretrigger=5, posttrigger=5):
+
+def test_daq(dut, pretrigger=5, posttrigger=5, triggers=1, trigger_spacing=1, stall=0.0):
     yield dut.we.eq(1)
     yield dut.pretrigger.eq(pretrigger)
     yield dut.posttrigger.eq(posttrigger)
     trigger_at = random.randint(64, 300)
+    trigger_times = [trigger_at+i*trigger_spacing for i in range(triggers)]
     readout = []
     yield
-    for t in range(512):
+    for t in range(512+2*triggers*(pretrigger+posttrigger+1)):
         yield dut.data_in.eq(t)
+        yield dut.ready.eq(random.random() >= stall)
         yield dut.trigger.eq(0)
-        if t == trigger_at:
+        if t in trigger_times:
             yield dut.trigger.eq(1)
-        if (yield dut.stb_out):
+            yield dut.trigger_id.eq(trigger_times.index(t))
+        if (yield dut.stb_out) and (yield dut.ready):
             readout.append((yield dut.data_out))
         yield
-    expected_readout = [trigger_at+i-pretrigger+1 for i in range(pretrigger+posttrigger)]
-    print(f"{pretrigger} / {posttrigger}")
+    assert not (yield dut.overrun)
+    data_mask = 2**len(dut.data_in)-1
+    expected_readout = [(trigger_id << len(dut.data_in)) | ((t+i-pretrigger) & data_mask)
+        for trigger_id, t in enumerate(trigger_times)
+        for i in range(pretrigger+posttrigger+1)]
+    print(f"{pretrigger} / {posttrigger} x{triggers}")
     print('='*40)
     print(expected_readout)
     print(readout)
-    for i in range(len(expected_readout)):
-        assert readout[i] == expected_readout[i]
+    assert readout == expected_readout
 
 def testbench(dut, pretrigger=5, posttrigger=5):
     for i in range(10):
@@ -113,7 +279,13 @@ def testbench(dut, pretrigger=5, posttrigger=5):
             pretrigger = random.randint(0, 63)
             posttrigger = 63-pretrigger
             yield from test_daq(dut, pretrigger, posttrigger)
+        # Overlapping and adjacent windows
+        yield from test_daq(dut, 10, 10, triggers=4, trigger_spacing=1)
+        yield from test_daq(dut, 10, 10, triggers=4, trigger_spacing=21)
+        yield from test_daq(dut, 20, 5, triggers=3, trigger_spacing=7)
+        # Stalled readout
+        yield from test_daq(dut, 10, 10, triggers=4, trigger_spacing=3, stall=0.3)
 
 if __name__ == "__main__":
-    dut = TriggeredCircularBuffer(44, 64)
+    dut = TriggeredCircularBuffer(44, 4)
     run_simulation(dut, testbench(dut), vcd_name="circular_buffer.vcd")
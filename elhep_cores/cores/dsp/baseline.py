@@ -11,9 +11,10 @@ from functools import reduce
 from operator import and_, add
 
 from math import cos, sin, pi
-from scipy import signal
 import numpy as np
 
+from elhep_cores.cores.dsp.fir import remez_lowpass
+
 
 class SignalBaseline(Module):
     def __init__(self, wsize=16, fs=100000000.0, cutoff=10000.0, trans_width=10000.0, numtaps=266):
@@ -30,8 +31,8 @@ class SignalBaseline(Module):
             trans_width (float, optional): Width of transition from pass band to stop band in Hz. Defaults to 10000.0.
             numtaps (int, optional): Size of the FIR filter. Defaults to 266.
         """
-        # Compute filter coefficients with SciPy
-        coef = signal.remez(numtaps, [0, cutoff, cutoff + trans_width, 0.5 * fs], [1, 0], Hz=fs)
+        # Compute filter coefficients with SciPy (cached)
+        coef = remez_lowpass(numtaps, fs, cutoff, trans_width)
 
         self.coef = coef
         self.wsize = wsize
@@ -40,6 +41,13 @@ class SignalBaseline(Module):
 
         ###
 
+        self.resources = {
+            "multipliers": numtaps,
+            "adders": numtaps-1,
+            "registers": numtaps*wsize + 2*wsize-1,
+            "memory_bits": 0
+        }
+
         muls = []
         src = self.i
         for c in self.coef:
@@ -51,3 +59,170 @@ class SignalBaseline(Module):
         sum_full = Signal((2 * self.wsize - 1, True))
         self.sync += sum_full.eq(reduce(add, muls))
         self.comb += self.o.eq(sum_full >> self.wsize - 1)
+
+
+class MovingAverageBaseline(Module):
+    def __init__(self, wsize=16, log2_length=8, stages=1):
+        """Multiplierless baseline computation module
+
+        Cascade of `stages` moving averages (boxcar filters) of 2**log2_length
+        samples each, i.e. CIC filter without decimation. Every stage is a
+        running sum updated with the sample entering and the sample leaving
+        the window; the delay line is kept in memory. DC gain is 1, cost is
+        independent of the window length except for memory.
+
+        Use `i` and `o` for connecting input and output data respectively.
+
+        Args:
+            wsize (int, optional): Width of the signal vector. Defaults to 16.
+            log2_length (int, optional): Log2 of the window length. Defaults to 8.
+            stages (int, optional): Number of cascaded moving averages. Defaults to 1.
+        """
+        self.wsize = wsize
+        self.i = Signal((self.wsize, True))
+        self.o = Signal((self.wsize, True))
+
+        self.resources = {
+            "multipliers": 0,
+            "adders": 2*stages,
+            "registers": stages*(2*wsize + log2_length + len(Signal(log2_length))),
+            "memory_bits": stages * 2**log2_length * wsize
+        }
+
+        ###
+
+        src = self.i
+        for _ in range(stages):
+            delay_line = Memory(wsize, 2**log2_length)
+            port = delay_line.get_port(write_capable=True, mode=READ_FIRST)
+            self.specials += delay_line, port
+
+            pointer = Signal(log2_length)
+            src_d = Signal((wsize, True))
+            leaving = Signal((wsize, True))
+            running_sum = Signal((wsize+log2_length, True))
+            self.comb += [
+                port.adr.eq(pointer),
+                port.we.eq(1),
+                port.dat_w.eq(src),
+                leaving.eq(port.dat_r)
+            ]
+            self.sync += [
+                pointer.eq(pointer+1),
+                src_d.eq(src),
+                running_sum.eq(running_sum + src_d - leaving)
+            ]
+            src = running_sum[log2_length:]
+        self.comb += self.o.eq(src)
+
+
+class ExponentialBaseline(Module):
+    def __init__(self, wsize=16, shift=8, gate_level=None, gate_holdoff=0, gate_timeout=None):
+        """Gated exponential baseline computation module
+
+        First order IIR low-pass filter, y += (x - y) / 2**shift, without
+        multipliers. Time constant is about 2**shift samples. Filter is
+        initialized with the first sample.
+
+        With `gate_level` the baseline is frozen while the input differs
+        from it by more than `gate_level` (runtime configurable through
+        `gate_level` signal) and for `gate_holdoff` samples afterwards, so
+        that pulses do not pull the baseline. If the gate stays closed for
+        `gate_timeout` samples (e.g. baseline step), the filter is
+        initialized with the current sample.
+
+        Use `i` and `o` for connecting input and output data respectively.
+
+        Args:
+            wsize (int, optional): Width of the signal vector. Defaults to 16.
+            shift (int, optional): Log2 of the time constant in samples. Defaults to 8.
+            gate_level (int, optional): Initial gate level, None disables gating. Defaults to None.
+            gate_holdoff (int, optional): Samples to keep the gate closed. Defaults to 0.
+            gate_timeout (int, optional): Samples before reinitialization. Defaults to 2**shift.
+        """
+        self.wsize = wsize
+        self.i = Signal((self.wsize, True))
+        self.o = Signal((self.wsize, True))
+
+        gated = gate_level is not None
+        if gate_timeout is None:
+            gate_timeout = 2**shift
+        self.resources = {
+            "multipliers": 0,
+            "adders": 2 + (3 if gated else 0) + (1 if gate_holdoff else 0),
+            "registers": wsize + shift + 1 +
+                (wsize + len(Signal(max=gate_timeout+1)) if gated else 0) +
+                (len(Signal(max=gate_holdoff+1)) if gate_holdoff else 0),
+            "memory_bits": 0
+        }
+
+        ###
+
+        accumulator = Signal((wsize+shift, True))
+        initialized = Signal()
+        difference = Signal((wsize+1, True))
+        update = Signal()
+        reload = Signal()
+        self.comb += [
+            self.o.eq(accumulator[shift:]),
+            difference.eq(self.i - self.o)
+        ]
+
+        if gated:
+            self.gate_level = Signal(wsize, reset=gate_level)
+            outside = Signal()
+            self.comb += outside.eq(
+                (difference > self.gate_level) | (difference < -self.gate_level))
+            if gate_holdoff:
+                holdoff = Signal(max=gate_holdoff+1)
+                self.sync += If(outside,
+                    holdoff.eq(gate_holdoff)
+                ).Elif(holdoff != 0,
+                    holdoff.eq(holdoff-1)
+                )
+                self.comb += update.eq(~outside & (holdoff == 0))
+            else:
+                self.comb += update.eq(~outside)
+
+            timeout = Signal(max=gate_timeout+1)
+            self.sync += If(update | reload,
+                timeout.eq(0)
+            ).Else(
+                timeout.eq(timeout+1)
+            )
+            self.comb += reload.eq(~initialized | (timeout == gate_timeout))
+        else:
+            self.comb += [
+                update.eq(1),
+                reload.eq(~initialized)
+            ]
+
+        self.sync += [
+            initialized.eq(1),
+            If(reload,
+                accumulator.eq(self.i << shift)
+            ).Elif(update,
+                accumulator.eq(accumulator + difference)
+            )
+        ]
+
+
+def resource_report(estimators):
+    """Returns table of resources of baseline estimators (dict of name: module)"""
+    keys = ["multipliers", "adders", "registers", "memory_bits"]
+    lines = [f"{'Estimator':30s}" + "".join(f"{k:>14s}" for k in keys)]
+    lines.append("="*(30+14*len(keys)))
+    for name, estimator in estimators.items():
+        lines.append(f"{name:30s}" + "".join(f"{estimator.resources[k]:14d}" for k in keys))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    print(resource_report({
+        "SignalBaseline": SignalBaseline(),
+        "MovingAverageBaseline": MovingAverageBaseline(),
+        "MovingAverageBaseline, 3 stages": MovingAverageBaseline(stages=3),
+        "ExponentialBaseline": ExponentialBaseline(),
+        "ExponentialBaseline, gated": ExponentialBaseline(gate_level=64, gate_holdoff=32,
+                                                          gate_timeout=4096)
+    }))
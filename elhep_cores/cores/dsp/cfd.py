@@ -0,0 +1,211 @@
+from migen import *
+from migen.genlib.cdc import MultiReg
+from migen.genlib.fifo import AsyncFIFO
+from artiq.gateware.rtio import rtlink
+from artiq.gateware.rtio.channel import Channel
+
+from elhep_cores.cores.rtlink_csr import RtLinkCSR
+from elhep_cores.cores.trigger_generators import TriggerGenerator
+from elhep_cores.helpers.ddb_manager import HasDdbManager
+
+
+class ConstantFractionDiscriminator(TriggerGenerator, HasDdbManager):
+
+    """
+    Digital constant fraction discriminator
+
+    Works on the samples of `data` (e.g. ADS5296A_XS7.data_o) in `cd` clock
+    domain. The pulse, x = data - offset (negated with `negative`), is
+    compared with its delayed copy:
+
+        s(n) = x(n - delay) - fraction * x(n)
+
+    Timestamp is the zero crossing of s (from negative to non-negative)
+    interpolated linearly between the samples, with `fine_width` bits below
+    the sample period. Only crossings with x above `threshold` are taken,
+    the discriminator is rearmed once x goes back below the threshold.
+    Interpolation uses a pipelined divider (one stage per fine bit).
+
+    Outputs `trigger` (registered as `cfd`) with `trigger_fine` (fractional
+    part of the crossing) in `cd` clock domain, so that it can be used as
+    trigger and with CircularDAQ `trigger_fine_ts_dclk`. Timestamps are also
+    available as list-mode stream through RTIO input, one word per pulse:
+    [31:fine_width] sample counter, [fine_width-1:0] fractional part.
+
+    Configuration is a separate RTIO channel (RtLinkCSR):
+     * 0: enabled
+     * 1: negative
+     * 2: offset (baseline, in data units)
+     * 3: threshold (above offset)
+     * 4: fraction (in 1/2**fraction_width)
+     * 5: delay (in samples, 1 to max_delay)
+    """
+
+    def __init__(self, data, cd="sys", fine_width=8, fraction_width=8, max_delay=15,
+            fifo_depth=64, name="cfd", identifier=None):
+        super().__init__(name)
+        width = len(data)
+        delay_width = len(Signal(max=max_delay+1))
+
+        self.regs = regs = [
+            ("enabled", 1),
+            ("negative", 1),
+            ("offset", width),
+            ("threshold", width, 2**width-1),
+            ("fraction", fraction_width, 2**(fraction_width-1)),
+            ("delay", delay_width, min(2, max_delay))
+        ]
+        self.submodules.csr = csr = RtLinkCSR(regs, name)
+
+        self.rtlink = rtlink_iface = rtlink.Interface(
+            rtlink.OInterface(data_width=1),
+            rtlink.IInterface(data_width=32, timestamped=True))
+
+        # Outputs
+        self.trigger = Signal()  # CD: cd
+        self.trigger_fine = Signal(fine_width)  # CD: cd
+        self.counter = Signal(32-fine_width)  # CD: cd, sample counter
+        self.trigger_counter = Signal(32-fine_width)  # CD: cd
+        self.register_trigger(self.trigger, "cfd", cd)
+
+        # # #
+
+        sync = getattr(self.sync, cd)
+
+        enabled = Signal()
+        negative = Signal()
+        offset = Signal(width)
+        threshold = Signal(width, reset=2**width-1)
+        fraction = Signal(fraction_width, reset=2**(fraction_width-1))
+        delay = Signal(delay_width, reset=min(2, max_delay))
+        self.specials += [
+            MultiReg(csr.enabled, enabled, cd),
+            MultiReg(csr.negative, negative, cd),
+            MultiReg(csr.offset, offset, cd),
+            MultiReg(csr.threshold, threshold, cd, reset=2**width-1),
+            MultiReg(csr.fraction, fraction, cd, reset=2**(fraction_width-1)),
+            MultiReg(csr.delay, delay, cd, reset=min(2, max_delay))
+        ]
+
+        sync += self.counter.eq(self.counter+1)
+
+        # Stage 1: baseline subtraction and polarity
+        x = Signal((width+2, True))
+        sync += x.eq(Mux(negative, offset - data, data - offset))
+
+        # Delay line with a dynamic tap
+        delay_line = [x]
+        for _ in range(max_delay):
+            d = Signal.like(x)
+            sync += d.eq(delay_line[-1])
+            delay_line.append(d)
+        x_delayed = Signal.like(x)
+        self.comb += x_delayed.eq(Array(delay_line)[delay])
+
+        # Stage 2: CFD signal, in 1/2**fraction_width
+        s = Signal((width+fraction_width+4, True))
+        s_prev = Signal.like(s)
+        above = Signal()
+        sync += [
+            s.eq((x_delayed << fraction_width) - fraction*x),
+            s_prev.eq(s),
+            above.eq(x > threshold)
+        ]
+
+        # Stage 3: zero crossing while above threshold
+        armed = Signal()
+        ready = Signal()
+        crossing = Signal()
+        self.comb += crossing.eq(armed & above & (s_prev < 0) & (s >= 0))
+        sync += [
+            If(~above | ~enabled,
+                armed.eq(0),
+                ready.eq(1)
+            ).Elif(crossing,
+                armed.eq(0),
+                ready.eq(0)
+            ).Elif(ready,
+                armed.eq(1)
+            )
+        ]
+
+        # Divider: fine = -s_prev * 2**fine_width / (s - s_prev), crossing is
+        # between samples of s_prev and s (s is 2 samples after data, so
+        # s_prev is the sample of counter - 3). Crossing exactly at s is
+        # taken as its sample with no fractional part.
+        div_width = len(s)+1
+        valid = crossing
+        remainder = Signal(div_width)
+        divisor = Signal(div_width)
+        quotient = Signal(fine_width)
+        coarse = Signal(32-fine_width)
+        self.comb += [
+            If(s == 0,
+                remainder.eq(0),
+                coarse.eq(self.counter - 2)
+            ).Else(
+                remainder.eq(-s_prev),
+                coarse.eq(self.counter - 3)
+            ),
+            divisor.eq(s - s_prev)
+        ]
+        for i in range(fine_width):
+            valid_n = Signal()
+            remainder_n = Signal(div_width)
+            divisor_n = Signal(div_width)
+            quotient_n = Signal(fine_width)
+            coarse_n = Signal(32-fine_width)
+            shifted = Signal(div_width+1)
+            self.comb += shifted.eq(remainder << 1)
+            sync += [
+                valid_n.eq(valid),
+                divisor_n.eq(divisor),
+                coarse_n.eq(coarse),
+                If(shifted >= divisor,
+                    remainder_n.eq(shifted - divisor),
+                    quotient_n.eq(Cat(1, quotient))
+                ).Else(
+                    remainder_n.eq(shifted),
+                    quotient_n.eq(Cat(0, quotient))
+                )
+            ]
+            valid, remainder, divisor, quotient, coarse = \
+                valid_n, remainder_n, divisor_n, quotient_n, coarse_n
+
+        self.comb += [
+            self.trigger.eq(valid),
+            self.trigger_fine.eq(quotient),
+            self.trigger_counter.eq(coarse)
+        ]
+
+        # List-mode readout
+        readout_fifo = ClockDomainsRenamer({"write": cd, "read": "rio_phy"})(
+            AsyncFIFO(width=32, depth=fifo_depth))
+        self.submodules += readout_fifo
+        self.comb += [
+            readout_fifo.we.eq(valid),
+            readout_fifo.din.eq(Cat(quotient, coarse)),
+            readout_fifo.re.eq(1),
+            rtlink_iface.i.stb.eq(readout_fifo.readable),
+            rtlink_iface.i.data.eq(readout_fifo.dout)
+        ]
+
+        if identifier is not None:
+            self.add_rtio_channels(
+                channel=Channel.from_phy(csr),
+                device_id=f"{identifier}_csr",
+                module="elhep_cores.coredevice.rtlink_csr",
+                class_name="RtlinkCsr",
+                arguments={
+                    "regs": regs
+                })
+            self.add_rtio_channels(
+                channel=Channel.from_phy(self, ififo_depth=fifo_depth),
+                device_id=identifier,
+                module="elhep_cores.coredevice.cfd",
+                class_name="ConstantFractionDiscriminator",
+                arguments={
+                    "csr_device": f"{identifier}_csr",
+                    "fine_width": fine_width,
+                    "fraction_width": fraction_width
+                })
@@ -0,0 +1,167 @@
+from migen import *
+from migen.genlib.fifo import AsyncFIFO
+from artiq.gateware.rtio import rtlink
+from artiq.gateware.rtio.channel import Channel
+
+from functools import lru_cache
+from scipy import signal
+
+from elhep_cores.helpers.ddb_manager import HasDdbManager
+
+
+@lru_cache(maxsize=None)
+def remez_lowpass(numtaps, fs, cutoff, trans_width):
+    """Low-pass FIR coefficients designed with Remez exchange algorithm
+
+    Results are cached, so that elaborating many filters with the same
+    parameters runs the design once.
+    """
+    return tuple(signal.remez(numtaps, [0, cutoff, cutoff + trans_width, 0.5 * fs], [1, 0], Hz=fs))
+
+
+def quantize_coefficients(coefficients, coef_width):
+    """Converts coefficients to integers scaled by 2**(coef_width-1)"""
+    limit = 2**(coef_width-1)
+    return [max(-limit, min(limit-1, int(round(c*limit)))) for c in coefficients]
+
+
+class SymmetricFIR(Module):
+    def __init__(self, numtaps, wsize=16, coef_width=18, coefficients=None, shift=None):
+        """Symmetric FIR filter with runtime loadable coefficients
+
+        Coefficients are assumed symmetric (linear phase), so pairs of
+        samples sharing a coefficient are pre-added and only
+        ceil(numtaps/2) multipliers are used. Products are summed in a
+        systolic chain (pre-adder, multiplier and partial sum registered in
+        every stage, input delay line with two registers per stage), so
+        there is no wide adder tree. Latency is ceil(numtaps/2)+2 cycles
+        plus the usual numtaps//2 group delay.
+
+        Use `i` and `o` for connecting input and output data respectively.
+        Coefficients (first half, see `coefficients`) are loaded into a
+        shadow bank with `coef_we`, `coef_adr` and `coef_dat` and become
+        active at once with `coef_commit`.
+
+        Args:
+            numtaps (int): Number of filter taps.
+            wsize (int, optional): Width of the signal vector. Defaults to 16.
+            coef_width (int, optional): Width of coefficients. Defaults to 18.
+            coefficients (list, optional): Initial integer coefficients, first
+                ceil(numtaps/2) taps. Defaults to None (all zero).
+            shift (int, optional): Right shift of the result. Defaults to coef_width-1.
+        """
+        self.numtaps = numtaps
+        self.folded_taps = folded_taps = (numtaps+1)//2
+        self.wsize = wsize
+        self.coef_width = coef_width
+        if shift is None:
+            shift = coef_width-1
+        if coefficients is None:
+            coefficients = [0]*folded_taps
+        assert len(coefficients) == folded_taps, "First half of the coefficients is expected"
+
+        self.i = Signal((wsize, True))
+        self.o = Signal((wsize, True))
+
+        self.coef_we = Signal()
+        self.coef_adr = Signal(max=max(folded_taps, 2))
+        self.coef_dat = Signal((coef_width, True))
+        self.coef_commit = Signal()
+
+        self.resources = {
+            "multipliers": folded_taps,
+            "adders": 2*folded_taps,
+            "registers": 0,
+            "memory_bits": 0
+        }
+
+        ###
+
+        shadow = [Signal((coef_width, True), reset=c) for c in coefficients]
+        active = [Signal((coef_width, True), reset=c) for c in coefficients]
+        self.sync += [
+            If(self.coef_we,
+                Case(self.coef_adr, {k: shadow[k].eq(self.coef_dat) for k in range(folded_taps)})
+            ),
+            If(self.coef_commit,
+                *[a.eq(s) for a, s in zip(active, shadow)]
+            )
+        ]
+
+        # Forward delay line (two registers per stage) and the oldest sample
+        forward = [self.i]
+        for _ in range(2*(folded_taps-1)):
+            d = Signal((wsize, True))
+            self.sync += d.eq(forward[-1])
+            forward.append(d)
+        oldest = self.i
+        for _ in range(numtaps-1):
+            d = Signal((wsize, True))
+            self.sync += d.eq(oldest)
+            oldest = d
+
+        sum_width = wsize + 1 + coef_width + len(Signal(max=folded_taps+1))
+        partial_sum = None
+        for k in range(folded_taps):
+            pre_add = Signal((wsize+1, True))
+            product = Signal((wsize+1+coef_width, True))
+            stage_sum = Signal((sum_width, True))
+            # Middle tap of odd length filter has no pair
+            paired = oldest if 2*k+1 != numtaps else 0
+            self.sync += [
+                pre_add.eq(forward[2*k] + paired),
+                product.eq(pre_add * active[k]),
+                stage_sum.eq(product if partial_sum is None else partial_sum + product)
+            ]
+            partial_sum = stage_sum
+        self.comb += self.o.eq(partial_sum >> shift)
+
+        self.resources["registers"] = (
+            2*folded_taps*coef_width + (2*(folded_taps-1) + numtaps-1)*wsize +
+            folded_taps*(2*wsize + 2 + coef_width + sum_width))
+
+
+class RtioSymmetricFIR(SymmetricFIR, HasDdbManager):
+    def __init__(self, numtaps, wsize=16, coef_width=18, coefficients=None, shift=None,
+            identifier=None):
+        """Symmetric FIR filter with coefficients loaded over RTIO
+
+        Filter runs in sys clock domain, use ClockDomainsRenamer to move it
+        (rio_phy is used for RTIO).
+
+        RTIO channel map:
+         * 0: write shadow coefficient, [31:24] index, [23:0] value
+         * 1: make shadow coefficients active
+        """
+        assert coef_width <= 24, "Coefficients up to 24 bits are supported"
+        assert (numtaps+1)//2 <= 256, "Up to 256 folded taps are supported"
+        SymmetricFIR.__init__(self, numtaps, wsize, coef_width, coefficients, shift)
+        self.rtlink = rtlink_iface = rtlink.Interface(
+            rtlink.OInterface(data_width=32, address_width=1))
+
+        # # #
+
+        # Coefficient writes are passed in order: [31:0] data, [32] commit
+        cdc = ClockDomainsRenamer({"write": "rio_phy", "read": "sys"})(
+            AsyncFIFO(width=33, depth=8))
+        self.submodules += cdc
+        self.comb += [
+            cdc.we.eq(rtlink_iface.o.stb),
+            cdc.din.eq(Cat(rtlink_iface.o.data, rtlink_iface.o.address[0])),
+            cdc.re.eq(1),
+            self.coef_we.eq(cdc.readable & ~cdc.dout[32]),
+            self.coef_commit.eq(cdc.readable & cdc.dout[32]),
+            self.coef_adr.eq(cdc.dout[24:32]),
+            self.coef_dat.eq(cdc.dout[:coef_width])
+        ]
+
+        if identifier is not None:
+            self.add_rtio_channels(
+                channel=Channel.from_phy(self),
+                device_id=identifier,
+                module="elhep_cores.coredevice.fir",
+                class_name="SymmetricFIR",
+                arguments={
+                    "numtaps": numtaps,
+                    "coef_width": coef_width
+                })
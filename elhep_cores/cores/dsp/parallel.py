@@ -0,0 +1,308 @@
+"""DSP blocks working on P samples per clock
+
+Samples are given as a list of P lanes (signals), lane 0 holds the oldest
+sample of the clock cycle, i.e. sample n*P+k is in lane k of cycle n (e.g.
+ISERDES or ADC with several samples per fabric clock). With P=1 blocks
+work on a single sample per clock, so the same gateware covers both cases.
+
+Every block has `i` and `o` lanes and `latency` (in clock cycles).
+"""
+
+from functools import reduce
+from operator import and_, or_, add
+
+from migen import *
+from migen.genlib.coding import PriorityEncoder
+
+
+def as_lanes(data):
+    """Returns lanes of `data` (signal or list of signals)"""
+    if isinstance(data, (list, tuple)):
+        return list(data)
+    return [data]
+
+
+class _History(Module):
+    """Samples of `lanes` back to `depth` samples before the current clock
+
+    `samples[j]` is the sample j samples before the first lane of the
+    current clock (j >= 1), registered from previous clocks.
+    """
+
+    def __init__(self, lanes, depth):
+        p = len(lanes)
+        self.samples = {}
+        previous = lanes
+        for cycle in range((depth + p - 1)//p):
+            delayed = [Signal.like(s) for s in lanes]
+            self.sync += [d.eq(s) for d, s in zip(delayed, previous)]
+            for k, d in enumerate(delayed):
+                self.samples[(cycle+1)*p - k] = d
+            previous = delayed
+
+    def window(self, lanes, k, length):
+        """Samples ending at lane k, oldest first"""
+        return [lanes[k-j] if k-j >= 0 else self.samples[j-k] for j in reversed(range(length))]
+
+
+class ParallelThreshold(Module):
+
+    """Threshold comparator, o[k] = i[k] > level (< with `negative`)
+
+    `level_shape` defaults to the sample shape, use a wider signed one for
+    levels relative to the baseline.
+    """
+
+    latency = 1
+
+    def __init__(self, p, wsize, signed=False, level_shape=None):
+        self.i = [Signal((wsize, signed)) for _ in range(p)]
+        self.o = [Signal() for _ in range(p)]
+        self.level = Signal(level_shape if level_shape is not None else (wsize, signed))
+        self.negative = Signal()
+
+        # # #
+
+        self.sync += [o.eq(Mux(self.negative, i < self.level, i > self.level))
+            for i, o in zip(self.i, self.o)]
+
+
+class ParallelRunDetector(Module):
+
+    """o[k] is set if i was set for `length` consecutive samples up to k
+
+    Combinatorial, earlier samples are taken from registered history.
+    """
+
+    latency = 0
+
+    def __init__(self, p, length):
+        self.i = [Signal() for _ in range(p)]
+        self.o = [Signal() for _ in range(p)]
+
+        # # #
+
+        self.submodules.history = history = _History(self.i, length-1)
+        self.comb += [o.eq(reduce(and_, history.window(self.i, k, length)))
+            for k, o in enumerate(self.o)]
+
+
+class ParallelEdgeDetector(Module):
+
+    """Rising edge detector (falling with `falling`)
+
+    o[k] is set for every sample which differs from the previous one in the
+    given direction. `any` is set if there is an edge in the clock cycle,
+    `index` gives the lane of the first one.
+    """
+
+    latency = 1
+
+    def __init__(self, p, falling=False):
+        self.i = [Signal() for _ in range(p)]
+        self.o = [Signal() for _ in range(p)]
+        self.any = Signal()
+        self.index = Signal(max=max(p, 2))
+
+        # # #
+
+        previous = Signal()
+        self.sync += previous.eq(self.i[-1])
+        before = [previous] + self.i[:-1]
+        if falling:
+            self.sync += [o.eq(~i & b) for i, b, o in zip(self.i, before, self.o)]
+        else:
+            self.sync += [o.eq(i & ~b) for i, b, o in zip(self.i, before, self.o)]
+
+        encoder = PriorityEncoder(max(p, 2))
+        self.submodules += encoder
+        self.comb += [
+            encoder.i.eq(Cat(*self.o)),
+            self.any.eq(reduce(or_, self.o)),
+            self.index.eq(encoder.o)
+        ]
+
+
+class ParallelMovingSum(Module):
+
+    """Sum of the last `length` samples for every lane
+
+    Running sum over all samples (wrapping) is kept per lane, the sum is
+    the difference of the running sums `length` samples apart, which are
+    kept in memory (registers for short windows).
+    """
+
+    latency = 2
+
+    def __init__(self, p, wsize, length, signed=True):
+        sum_width = wsize + bits_for(length)
+        self.i = [Signal((wsize, signed)) for _ in range(p)]
+        self.o = [Signal((sum_width, signed)) for _ in range(p)]
+
+        # # #
+
+        # Stage 1: running sums
+        running = [Signal(sum_width) for _ in range(p)]
+        total = running[-1]
+        partial = total
+        for i, r in zip(self.i, running):
+            partial = partial + i
+            self.sync += r.eq(partial)
+
+        # Running sums `length` samples back, i.e. `q` or `q+1` cycles
+        q, r = divmod(length, p)
+        delayed = {}
+        for cycles in sorted({q + (1 if k < r else 0) for k in range(p)}):
+            delayed[cycles] = self._delay(running, cycles)
+
+        # Stage 2: window sums
+        for k, o in enumerate(self.o):
+            if k >= r:
+                start = delayed[q][k-r]
+            else:
+                start = delayed[q+1][k-r+p]
+            self.sync += o.eq(running[k] - start)
+
+    def _delay(self, signals, cycles):
+        if cycles == 0:
+            return signals
+        width = sum(len(s) for s in signals)
+        if cycles <= 4:
+            word = Cat(*signals)
+            for _ in range(cycles):
+                d = Signal(width)
+                self.sync += d.eq(word)
+                word = d
+        else:
+            # Read-first memory, read data is one cycle late
+            memory = Memory(width, cycles-1)
+            port = memory.get_port(write_capable=True, mode=READ_FIRST)
+            self.specials += memory, port
+            pointer = Signal(max=cycles-1)
+            self.sync += If(pointer == cycles-2, pointer.eq(0)).Else(pointer.eq(pointer+1))
+            self.comb += [
+                port.adr.eq(pointer),
+                port.we.eq(1),
+                port.dat_w.eq(Cat(*signals))
+            ]
+            word = port.dat_r
+        out = [Signal(len(s)) for s in signals]
+        offset = 0
+        for o in out:
+            self.comb += o.eq(word[offset:offset+len(o)])
+            offset += len(o)
+        return out
+
+
+class ParallelFIR(Module):
+
+    """FIR filter with fixed integer coefficients
+
+    o[k] is the sum of coefficients[j] * sample (k-j), right shifted by
+    `shift`. Products are registered, then summed.
+    """
+
+    latency = 2
+
+    def __init__(self, p, wsize, coefficients, shift=0):
+        self.i = [Signal((wsize, True)) for _ in range(p)]
+        self.o = [Signal((wsize, True)) for _ in range(p)]
+
+        # # #
+
+        numtaps = len(coefficients)
+        self.submodules.history = history = _History(self.i, numtaps-1)
+        coef_width = max(bits_for(c) for c in coefficients) + 1
+        sum_width = wsize + coef_width + bits_for(numtaps)
+        for k, o in enumerate(self.o):
+            window = history.window(self.i, k, numtaps)
+            products = []
+            # Window is oldest first, coefficient 0 applies to the newest
+            for c, x in zip(reversed(coefficients), window):
+                if c == 0:
+                    continue
+                product = Signal((wsize + coef_width, True))
+                self.sync += product.eq(c * x)
+                products.append(product)
+            total = Signal((sum_width, True))
+            self.sync += total.eq(reduce(add, products) if products else 0)
+            self.comb += o.eq(total >> shift)
+
+
+class ParallelMovingAverageBaseline(Module):
+
+    """Moving average of 2**log2_length samples as signal baseline
+
+    `o` is the average of the window ending at the last lane (one value
+    per clock cycle, baseline is slow). Parallel counterpart of
+    elhep_cores.cores.dsp.baseline.MovingAverageBaseline.
+    """
+
+    latency = ParallelMovingSum.latency
+
+    def __init__(self, p, wsize=16, log2_length=8):
+        self.submodules.moving_sum = moving_sum = \
+            ParallelMovingSum(p, wsize, 2**log2_length)
+        self.i = moving_sum.i
+        self.o = Signal((wsize, True))
+
+        # # #
+
+        self.comb += self.o.eq(moving_sum.o[-1] >> log2_length)
+
+
+class ParallelHysteresisTrigger(Module):
+
+    """Threshold trigger with hysteresis
+
+    o[k] is set when sample k crosses `level` (goes above it, below with
+    `negative`) while armed; the trigger is rearmed once a sample returns
+    past `level` by more than `hysteresis`. State is passed from lane to
+    lane within the clock cycle. `any` and `index` as in
+    ParallelEdgeDetector.
+    """
+
+    latency = 1
+
+    def __init__(self, p, wsize, signed=False):
+        self.i = [Signal((wsize, signed)) for _ in range(p)]
+        self.o = [Signal() for _ in range(p)]
+        self.any = Signal()
+        self.index = Signal(max=max(p, 2))
+
+        self.enabled = Signal()
+        self.negative = Signal()
+        self.level = Signal((wsize, signed))
+        self.hysteresis = Signal(wsize)
+
+        # # #
+
+        # Rearm threshold, one bit wider to avoid wrapping
+        rearm_level = Signal((wsize+2, True))
+        self.sync += rearm_level.eq(Mux(self.negative,
+            self.level + self.hysteresis, self.level - self.hysteresis))
+
+        armed = Signal(reset=1)
+        state = armed
+        for i, o in zip(self.i, self.o):
+            crossed = Signal()
+            rearm = Signal()
+            fire = Signal()
+            next_state = Signal()
+            self.comb += [
+                crossed.eq(Mux(self.negative, i < self.level, i > self.level)),
+                rearm.eq(Mux(self.negative, i > rearm_level, i < rearm_level)),
+                fire.eq(state & self.enabled & crossed),
+                next_state.eq(Mux(state, ~fire, rearm))
+            ]
+            self.sync += o.eq(fire)
+            state = next_state
+        self.sync += armed.eq(state)
+
+        encoder = PriorityEncoder(max(p, 2))
+        self.submodules += encoder
+        self.comb += [
+            encoder.i.eq(Cat(*self.o)),
+            self.any.eq(reduce(or_, self.o)),
+            self.index.eq(encoder.o)
+        ]
@@ -0,0 +1,147 @@
+from functools import reduce
+from operator import and_
+
+from migen import *
+from migen.genlib.cdc import MultiReg
+from artiq.gateware.rtio import rtlink
+from artiq.gateware.rtio.channel import Channel
+
+from elhep_cores.helpers.ddb_manager import HasDdbManager
+
+
+# Words per channel: sum low/high, sum of squares low/high
+PEDESTAL_WORDS = 4
+
+
+class _LaneAccumulator(Module):
+    def __init__(self, data, samples_width):
+        # Accumulation starts when `start` toggles, `done` follows `start`
+        # once it is finished
+        self.start = Signal()
+        self.samples = Signal(samples_width)
+        self.done = Signal()
+        self.sum = Signal(len(data)+samples_width)
+        self.sum_squares = Signal(2*len(data)+samples_width)
+
+        # # #
+
+        start = Signal()
+        started = Signal()
+        x = Signal(len(data))
+        remaining = Signal(samples_width)
+        running = Signal()
+        self.sync += [
+            start.eq(self.start),
+            x.eq(data),
+            If(start != started,
+                started.eq(start),
+                running.eq(1),
+                remaining.eq(self.samples),
+                self.sum.eq(0),
+                self.sum_squares.eq(0)
+            ).Elif(running,
+                If(remaining == 0,
+                    running.eq(0),
+                    self.done.eq(started)
+                ).Else(
+                    remaining.eq(remaining-1),
+                    self.sum.eq(self.sum + x),
+                    self.sum_squares.eq(self.sum_squares + x*x)
+                )
+            )
+        ]
+
+
+class PedestalAccumulator(Module, HasDdbManager):
+
+    """
+    Pedestal and noise accumulator
+
+    Accumulates sum and sum of squares of `samples` consecutive samples of
+    every lane of `data` (list of signals, `cd` is the clock domain of all
+    of them or a list with clock domain of every lane), so that pedestal
+    (mean) and noise (RMS) can be computed without the waveform readout.
+    Sums are wide enough for 2**samples_width-1 samples.
+
+    RTIO channel map:
+     * 0: start, data is number of samples
+     * 1: readout, results are sent to RTIO input (not timestamped) once
+       all lanes are done: for every lane sum [31:0], sum [63:32], sum of
+       squares [31:0] and sum of squares [63:32]
+    """
+
+    def __init__(self, data, cd="sys", samples_width=24, name="pedestal", identifier=None):
+        n = len(data)
+        if isinstance(cd, str):
+            cd = [cd]*n
+        assert len(cd) == n, "Clock domain must be given for every lane"
+        assert 2*max(len(d) for d in data) + samples_width <= 64, "Sums must fit in 64 bits"
+        self.name = name
+
+        words = PEDESTAL_WORDS*n
+        self.rtlink = rtlink_iface = rtlink.Interface(
+            rtlink.OInterface(data_width=samples_width, address_width=1),
+            rtlink.IInterface(data_width=32, timestamped=False))
+
+        # # #
+
+        samples = Signal(samples_width)
+        start = Signal()
+        self.sync.rio_phy += [
+            If(rtlink_iface.o.stb & (rtlink_iface.o.address == 0),
+                samples.eq(rtlink_iface.o.data),
+                start.eq(~start)
+            )
+        ]
+
+        results = []
+        lanes_done = []
+        for d, lane_cd in zip(data, cd):
+            lane = ClockDomainsRenamer(lane_cd)(_LaneAccumulator(d, samples_width))
+            self.submodules += lane
+            done = Signal()
+            self.specials += [
+                MultiReg(samples, lane.samples, lane_cd),
+                MultiReg(start, lane.start, lane_cd),
+                MultiReg(lane.done, done, "rio_phy")
+            ]
+            lanes_done.append(done == start)
+            # Sums are static once the lane is done
+            lane_sum = Signal(64)
+            lane_sum_squares = Signal(64)
+            self.comb += [
+                lane_sum.eq(lane.sum),
+                lane_sum_squares.eq(lane.sum_squares)
+            ]
+            results += [lane_sum[:32], lane_sum[32:], lane_sum_squares[:32], lane_sum_squares[32:]]
+
+        all_done = Signal()
+        self.comb += all_done.eq(reduce(and_, lanes_done))
+
+        readout = Signal()
+        word = Signal(max=words)
+        results = Array(results)
+        self.sync.rio_phy += [
+            rtlink_iface.i.stb.eq(0),
+            If(rtlink_iface.o.stb & (rtlink_iface.o.address == 1),
+                readout.eq(1),
+                word.eq(0)
+            ).Elif(readout & all_done,
+                rtlink_iface.i.stb.eq(1),
+                rtlink_iface.i.data.eq(results[word]),
+                word.eq(word+1),
+                If(word == words-1,
+                    readout.eq(0)
+                )
+            )
+        ]
+
+        if identifier is not None:
+            self.add_rtio_channels(
+                channel=Channel.from_phy(self, ififo_depth=1 << bits_for(words-1)),
+                device_id=identifier,
+                module="elhep_cores.coredevice.pedestal",
+                class_name="PedestalAccumulator",
+                arguments={
+                    "lanes": n
+                })
@@ -0,0 +1,69 @@
+"""Checks constant fraction discriminator timestamps of pulses at known times
+
+Run with: python -m elhep_cores.cores.dsp.tests.tb_cfd
+"""
+
+from migen import *
+
+from elhep_cores.cores.dsp.cfd import ConstantFractionDiscriminator
+
+
+def csr_write(csr, name, value):
+    o = csr.rtlink.o
+    yield o.address.eq([r[0] for r in csr.regs].index(name) << 1 | 1)
+    yield o.data.eq(value)
+    yield o.stb.eq(1)
+    yield
+    yield o.stb.eq(0)
+    yield
+
+
+def pulse(t, t0, amplitude=1000, slope=200):
+    """Linear rise from t0 up to amplitude, then flat"""
+    return int(round(min(max(slope*(t - t0), 0), amplitude)))
+
+
+def check(fine_width=8, period=64, steps=32):
+    """Pulses start `steps` fractions of a sample apart (including integer
+    sample positions, where the CFD signal crosses exactly zero at a
+    sample). With delay 2 and fraction 1/2 the linear edge crosses 4
+    samples after the start, timestamp is the sample counter when the
+    sample is on `data`.
+    """
+    data = Signal(14)
+    dut = ConstantFractionDiscriminator(data, fine_width=fine_width)
+    starts = [period*(k+1) + k/steps for k in range(steps)]
+    expected = [round((t0 + 4)*2**fine_width) for t0 in starts]
+    timestamps = []
+
+    def configure():
+        yield from csr_write(dut.csr, "threshold", 100)
+        yield from csr_write(dut.csr, "enabled", 1)
+
+    def generator():
+        for _ in range(20):
+            yield
+        for t in range(period*(steps+2)):
+            counter = yield dut.counter
+            value = sum(pulse(t, t0) for t0 in starts if t0 - 2 < t < t0 + period//2)
+            yield data.eq(value)
+            yield
+            if (yield dut.trigger):
+                timestamps.append(((yield dut.trigger_counter) << fine_width) +
+                                  (yield dut.trigger_fine))
+            if t == 0:
+                # Sample t is on data in the next cycle
+                offset = counter + 1
+        for i, (ts, e) in enumerate(zip(timestamps, expected)):
+            ts -= offset << fine_width
+            assert abs(ts - e) <= 1 and ts >> fine_width == e >> fine_width, \
+                f"pulse {i}: {ts} instead of {e}"
+
+    run_simulation(dut, {"rio_phy": configure(), "sys": generator()},
+                   clocks={"rio_phy": 8, "sys": 10})
+    assert len(timestamps) == steps, f"{len(timestamps)} of {steps} pulses"
+    print("OK")
+
+
+if __name__ == "__main__":
+    check()
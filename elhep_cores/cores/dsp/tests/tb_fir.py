@@ -0,0 +1,55 @@
+"""Checks symmetric FIR filter against numpy convolution
+
+Run with: python -m elhep_cores.cores.dsp.tests.tb_fir
+"""
+
+import numpy as np
+from migen import *
+
+from elhep_cores.cores.dsp.fir import SymmetricFIR
+
+
+def run(dut, coefficients, samples):
+    """Loads coefficients (first half), feeds samples, returns outputs"""
+    output = []
+
+    def generator():
+        for k, c in enumerate(coefficients):
+            yield dut.coef_we.eq(1)
+            yield dut.coef_adr.eq(k)
+            yield dut.coef_dat.eq(int(c))
+            yield
+        yield dut.coef_we.eq(0)
+        yield dut.coef_commit.eq(1)
+        yield
+        yield dut.coef_commit.eq(0)
+        for s in samples:
+            yield dut.i.eq(int(s))
+            yield
+            output.append((yield dut.o))
+
+    run_simulation(dut, generator())
+    return np.array(output)
+
+
+def check(numtaps, wsize=16, coef_width=18, n=400, seed=0):
+    rng = np.random.default_rng(seed)
+    # Gain of at most one, so that the output does not overflow
+    folded = rng.integers(-2**(coef_width-1), 2**(coef_width-1), (numtaps+1)//2)//numtaps
+    taps = np.concatenate([folded, folded[:numtaps//2][::-1]])
+    samples = rng.integers(-2**(wsize-1), 2**(wsize-1), n)
+
+    dut = SymmetricFIR(numtaps, wsize, coef_width)
+    output = run(dut, folded, samples)
+
+    latency = (numtaps+1)//2 + 2
+    shift = coef_width-1
+    reference = np.convolve(samples, taps)[:n] >> shift
+    assert np.array_equal(output[latency:], reference[:n-latency]), \
+        f"{numtaps} taps: output differs from reference"
+    print(f"{numtaps} taps: {n-latency} samples match")
+
+
+if __name__ == "__main__":
+    for numtaps in [1, 2, 7, 8, 31]:
+        check(numtaps)
@@ -0,0 +1,133 @@
+"""Checks that P samples per clock DSP blocks match the P=1 ones
+
+Run with: python -m elhep_cores.cores.dsp.tests.tb_parallel
+"""
+
+import numpy as np
+from migen import *
+
+from elhep_cores.cores.dsp.parallel import ParallelThreshold, ParallelRunDetector, \
+    ParallelEdgeDetector, ParallelMovingSum, ParallelFIR, ParallelHysteresisTrigger
+from elhep_cores.cores.trigger_generators import BaselineTriggerGenerator
+
+
+def run_lanes(dut, inputs, outputs, samples, setup=()):
+    """Feeds samples to `inputs` lanes, returns samples of `outputs` lanes
+
+    Outputs are collected every clock cycle, so they are delayed by latency
+    times the number of lanes samples.
+    """
+    p = len(inputs)
+    result = []
+
+    def generator():
+        for signal, value in setup:
+            yield signal.eq(value)
+        for n in range(len(samples)//p):
+            for i, s in zip(inputs, samples[n*p:(n+1)*p]):
+                yield i.eq(int(s))
+            yield
+            for o in outputs:
+                result.append((yield o))
+
+    run_simulation(dut, generator())
+    return np.array(result)
+
+
+def compare(name, run, samples, latency, reference=None, p=4):
+    """Runs a block built by `run(p)` with P lanes and a single lane"""
+    parallel = run(p, samples)[latency*p:]
+    serial = run(1, samples)[latency:]
+    n = min(len(parallel), len(serial))
+    assert np.array_equal(parallel[:n], serial[:n]), f"{name}: P={p} differs from P=1"
+    if reference is not None:
+        assert np.array_equal(serial[:n], reference[:n]), f"{name}: differs from reference"
+    print(f"{name}: {n} samples match")
+
+
+def signal(n=1024, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(n)
+    x = 100*np.sin(2*np.pi*t/97) + rng.normal(0, 30, n)
+    for t0 in rng.integers(0, n-20, 12):
+        x[t0:t0+8] += 300
+    return np.round(x).astype(int)
+
+
+def test_trigger_chain():
+    samples = signal()
+
+    def run(p, samples):
+        threshold = ParallelThreshold(p, 12, signed=True)
+        run_detector = ParallelRunDetector(p, 3)
+        edge = ParallelEdgeDetector(p)
+        dut = Module()
+        dut.submodules += threshold, run_detector, edge
+        dut.comb += [
+            [i.eq(o) for i, o in zip(run_detector.i, threshold.o)],
+            [i.eq(o) for i, o in zip(edge.i, run_detector.o)]
+        ]
+        return run_lanes(dut, threshold.i, edge.o, samples, [(threshold.level, 150)])
+
+    above = samples > 150
+    run3 = above & np.roll(above, 1) & np.roll(above, 2)
+    run3[:2] = False
+    reference = (run3 & ~np.roll(run3, 1)).astype(int)
+    compare("threshold, run and edge detectors", run, samples, 2, reference)
+
+
+def test_moving_sum():
+    samples = signal(seed=1)
+    for length in [3, 16, 37]:
+        def run(p, samples):
+            dut = ParallelMovingSum(p, 12, length)
+            return run_lanes(dut, dut.i, dut.o, samples)
+        reference = np.convolve(samples, np.ones(length, dtype=int))[:len(samples)]
+        compare(f"moving sum of {length}", run, samples, 2, reference)
+
+
+def test_fir():
+    samples = signal(seed=2)
+    coefficients = [3, -5, 0, 17, 31, 17, 0, -5, 3]
+
+    def run(p, samples):
+        dut = ParallelFIR(p, 16, coefficients, shift=2)
+        return run_lanes(dut, dut.i, dut.o, samples)
+
+    reference = np.convolve(samples, coefficients)[:len(samples)] >> 2
+    compare("FIR", run, samples, 2, reference)
+
+
+def test_hysteresis_trigger():
+    samples = signal(seed=3)
+
+    def run(p, samples):
+        dut = ParallelHysteresisTrigger(p, 12, signed=True)
+        setup = [(dut.enabled, 1), (dut.level, 150), (dut.hysteresis, 60)]
+        return run_lanes(dut, dut.i, dut.o, samples, setup)
+
+    compare("hysteresis trigger", run, samples, 1)
+
+
+def test_baseline_trigger():
+    samples = signal(seed=4)
+
+    def run(p, samples):
+        data = [Signal((12, True)) for _ in range(p)]
+        level = Signal((12, True))
+        dut = BaselineTriggerGenerator(data if p > 1 else data[0], level, 4)
+        # Trigger lanes as samples, from `trigger_re` and `trigger_re_index`
+        lanes = [Signal() for _ in range(p)]
+        dut.comb += [lane.eq(dut.trigger_re & (dut.trigger_re_index == k))
+            for k, lane in enumerate(lanes)]
+        return run_lanes(dut, data, lanes, samples, [(level, 150)])
+
+    compare("baseline trigger", run, samples, 2)
+
+
+if __name__ == "__main__":
+    test_trigger_chain()
+    test_moving_sum()
+    test_fir()
+    test_hysteresis_trigger()
+    test_baseline_trigger()
@@ -0,0 +1,77 @@
+"""Checks pedestal sums against the samples fed to the lanes
+
+Run with: python -m elhep_cores.cores.dsp.tests.tb_pedestal
+"""
+
+import numpy as np
+from migen import *
+
+from elhep_cores.cores.dsp.pedestal import PedestalAccumulator, PEDESTAL_WORDS
+
+
+@passive
+def lane_source(lane, samples, fed):
+    """Feeds `samples` to `lane`, one per cycle, appends them to `fed`"""
+    for s in samples:
+        yield lane.eq(int(s))
+        fed.append(int(s))
+        yield
+
+
+def matches(fed, count, total, total_squares):
+    """Tells if `count` consecutive samples of `fed` give the sums"""
+    x = np.array(fed, dtype=np.int64)
+    for start in range(len(x) - count + 1):
+        window = x[start:start+count]
+        if window.sum() == total and (window*window).sum() == total_squares:
+            return True
+    return False
+
+
+def check(width=14, runs=(100, 37, 0), seed=0):
+    rng = np.random.default_rng(seed)
+    data = [Signal(width) for _ in range(3)]
+    # Last lane in a clock domain of its own
+    dut = PedestalAccumulator(data, cd=["sys", "sys", "adc"], samples_width=16)
+    fed = [[] for _ in data]
+    results = []
+
+    def controller():
+        o = dut.rtlink.o
+        for _ in range(10):
+            yield
+        for count in runs:
+            for address, value in ((0, count), (1, 0)):
+                yield o.address.eq(address)
+                yield o.data.eq(value)
+                yield o.stb.eq(1)
+                yield
+                yield o.stb.eq(0)
+            words = []
+            timeout = 1000
+            while len(words) < PEDESTAL_WORDS*len(data):
+                yield
+                timeout -= 1
+                assert timeout, "Readout timeout"
+                if (yield dut.rtlink.i.stb):
+                    words.append((yield dut.rtlink.i.data))
+            results.append((count, words))
+
+    sources = [lane_source(d, rng.integers(0, 2**width, 5000), f)
+               for d, f in zip(data, fed)]
+    run_simulation(dut, {"rio_phy": [controller()], "sys": sources[:2], "adc": sources[2]},
+                   clocks={"rio_phy": 8, "sys": 10, "adc": 7})
+
+    assert len(results) == len(runs)
+    for count, words in results:
+        for lane in range(len(data)):
+            w = words[PEDESTAL_WORDS*lane:PEDESTAL_WORDS*(lane+1)]
+            total = w[0] | w[1] << 32
+            total_squares = w[2] | w[3] << 32
+            assert matches(fed[lane], count, total, total_squares), \
+                f"lane {lane}: sums of {count} samples do not match"
+    print("OK")
+
+
+if __name__ == "__main__":
+    check()
@@ -0,0 +1,363 @@
+from math import exp
+
+from migen import *
+from migen.genlib.cdc import MultiReg
+from migen.genlib.fifo import AsyncFIFO
+from artiq.gateware.rtio import rtlink
+from artiq.gateware.rtio.channel import Channel
+
+from elhep_cores.cores.rtlink_csr import RtLinkCSR
+from elhep_cores.helpers.ddb_manager import HasDdbManager
+
+
+class _DelayLine(Module):
+    """Delay by `delay` (1..depth-1) cycles plus one, kept in memory"""
+
+    def __init__(self, i, delay, depth, cd):
+        self.o = Signal.like(i)
+
+        # # #
+
+        memory = Memory(len(i), depth)
+        write_port = memory.get_port(write_capable=True, clock_domain=cd)
+        read_port = memory.get_port(clock_domain=cd)
+        self.specials += memory, write_port, read_port
+
+        pointer = Signal(log2_int(depth))
+        sync = getattr(self.sync, cd)
+        sync += pointer.eq(pointer+1)
+        self.comb += [
+            write_port.adr.eq(pointer),
+            write_port.we.eq(1),
+            write_port.dat_w.eq(i),
+            read_port.adr.eq(pointer - delay),
+            self.o.eq(read_port.dat_r)
+        ]
+
+
+class TrapezoidalShaper(Module, HasDdbManager):
+
+    """
+    Trapezoidal energy shaper
+
+    Recursive trapezoidal filter (Jordanov) of `data` in `cd` clock domain,
+    with runtime set rise time (k), flat top (m) and pole-zero constant
+    (M = 1/(exp(1/tau) - 1) for the preamplifier decay time constant tau in
+    samples):
+
+        d(n) = v(n) - v(n-k) - v(n-k-m) + v(n-2k-m)
+        p(n) = p(n-1) + d(n)
+        r(n) = p(n) + M*d(n)     (M in 1/2**pz_frac, p scaled to match)
+        s(n) = s(n-1) + r(n)
+
+    Delay lines are kept in memory and the only multiplication is M*d, so a
+    channel uses a single DSP48 (two with `pz_width` over 25). Filter is
+    exact (integer), height of the trapezoid is
+    amplitude * k * (M + 1) * 2**pz_frac. Baseline of the input gives a
+    constant offset of the output (k * (k+m) * 2**pz_frac per data unit).
+    Filter is restarted on every change of the configuration, the input is
+    taken as zero before, so the output settles after 2k+m samples.
+
+    On `trigger` (in `cd` clock domain) the maximum of s over the next
+    2k+m samples, relative to s `trigger_delay` samples before the trigger,
+    is taken as energy; pile-up is flagged if another trigger comes in the
+    meantime. Triggers come after the pulse start (e.g. CFD trigger is
+    about fine_width + 2 + CFD delay samples late) while s lags the input by
+    8 samples, so that the reference has to be taken before the trigger not
+    to fall on the rising edge of the trapezoid. Energy is
+    delivered through `energy_stb`, `energy` and `pileup` and as list-mode
+    stream through RTIO input, one word per trigger: [30:0] energy shifted
+    right by `energy_shift` (saturated), [31] pile-up.
+
+    Configuration is a separate RTIO channel (RtLinkCSR):
+     * 0: rise time k (samples, 1 to max_rise)
+     * 1: flat top m (samples, 0 to max_flat)
+     * 2: pole-zero constant M (fixed point with pz_frac fractional bits)
+     * 3: energy shift
+     * 4: trigger delay (samples, 0 to max_trigger_delay)
+    """
+
+    def __init__(self, data, trigger, cd="sys", max_rise=127, max_flat=127,
+            pz_width=24, pz_frac=8, trigger_delay=16, max_trigger_delay=31, fifo_depth=64,
+            name="trapezoidal_shaper", identifier=None):
+        width = len(data)
+        rise_width = len(Signal(max=max_rise+1))
+        flat_width = len(Signal(max=max_flat+1))
+        acc_width = 48
+        trigger_delay_width = len(Signal(max=max_trigger_delay+1))
+
+        self.regs = regs = [
+            ("rise", rise_width, min(16, max_rise)),
+            ("flat", flat_width, min(8, max_flat)),
+            ("pole_zero", pz_width),
+            ("energy_shift", 6),
+            ("trigger_delay", trigger_delay_width, trigger_delay)
+        ]
+        self.submodules.csr = csr = RtLinkCSR(regs, name)
+
+        self.rtlink = rtlink_iface = rtlink.Interface(
+            rtlink.OInterface(data_width=1),
+            rtlink.IInterface(data_width=32, timestamped=True))
+
+        # Outputs, CD: cd
+        self.shaped = Signal((acc_width, True))
+        self.energy_stb = Signal()
+        self.energy = Signal((acc_width, True))
+        self.pileup = Signal()
+
+        # # #
+
+        sync = getattr(self.sync, cd)
+
+        rise = Signal(rise_width, reset=min(16, max_rise))
+        flat = Signal(flat_width, reset=min(8, max_flat))
+        pole_zero = Signal(pz_width)
+        energy_shift = Signal(6)
+        trigger_delay_cd = Signal(trigger_delay_width, reset=trigger_delay)
+        self.specials += [
+            MultiReg(csr.rise, rise, cd, reset=min(16, max_rise)),
+            MultiReg(csr.flat, flat, cd, reset=min(8, max_flat)),
+            MultiReg(csr.pole_zero, pole_zero, cd),
+            MultiReg(csr.energy_shift, energy_shift, cd),
+            MultiReg(csr.trigger_delay, trigger_delay_cd, cd, reset=trigger_delay)
+        ]
+        gap = Signal(max=max_rise+max_flat+1)
+        sync += gap.eq(rise + flat)
+
+        # Filter is restarted (as if the input was zero before) a few cycles
+        # after reconfiguration, otherwise samples in flight would leave an
+        # offset in the accumulators
+        config = Cat(rise, flat, pole_zero)
+        config_prev = Signal.like(config)
+        settle = Signal(2)
+        restart = Signal()
+        sync += [
+            config_prev.eq(config),
+            If(config != config_prev,
+                settle.eq(3)
+            ).Elif(settle != 0,
+                settle.eq(settle-1)
+            ),
+            restart.eq(settle == 1)
+        ]
+        restart_d = [restart]
+        for _ in range(5):
+            r = Signal()
+            sync += r.eq(restart_d[-1])
+            restart_d.append(r)
+
+        # e(n) = v(n) - v(n-k), d(n) = e(n) - e(n-k-m), one extra cycle per
+        # stage for memory read; samples from before the restart are masked
+        v = Signal((width+1, True))
+        v_d = Signal.like(v)
+        sync += [
+            v.eq(data),
+            v_d.eq(v)
+        ]
+        v_delayed = _DelayLine(v, rise, 2**bits_for(max_rise), cd)
+        self.submodules += v_delayed
+        v_mask = Signal.like(rise)
+        e = Signal((width+2, True))
+        e_d = Signal.like(e)
+        sync += [
+            If(restart,
+                v_mask.eq(rise)
+            ).Elif(v_mask != 0,
+                v_mask.eq(v_mask-1)
+            ),
+            e.eq(v_d - Mux(v_mask != 0, 0, v_delayed.o)),
+            e_d.eq(e)
+        ]
+        e_delayed = _DelayLine(e, gap, 2**bits_for(max_rise+max_flat), cd)
+        self.submodules += e_delayed
+        e_mask = Signal.like(gap)
+        d = Signal((width+3, True))
+        sync += [
+            If(restart_d[2],
+                e_mask.eq(gap)
+            ).Elif(e_mask != 0,
+                e_mask.eq(e_mask-1)
+            ),
+            d.eq(e_d - Mux(e_mask != 0, 0, e_delayed.o))
+        ]
+
+        p = Signal((acc_width, True))
+        product = Signal((acc_width, True))
+        r = Signal((acc_width, True))
+        sync += [
+            If(restart_d[3], p.eq(0)).Else(p.eq(p + d)),
+            product.eq(d*pole_zero),
+            r.eq((p << pz_frac) + product),
+            If(restart_d[5],
+                self.shaped.eq(0)
+            ).Else(
+                self.shaped.eq(self.shaped + r)
+            )
+        ]
+
+        # s trigger_delay samples back, for delays over one from memory (which
+        # adds one cycle)
+        shaped_d = Signal.like(self.shaped)
+        sync += shaped_d.eq(self.shaped)
+        shaped_delayed = _DelayLine(self.shaped, trigger_delay_cd - 1,
+            2**bits_for(max_trigger_delay), cd)
+        self.submodules += shaped_delayed
+        shaped_before = Signal.like(self.shaped)
+        self.comb += shaped_before.eq(
+            Mux(trigger_delay_cd == 0, self.shaped,
+                Mux(trigger_delay_cd == 1, shaped_d, shaped_delayed.o)))
+
+        # Energy: maximum over 2k+m samples after the trigger
+        window = Signal(max=2*max_rise+max_flat+2)
+        measuring = Signal()
+        reference = Signal((acc_width, True))
+        maximum = Signal((acc_width, True))
+        pileup = Signal()
+        sync += [
+            self.energy_stb.eq(0),
+            If(measuring,
+                If(self.shaped > maximum, maximum.eq(self.shaped)),
+                If(trigger, pileup.eq(1)),
+                If(window == 0,
+                    measuring.eq(0),
+                    self.energy_stb.eq(1),
+                    self.energy.eq(maximum - reference),
+                    self.pileup.eq(pileup | trigger)
+                ).Else(
+                    window.eq(window-1)
+                )
+            ).Elif(trigger,
+                measuring.eq(1),
+                window.eq(rise + gap),
+                reference.eq(shaped_before),
+                maximum.eq(self.shaped),
+                pileup.eq(0)
+            )
+        ]
+
+        # List-mode readout
+        energy_shifted = Signal((acc_width, True))
+        word = Signal(32)
+        self.comb += [
+            energy_shifted.eq(self.energy >> energy_shift),
+            word.eq(Cat(
+                Mux(energy_shifted >= 2**31-1, 2**31-1,
+                    Mux(energy_shifted < 0, 0, energy_shifted[:31])),
+                self.pileup))
+        ]
+
+        readout_fifo = ClockDomainsRenamer({"write": cd, "read": "rio_phy"})(
+            AsyncFIFO(width=32, depth=fifo_depth))
+        self.submodules += readout_fifo
+        self.comb += [
+            readout_fifo.we.eq(self.energy_stb),
+            readout_fifo.din.eq(word),
+            readout_fifo.re.eq(1),
+            rtlink_iface.i.stb.eq(readout_fifo.readable),
+            rtlink_iface.i.data.eq(readout_fifo.dout)
+        ]
+
+        if identifier is not None:
+            self.add_rtio_channels(
+                channel=Channel.from_phy(csr),
+                device_id=f"{identifier}_csr",
+                module="elhep_cores.coredevice.rtlink_csr",
+                class_name="RtlinkCsr",
+                arguments={
+                    "regs": regs
+                })
+            self.add_rtio_channels(
+                channel=Channel.from_phy(self, ififo_depth=fifo_depth),
+                device_id=identifier,
+                module="elhep_cores.coredevice.trapezoidal",
+                class_name="TrapezoidalShaper",
+                arguments={
+                    "csr_device": f"{identifier}_csr",
+                    "pz_frac": pz_frac
+                })
+
+
+def csr_write(csr, name, value):
+    o = csr.rtlink.o
+    yield o.address.eq([r[0] for r in csr.regs].index(name) << 1 | 1)
+    yield o.data.eq(value)
+    yield o.stb.eq(1)
+    yield
+    yield o.stb.eq(0)
+    yield
+
+
+def exponential_pulses(starts, amplitude, tau, baseline, length):
+    """Samples of pulses with instant rise and exponential decay"""
+    samples = []
+    for n in range(length):
+        samples.append(baseline + int(round(sum(amplitude*exp(-(n-t0)/tau)
+                                                for t0 in starts if n >= t0))))
+    return samples
+
+
+def testbench(dut, data, trigger, samples, trigger_samples):
+    energies = []
+    for _ in range(20):
+        yield
+    for n, sample in enumerate(samples):
+        yield data.eq(sample)
+        if trigger is not None:
+            yield trigger.eq(n in trigger_samples)
+        yield
+        if (yield dut.energy_stb):
+            energies.append(((yield dut.energy), (yield dut.pileup)))
+    return energies
+
+
+def check(trigger_delay=16, latencies=range(0, 17, 4), with_cfd=False,
+        amplitude=400, tau=50, rise=16, flat=8, pz_frac=8):
+    """Energy (in units of the pulse amplitude) of pulses triggered
+    `latencies` samples after their start, or by CFD"""
+    pole_zero = int(round(2**pz_frac/(exp(1/tau) - 1)))
+    gain = rise*(pole_zero + 2**pz_frac)
+    period = 2*rise + flat + 60
+    starts = [period*(k+1) for k in range(len(latencies))]
+    samples = exponential_pulses(starts, amplitude, tau, 100, period*(len(starts)+1))
+
+    data = Signal(14)
+    dut = Module()
+    if with_cfd:
+        from elhep_cores.cores.dsp.cfd import ConstantFractionDiscriminator
+        cfd = ConstantFractionDiscriminator(data)
+        dut.submodules += cfd
+        trigger = None
+        trigger_signal = cfd.trigger
+    else:
+        trigger = trigger_signal = Signal()
+    shaper = TrapezoidalShaper(data, trigger_signal, pz_frac=pz_frac, trigger_delay=trigger_delay)
+    dut.submodules += shaper
+    energies = []
+
+    def configure():
+        yield from csr_write(shaper.csr, "rise", rise)
+        yield from csr_write(shaper.csr, "flat", flat)
+        yield from csr_write(shaper.csr, "pole_zero", pole_zero)
+        if with_cfd:
+            yield from csr_write(cfd.csr, "offset", 100)
+            yield from csr_write(cfd.csr, "threshold", amplitude//4)
+            yield from csr_write(cfd.csr, "enabled", 1)
+
+    def generator():
+        energies.extend((yield from testbench(shaper, data, trigger, samples,
+            [t0 + latency for t0, latency in zip(starts, latencies)])))
+
+    run_simulation(dut, {"rio_phy": configure(), "sys": generator()},
+                   clocks={"rio_phy": 8, "sys": 10})
+    assert len(energies) == len(starts), f"{len(energies)} of {len(starts)} energies"
+    for latency, (energy, pileup) in zip(latencies, energies):
+        source = "CFD trigger" if with_cfd else f"trigger {latency} samples late"
+        assert not pileup
+        assert abs(energy/gain - amplitude) < 0.01*amplitude, \
+            f"{source}: {energy/gain:.1f} instead of {amplitude}"
+
+
+if __name__ == "__main__":
+    check()
+    check(with_cfd=True)
+    print("OK")
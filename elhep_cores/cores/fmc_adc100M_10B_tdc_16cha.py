@@ -3,13 +3,19 @@ from migen.build.generic_platform import *
 from misoc.cores import gpio
 
 from artiq.gateware.rtio.phy.ttl_simple import *
-from artiq.gateware.rtio.phy import ttl_serdes_7series
+from artiq.gateware.rtio.phy import ttl_serdes_7series, ttl_serdes_generic
 from artiq.gateware.rtio.phy.spi2 import SPIMaster
 from artiq.gateware.rtio.phy.edge_counter import SimpleEdgeCounter
 from artiq.gateware import rtio
 
 from elhep_cores.cores.ads5296a_phy.ads5296a import ADS5296A_XS7
 from elhep_cores.cores.tdcgpx2_phy.tdcgpx2 import TdcGpx2Phy
+from elhep_cores.cores.trigger_generators import ThresholdTriggerBank, SerdesTriggerInput, \
+    RtioFineCoincidenceTriggerGenerator
+from elhep_cores.cores.dsp.cfd import ConstantFractionDiscriminator
+from elhep_cores.cores.dsp.trapezoidal import TrapezoidalShaper
+from elhep_cores.cores.histogram import RtioHistogram
+from elhep_cores.cores.dsp.pedestal import PedestalAccumulator
 
 from elhep_cores.cores.xilinx import *
 from elhep_cores.helpers.fmc import _FMC, _fmc_pin
@@ -136,7 +142,9 @@ class FmcAdc100M10b16chaTdc(_FMC):
         ]
 
     @classmethod
-    def add_std(cls, target, fmc, iostd_single, iostd_diff, with_trig=False, adc_daq_samples=1024, tdc_daq_samples=1024):
+    def add_std(cls, target, fmc, iostd_single, iostd_diff, with_trig=False, adc_daq_samples=1024, tdc_daq_samples=1024,
+            with_threshold_triggers=False, with_cfd=False, with_trapezoidal=False,
+            with_histograms=False, with_pedestals=False, with_coincidence=False):
         cls.add_extension(target, fmc, iostd_single, iostd_diff)
 
         # CFD DAC I2C
@@ -237,6 +245,8 @@ class FmcAdc100M10b16chaTdc(_FMC):
 
         # ADC
 
+        adc_lanes = []
+        adc_lanes_cd = []
         for adc_id in range(2):
             dclk_name = "fmc{}_adc{}_dclk".format(fmc, adc_id)
             adc_lclk = target.platform.request(cls.signal_name("adc_out_lclk", fmc), adc_id)
@@ -250,6 +260,8 @@ class FmcAdc100M10b16chaTdc(_FMC):
             target.platform.add_period_constraint(phy.lclk, 10.)
             phy_renamed_cd = ClockDomainsRenamer({"adclk_clkdiv": dclk_name})(phy)
             setattr(target.submodules, "fmc{}_adc{}_phy".format(fmc, adc_id), phy_renamed_cd)
+            adc_lanes += phy.data_o[:8]
+            adc_lanes_cd += [dclk_name]*8
             target.add_rtio_channels(
                 channel=rtio.Channel.from_phy(phy.csr), 
                 device_id=f"fmc{fmc}_adc{adc_id}_phycsr",
@@ -271,6 +283,46 @@ class FmcAdc100M10b16chaTdc(_FMC):
                 }
             )
 
+        if with_threshold_triggers:
+            # Triggers are available as target.fmc{fmc}_adc_threshold_trigger.trigger
+            threshold_trigger = ThresholdTriggerBank(adc_lanes, adc_lanes_cd,
+                name=f"fmc{fmc}_adc_threshold_trigger",
+                identifier=f"fmc{fmc}_adc_threshold_trigger")
+            setattr(target.submodules, f"fmc{fmc}_adc_threshold_trigger", threshold_trigger)
+
+        if with_pedestals:
+            pedestal = PedestalAccumulator(adc_lanes, adc_lanes_cd,
+                name=f"fmc{fmc}_adc_pedestal",
+                identifier=f"fmc{fmc}_adc_pedestal")
+            setattr(target.submodules, f"fmc{fmc}_adc_pedestal", pedestal)
+
+        if with_cfd:
+            for idx, (lane, lane_cd) in enumerate(zip(adc_lanes, adc_lanes_cd)):
+                cfd = ConstantFractionDiscriminator(lane, lane_cd,
+                    name=f"fmc{fmc}_adc_cfd{idx}",
+                    identifier=f"fmc{fmc}_adc_cfd{idx}")
+                setattr(target.submodules, f"fmc{fmc}_adc_cfd{idx}", cfd)
+
+        if with_trapezoidal:
+            # Energy is taken on CFD trigger (or threshold trigger without CFD)
+            assert with_cfd or with_threshold_triggers, "Trapezoidal shaper requires trigger"
+            for idx, (lane, lane_cd) in enumerate(zip(adc_lanes, adc_lanes_cd)):
+                if with_cfd:
+                    trigger = getattr(target, f"fmc{fmc}_adc_cfd{idx}").trigger
+                else:
+                    trigger = threshold_trigger.trigger[idx]
+                shaper = TrapezoidalShaper(lane, trigger, lane_cd,
+                    name=f"fmc{fmc}_adc_trapezoidal{idx}",
+                    identifier=f"fmc{fmc}_adc_trapezoidal{idx}")
+                setattr(target.submodules, f"fmc{fmc}_adc_trapezoidal{idx}", shaper)
+
+                if with_histograms:
+                    histogram = RtioHistogram(shaper.energy, shaper.energy_stb, lane_cd,
+                        bin_width=12,
+                        name=f"fmc{fmc}_adc_histogram{idx}",
+                        identifier=f"fmc{fmc}_adc_histogram{idx}")
+                    setattr(target.submodules, f"fmc{fmc}_adc_histogram{idx}", histogram)
+
         # TDC
 
         for tdc_id in range(4):
@@ -293,6 +345,15 @@ class FmcAdc100M10b16chaTdc(_FMC):
                         "regs": channel.csr.regs
                     })
 
+            if with_histograms:
+                # Histograms of the stop value (20 LSBs of the frame)
+                for idx, (data, stb) in enumerate(zip(phy.data_o, phy.data_stb_o)):
+                    histogram = RtioHistogram(data[:20], stb, dclk_name,
+                        bin_width=12,
+                        name=f"fmc{fmc}_tdc{tdc_id}_histogram{idx}",
+                        identifier=f"fmc{fmc}_tdc{tdc_id}_histogram{idx}")
+                    setattr(target.submodules, f"fmc{fmc}_tdc{tdc_id}_histogram{idx}", histogram)
+
             target.register_coredevice(
                 device_id=f"fmc{fmc}_tdc{tdc_id}_control",
                 module="elhep_cores.coredevice.tdc_gpx2",
@@ -308,13 +369,45 @@ class FmcAdc100M10b16chaTdc(_FMC):
 
         if with_trig:
             pads = target.platform.request(cls.signal_name("trig", fmc))
-            phy = ttl_serdes_7series.InOut_8X(pads.p, pads.n)
-            target.submodules += phy
+            # Same as InOut_8X, but the SERDES is kept to be shared with the
+            # trigger input of the coincidence trigger generator
+            trig_serdes = ttl_serdes_7series._IOSERDESE2_8X(pads.p, pads.n)
+            phy = ttl_serdes_generic.InOut(trig_serdes)
+            target.submodules += trig_serdes, phy
             target.add_rtio_channels(
                 channel=rtio.Channel.from_phy(phy, ififo_depth=64), 
                 device_id=f"fmc{fmc}_trig",
                 module="artiq.coredevice.ttl",
                 class_name="TTLInOut")
+
+        if with_coincidence:
+            # FMC trigger (and threshold triggers, if any) combined with sub-cycle
+            # resolution, trigger is available as target.fmc{fmc}_coincidence.trigger
+            assert with_trig, "Coincidence trigger generator requires FMC trigger input"
+            trig_input = SerdesTriggerInput(serdes=trig_serdes, name=f"fmc{fmc}_trig")
+            target.submodules += trig_input
+            generators = [trig_input]
+            if with_threshold_triggers:
+                generators.append(threshold_trigger)
+            coincidence = RtioFineCoincidenceTriggerGenerator(f"fmc{fmc}_coincidence", generators)
+            setattr(target.submodules, f"fmc{fmc}_coincidence", coincidence)
+            target.add_rtio_channels(
+                channel=rtio.Channel.from_phy(coincidence),
+                device_id=f"fmc{fmc}_coincidence",
+                module="elhep_cores.coredevice.trigger_generators",
+                class_name="RtioFineCoincidenceTriggerGenerator",
+                arguments={
+                    "mask_mapping": coincidence.get_mask_mapping(),
+                    "serdes_width": coincidence.serdes_width
+                })
+            target.add_rtio_channels(
+                channel=rtio.Channel.from_phy(coincidence.timestamps, ififo_depth=64),
+                device_id=f"fmc{fmc}_coincidence_timestamps",
+                module="elhep_cores.coredevice.trigger_generators",
+                class_name="CoincidenceTriggerTimestamps",
+                arguments={
+                    "latency": coincidence.latency
+                })
     
         # Frequency counters
 
@@ -0,0 +1,390 @@
+import random
+
+from migen import *
+from migen.genlib.cdc import MultiReg, PulseSynchronizer, BusSynchronizer
+from migen.genlib.fifo import AsyncFIFO
+from migen.genlib.fsm import FSM
+from artiq.gateware.rtio import rtlink
+from artiq.gateware.rtio.channel import Channel
+
+from elhep_cores.cores.rtlink_csr import RtLinkCSR
+from elhep_cores.helpers.ddb_manager import HasDdbManager
+
+
+class Histogram(Module):
+
+    """Histogram accumulator
+
+    Counts entries (`stb`, `value`) in 2**bin_width bins of `count_width`
+    bits kept in memory. Bin is (value >> shift) - offset, entries out of
+    range are counted in `underflow` and `overflow` instead. One entry per
+    clock cycle is accepted while `enabled`, bins saturate at the maximum
+    count.
+
+    Bins are incremented in a read-modify-write pipeline (read, increment,
+    write). Counts of the two entries ahead, which are not yet in memory
+    when the bin is read, are forwarded.
+
+    `clear` zeroes all bins and counters. `readout` (with `readout_start`
+    and `readout_count`) sends counts of the selected bins through
+    `source_stb`, `source_data` (held until `source_ready`). Clear takes
+    2**bin_width cycles, readout two cycles per bin; `busy` is set
+    meanwhile and entries are not accepted.
+    """
+
+    def __init__(self, value_width, bin_width=10, count_width=32):
+        bins = 2**bin_width
+        offset_width = min(value_width, 32)
+
+        self.stb = Signal()
+        self.value = Signal(value_width)
+
+        self.enabled = Signal()
+        self.offset = Signal(offset_width)
+        self.shift = Signal(max=max(value_width, 2))
+
+        self.clear = Signal()
+        self.readout = Signal()
+        self.readout_start = Signal(bin_width)
+        self.readout_count = Signal(bin_width+1)
+        self.busy = Signal()
+
+        self.source_stb = Signal()
+        self.source_data = Signal(count_width)
+        self.source_ready = Signal(reset=1)
+
+        self.entries = Signal(32)
+        self.underflow = Signal(32)
+        self.overflow = Signal(32)
+
+        # # #
+
+        memory = Memory(count_width, bins)
+        read_port = memory.get_port()
+        write_port = memory.get_port(write_capable=True)
+        self.specials += memory, read_port, write_port
+
+        # Stage 0: bin, read
+        scaled = Signal(value_width)
+        relative = Signal((max(value_width, offset_width)+1, True))
+        self.comb += [
+            scaled.eq(self.value >> self.shift),
+            relative.eq(scaled - self.offset)
+        ]
+        accept = Signal()
+        self.comb += accept.eq(self.stb & self.enabled & ~self.busy)
+
+        in_range = Signal()
+        self.comb += in_range.eq((relative >= 0) & (relative < bins))
+
+        valid1 = Signal()
+        bin1 = Signal(bin_width)
+        self.sync += [
+            valid1.eq(accept & in_range),
+            bin1.eq(relative[:bin_width])
+        ]
+
+        # Stage 1: increment, count is forwarded from stage 2 (written at the
+        # end of this cycle) and stage 3 (written with the read)
+        valid2 = Signal()
+        bin2 = Signal(bin_width)
+        count2 = Signal(count_width)
+        valid3 = Signal()
+        bin3 = Signal(bin_width)
+        count3 = Signal(count_width)
+        current = Signal(count_width)
+        self.comb += [
+            If(valid2 & (bin2 == bin1),
+                current.eq(count2)
+            ).Elif(valid3 & (bin3 == bin1),
+                current.eq(count3)
+            ).Else(
+                current.eq(read_port.dat_r)
+            )
+        ]
+        self.sync += [
+            valid2.eq(valid1),
+            bin2.eq(bin1),
+            count2.eq(Mux(current == 2**count_width-1, current, current+1)),
+            valid3.eq(valid2),
+            bin3.eq(bin2),
+            count3.eq(count2)
+        ]
+
+        # Counters
+        self.sync += [
+            If(self.clear,
+                self.entries.eq(0),
+                self.underflow.eq(0),
+                self.overflow.eq(0)
+            ).Elif(accept,
+                self.entries.eq(self.entries+1),
+                If(relative < 0,
+                    self.underflow.eq(self.underflow+1)
+                ).Elif(relative >= bins,
+                    self.overflow.eq(self.overflow+1)
+                )
+            )
+        ]
+
+        # Clear and readout sweep, started once the pipeline is empty
+        sweep_adr = Signal(bin_width)
+        sweep_remaining = Signal(bin_width+1)
+        pending_clear = Signal()
+        pending_readout = Signal()
+        readout_start = Signal(bin_width)
+        readout_count = Signal(bin_width+1)
+        pipeline_empty = Signal()
+        self.comb += pipeline_empty.eq(~valid1 & ~valid2 & ~valid3)
+
+        fsm = FSM("IDLE")
+        self.submodules += fsm
+
+        fsm.act("IDLE",
+            If(pending_clear & pipeline_empty,
+                NextValue(pending_clear, 0),
+                NextValue(sweep_adr, 0),
+                NextState("CLEAR")
+            ).Elif(pending_readout & pipeline_empty,
+                NextValue(pending_readout, 0),
+                NextValue(sweep_adr, readout_start),
+                NextValue(sweep_remaining, readout_count),
+                NextState("READ")
+            )
+        )
+        fsm.act("CLEAR",
+            write_port.adr.eq(sweep_adr),
+            write_port.dat_w.eq(0),
+            write_port.we.eq(1),
+            NextValue(sweep_adr, sweep_adr+1),
+            If(sweep_adr == bins-1,
+                NextState("IDLE")
+            )
+        )
+        # Read of the current bin is issued in READ, count is held in
+        # SEND until accepted
+        fsm.act("READ",
+            read_port.adr.eq(sweep_adr),
+            If(sweep_remaining == 0,
+                NextState("IDLE")
+            ).Else(
+                NextState("SEND")
+            )
+        )
+        fsm.act("SEND",
+            read_port.adr.eq(sweep_adr),
+            self.source_stb.eq(1),
+            self.source_data.eq(read_port.dat_r),
+            If(self.source_ready,
+                NextValue(sweep_adr, sweep_adr+1),
+                NextValue(sweep_remaining, sweep_remaining-1),
+                NextState("READ")
+            )
+        )
+        self.sync += [
+            If(self.clear, pending_clear.eq(1)),
+            If(self.readout,
+                pending_readout.eq(1),
+                readout_start.eq(self.readout_start),
+                readout_count.eq(self.readout_count)
+            )
+        ]
+        self.comb += [
+            self.busy.eq(pending_clear | pending_readout | ~fsm.ongoing("IDLE")),
+            If(fsm.ongoing("IDLE"),
+                read_port.adr.eq(relative[:bin_width]),
+                write_port.adr.eq(bin2),
+                write_port.dat_w.eq(count2),
+                write_port.we.eq(valid2)
+            )
+        ]
+
+
+class RtioHistogram(Module, HasDdbManager):
+
+    """Histogram of `value` (on `stb`) in `cd` clock domain with RTIO readout
+
+    See Histogram. Counts are read in chunks (up to `fifo_depth` bins) by
+    writing Cat(start, count) ([15:0] first bin, [31:16] number of bins) to
+    the RTIO output, counts come back through RTIO input (not
+    timestamped).
+
+    Configuration is a separate RTIO channel (RtLinkCSR):
+     * 0: enabled
+     * 1: offset (first bin, in value >> shift units)
+     * 2: shift
+     * 3: clear (write)
+     * 4: busy (ro)
+     * 5: entries (ro)
+     * 6: underflow (ro)
+     * 7: overflow (ro)
+    """
+
+    def __init__(self, value, stb, cd="sys", bin_width=10, fifo_depth=64,
+            name="histogram", identifier=None):
+        assert bin_width <= 16, "Up to 2**16 bins are supported"
+        value_width = len(value)
+
+        self.submodules.histogram = histogram = ClockDomainsRenamer(cd)(
+            Histogram(value_width, bin_width))
+
+        self.regs = regs = [
+            ("enabled", 1),
+            ("offset", len(histogram.offset)),
+            ("shift", len(histogram.shift)),
+            ("clear", 1),
+            ("busy", 1, 0, "ro"),
+            ("entries", 32, 0, "ro"),
+            ("underflow", 32, 0, "ro"),
+            ("overflow", 32, 0, "ro")
+        ]
+        self.submodules.csr = csr = RtLinkCSR(regs, name)
+
+        self.rtlink = rtlink_iface = rtlink.Interface(
+            rtlink.OInterface(data_width=32),
+            rtlink.IInterface(data_width=32, timestamped=False))
+
+        # # #
+
+        self.comb += [
+            histogram.stb.eq(stb),
+            histogram.value.eq(value)
+        ]
+        self.specials += [
+            MultiReg(csr.enabled, histogram.enabled, cd),
+            MultiReg(csr.offset, histogram.offset, cd),
+            MultiReg(csr.shift, histogram.shift, cd),
+            MultiReg(histogram.busy, csr.busy, "rio_phy")
+        ]
+
+        clear_cdc = PulseSynchronizer("rio_phy", cd)
+        self.submodules += clear_cdc
+        self.comb += [
+            clear_cdc.i.eq(csr.clear_ld),
+            histogram.clear.eq(clear_cdc.o)
+        ]
+
+        for counter in ["entries", "underflow", "overflow"]:
+            counter_cdc = BusSynchronizer(32, cd, "rio_phy")
+            self.submodules += counter_cdc
+            self.comb += [
+                counter_cdc.i.eq(getattr(histogram, counter)),
+                getattr(csr, counter).eq(counter_cdc.o)
+            ]
+
+        # Readout requests
+        request_cdc = ClockDomainsRenamer({"write": "rio_phy", "read": cd})(
+            AsyncFIFO(width=32, depth=4))
+        self.submodules += request_cdc
+        self.comb += [
+            request_cdc.we.eq(rtlink_iface.o.stb),
+            request_cdc.din.eq(rtlink_iface.o.data),
+            request_cdc.re.eq(~histogram.busy),
+            histogram.readout.eq(request_cdc.readable & ~histogram.busy),
+            histogram.readout_start.eq(request_cdc.dout[:16]),
+            histogram.readout_count.eq(request_cdc.dout[16:])
+        ]
+
+        readout_fifo = ClockDomainsRenamer({"write": cd, "read": "rio_phy"})(
+            AsyncFIFO(width=32, depth=fifo_depth))
+        self.submodules += readout_fifo
+        self.comb += [
+            readout_fifo.we.eq(histogram.source_stb),
+            readout_fifo.din.eq(histogram.source_data),
+            histogram.source_ready.eq(readout_fifo.writable),
+            readout_fifo.re.eq(1),
+            rtlink_iface.i.stb.eq(readout_fifo.readable),
+            rtlink_iface.i.data.eq(readout_fifo.dout)
+        ]
+
+        if identifier is not None:
+            self.add_rtio_channels(
+                channel=Channel.from_phy(csr),
+                device_id=f"{identifier}_csr",
+                module="elhep_cores.coredevice.rtlink_csr",
+                class_name="RtlinkCsr",
+                arguments={
+                    "regs": regs
+                })
+            self.add_rtio_channels(
+                channel=Channel.from_phy(self, ififo_depth=fifo_depth),
+                device_id=identifier,
+                module="elhep_cores.coredevice.histogram",
+                class_name="Histogram",
+                arguments={
+                    "csr_device": f"{identifier}_csr",
+                    "bins": 2**bin_width,
+                    "chunk": fifo_depth
+                })
+
+
+def clear(dut):
+    yield dut.clear.eq(1)
+    yield
+    yield dut.clear.eq(0)
+    yield
+    while (yield dut.busy):
+        yield
+
+
+def testbench(dut, values, stall=0.0):
+    yield from clear(dut)
+    for value in values:
+        while random.random() < stall:
+            yield dut.stb.eq(0)
+            yield
+        yield dut.stb.eq(1)
+        yield dut.value.eq(value)
+        yield
+    yield dut.stb.eq(0)
+    yield
+
+
+def readout(dut, start, count, stall=0.0):
+    yield dut.readout.eq(1)
+    yield dut.readout_start.eq(start)
+    yield dut.readout_count.eq(count)
+    yield
+    yield dut.readout.eq(0)
+    counts = []
+    while True:
+        yield dut.source_ready.eq(random.random() >= stall)
+        yield
+        if (yield dut.source_stb) and (yield dut.source_ready):
+            counts.append((yield dut.source_data))
+        if not (yield dut.busy):
+            break
+    yield dut.source_ready.eq(1)
+    return counts
+
+
+def check(dut, offset=5, shift=2, stall=0.0):
+    bins = 2**len(dut.readout_start)
+    max_count = 2**len(dut.source_data)-1
+    # Few distinct values, so that entries of the same bin follow each other
+    choices = [random.randint(0, (bins+offset+10) << shift) for _ in range(12)]
+    values = [random.choice(choices) for _ in range(1000)]
+    yield dut.enabled.eq(1)
+    yield dut.offset.eq(offset)
+    yield dut.shift.eq(shift)
+    yield from testbench(dut, values, stall)
+
+    relative = [(v >> shift) - offset for v in values]
+    expected = [min(relative.count(b), max_count) for b in range(bins)]
+    assert (yield from readout(dut, 0, bins, stall)) == expected
+    assert (yield from readout(dut, 3, 7, stall)) == expected[3:10]
+    assert (yield dut.entries) == len(values)
+    assert (yield dut.underflow) == sum(r < 0 for r in relative)
+    assert (yield dut.overflow) == sum(r >= bins for r in relative)
+
+    yield from clear(dut)
+    assert (yield from readout(dut, 0, bins, stall)) == [0]*bins
+    assert (yield dut.entries) == 0
+
+
+if __name__ == "__main__":
+    for stall in [0.0, 0.3]:
+        # Narrow counts, so that some of the bins saturate
+        dut = Histogram(12, bin_width=6, count_width=7)
+        run_simulation(dut, check(dut, stall=stall))
+    print("OK")
@@ -0,0 +1,164 @@
+"""Checks coincidence trigger generator input conditioning, modes and scalers
+
+Everything is configured through the RTIO interfaces, the same way as the
+drivers do.
+
+Run with: python -m elhep_cores.cores.tests.tb_coincidence
+"""
+
+from migen import *
+
+from elhep_cores.cores.trigger_generators import TriggerGenerator, \
+    RtioCoincidenceTriggerGenerator, TriggerScalers
+
+
+class _TestBench(Module):
+    def __init__(self, inputs=3, truth_table_groups=2):
+        generators = []
+        for idx in range(inputs):
+            generator = TriggerGenerator(f"in{idx}")
+            generator.register_trigger(Signal(), "i", "rio_phy")
+            generators.append(generator)
+        self.inputs = [g.triggers[0]["signal"] for g in generators]
+        self.submodules.dut = RtioCoincidenceTriggerGenerator("coincidence", generators,
+            truth_table_groups=truth_table_groups)
+        self.submodules.scalers = TriggerScalers(self.dut)
+        # Conditioned inputs, as passed to the pulse extenders
+        self.conditioned = [getattr(self.dut, f"pe_{idx}").i for idx in range(inputs)]
+
+
+def rtlink_write(rtlink, address, value):
+    yield rtlink.o.address.eq(address)
+    yield rtlink.o.data.eq(value)
+    yield rtlink.o.stb.eq(1)
+    yield
+    yield rtlink.o.stb.eq(0)
+    yield
+
+
+def rtlink_read(rtlink, address, words=1):
+    yield rtlink.o.address.eq(address)
+    yield rtlink.o.stb.eq(1)
+    yield
+    yield rtlink.o.stb.eq(0)
+    data = []
+    for _ in range(100):
+        yield
+        if (yield rtlink.i.stb):
+            data.append((yield rtlink.i.data))
+            if len(data) == words:
+                return data
+    raise AssertionError("Readout timeout")
+
+
+def reg_write(tb, index, value):
+    yield from rtlink_write(tb.dut.rtlink, index << 1 | 1, value)
+
+
+def reg_read(tb, index):
+    return (yield from rtlink_read(tb.dut.rtlink, index << 1))[0]
+
+
+def input_config(prescale=0, holdoff=0, delay=0):
+    return delay << 27 | holdoff << 12 | prescale
+
+
+def conditioned_edges(edges, prescale=0, holdoff=0, delay=0):
+    """Model of the input conditioning, returns cycles of passed edges"""
+    accepted = []
+    for t in edges:
+        if not accepted or t > accepted[-1] + holdoff:
+            accepted.append(t)
+    return [t + delay for t in accepted[::prescale+1]]
+
+
+def check_conditioning():
+    tb = _TestBench()
+    layout = tb.dut.get_layout()
+    configs = [
+        dict(prescale=2, holdoff=6, delay=7),
+        dict(prescale=0, holdoff=0, delay=0),
+        dict(prescale=1, holdoff=0, delay=31)
+    ]
+    # Rising edges, some of them within the holdoff of the previous one
+    edges = [10, 14, 20, 23, 30, 31, 40, 47, 48, 60, 63, 70, 80, 81, 82, 90, 100, 110]
+    observed = [[] for _ in tb.inputs]
+
+    def generator():
+        for idx, config in enumerate(configs):
+            yield from reg_write(tb, layout["input_select"], idx)
+            yield from reg_write(tb, layout["input_config"], input_config(**config))
+        # Each input reads back its own config word
+        for idx, config in enumerate(configs):
+            yield from reg_write(tb, layout["input_select"], idx)
+            assert (yield from reg_read(tb, layout["input_config"])) == input_config(**config)
+
+        for t in range(200):
+            for s in tb.inputs:
+                # High for one cycle, except for edges directly following
+                # each other
+                yield s.eq(t in edges)
+            yield
+            for idx, o in enumerate(tb.conditioned):
+                if (yield o):
+                    observed[idx].append(t)
+
+    run_simulation(tb, {"rio_phy": generator()}, clocks={"rio_phy": 8})
+    for idx, config in enumerate(configs):
+        # Edges directly following a high cycle are not edges
+        rising = [t for t in edges if t-1 not in edges]
+        expected = conditioned_edges(rising, **config)
+        assert observed[idx] == expected, f"input {idx}: {observed[idx]} instead of {expected}"
+
+
+def check_mode(mode, patterns, expected, pulse_length=3, period=20, gate=400):
+    """Fires the inputs of every pattern at once, `period` cycles apart,
+    expects a trigger for patterns in `expected`. Scalers count the edges
+    within a single gate."""
+    tb = _TestBench()
+    dut = tb.dut
+    layout = dut.get_layout()
+    triggers = []
+    counts = []
+
+    def generator():
+        yield from reg_write(tb, layout["pulse_length"], pulse_length)
+        yield from reg_write(tb, layout["mask"][0], 0b111)
+        yield from reg_write(tb, layout["mode"], mode)
+        yield from reg_write(tb, layout["threshold"], 2)
+        # Group 0: input 0, group 1: inputs 1 and 2; table is true for
+        # group 0 without group 1
+        yield from reg_write(tb, layout["group_masks"][0][0], 0b001)
+        yield from reg_write(tb, layout["group_masks"][1][0], 0b110)
+        yield from reg_write(tb, layout["truth_table"][0], 0b0010)
+        yield from reg_write(tb, layout["enabled"], 1)
+        yield from rtlink_write(tb.scalers.rtlink, 0, gate)
+
+        for idx, pattern in enumerate(patterns):
+            for t in range(period):
+                for bit, s in enumerate(tb.inputs):
+                    yield s.eq(t == 0 and (pattern >> bit) & 1)
+                yield
+                if (yield dut.trigger):
+                    triggers.append(pattern)
+        for _ in range(gate):
+            yield
+        counts.extend((yield from rtlink_read(tb.scalers.rtlink, 1, tb.scalers.burst_length)))
+
+    run_simulation(tb, {"rio_phy": generator()}, clocks={"rio_phy": 8})
+    assert triggers == expected, f"mode {mode}: {triggers} instead of {expected}"
+
+    sequence, *counters, sequence_end = counts
+    assert sequence == sequence_end == 1, counts
+    edges = [sum((p >> bit) & 1 for p in patterns) for bit in range(len(tb.inputs))]
+    assert counters == edges + [len(expected)], f"mode {mode}: scalers {counters}"
+
+
+if __name__ == "__main__":
+    check_conditioning()
+    patterns = [0b001, 0b011, 0b111, 0b110, 0b100, 0b101, 0b010, 0b111]
+    check_mode(RtioCoincidenceTriggerGenerator.MODE_AND, patterns, [0b111, 0b111])
+    check_mode(RtioCoincidenceTriggerGenerator.MODE_MAJORITY, patterns,
+        [p for p in patterns if bin(p).count("1") >= 2])
+    check_mode(RtioCoincidenceTriggerGenerator.MODE_TRUTH_TABLE, patterns, [0b001])
+    print("OK")
@@ -0,0 +1,77 @@
+"""Checks fine coincidence trigger generator on edges at known positions
+
+Run with: python -m elhep_cores.cores.tests.tb_fine_coincidence
+"""
+
+from migen import *
+
+from elhep_cores.cores.trigger_generators import TriggerGenerator, \
+    RtioFineCoincidenceTriggerGenerator
+
+
+def reg_write(dut, index, value):
+    o = dut.rtlink.o
+    yield o.address.eq(index << 1 | 1)
+    yield o.data.eq(value)
+    yield o.stb.eq(1)
+    yield
+    yield o.stb.eq(0)
+    yield
+
+
+def check(window, pairs, period=40):
+    """Edges of two SERDES inputs at `pairs` of positions (in samples of
+    the cycle they are in, relative to the start of their slot of `period`
+    cycles)"""
+    inputs = []
+    for name in ["a", "b"]:
+        generator = TriggerGenerator(name)
+        generator.register_trigger(Signal(8), "i", "rio_phy")
+        inputs.append(generator)
+    dut = RtioFineCoincidenceTriggerGenerator("coincidence", inputs)
+    samples = [g.triggers[0]["signal"] for g in inputs]
+    w = dut.serdes_width
+    triggers = []
+    timestamps = []
+
+    def generator():
+        layout = dut.get_layout()
+        yield from reg_write(dut, layout["window"], window)
+        yield from reg_write(dut, layout["mask"][0], 0b11)
+        yield from reg_write(dut, layout["enabled"], 1)
+        start = 10
+        for _ in range(start):
+            yield
+        for slot in range(len(pairs) + 1):
+            for cycle in range(period):
+                t = slot*period + cycle
+                for s, edge in zip(samples, pairs[slot] if slot < len(pairs) else []):
+                    # High for two cycles from the edge
+                    level = sum(1 << k for k in range(w) if 0 <= cycle*w + k - edge < 2*w)
+                    yield s.eq(level)
+                yield
+                if (yield dut.trigger):
+                    triggers.append((t - dut.latency, (yield dut.trigger_fine)))
+                if (yield dut.timestamps.rtlink.i.stb):
+                    timestamps.append((yield dut.timestamps.rtlink.i.fine_ts))
+
+    run_simulation(dut, {"rio_phy": generator()}, clocks={"rio_phy": 8})
+
+    expected = []
+    for slot, (a, b) in enumerate(pairs):
+        if abs(a - b) <= window:
+            last = max(a, b)
+            expected.append((slot*period + last//w, last % w))
+    assert triggers == expected, f"window {window}: {triggers} instead of {expected}"
+    assert timestamps == [fine for _, fine in expected]
+
+
+if __name__ == "__main__":
+    # Edges within and across rio_phy cycles, in both input orders
+    pairs = [(0, 0), (3, 5), (5, 3), (6, 9), (7, 8), (7, 10), (1, 4), (12, 14), (15, 16),
+             (0, 30), (2, 13), (4, 6)]
+    for window in [0, 1, 2, 3, 8, 11]:
+        check(window, pairs)
+    # Edges 2 samples (2 ns) apart pass with window 2, not with window 1
+    check(1, [(3, 5)])
+    print("OK")
@@ -1,11 +1,15 @@
 from migen import *
 from migen.genlib.io import DifferentialInput
-from migen.genlib.cdc import BusSynchronizer, PulseSynchronizer
+from migen.genlib.cdc import BusSynchronizer, PulseSynchronizer, MultiReg
+from migen.genlib.coding import PriorityEncoder
 from artiq.gateware.rtio import rtlink
 from artiq.gateware.rtio.channel import Channel
+from artiq.gateware.rtio.phy.ttl_serdes_7series import _ISERDESE2_8X
 from elhep_cores.cores.dsp.baseline import SignalBaseline
+from elhep_cores.cores.dsp.parallel import as_lanes, ParallelThreshold, ParallelRunDetector, \
+    ParallelEdgeDetector, ParallelHysteresisTrigger
 from functools import reduce
-from operator import and_, add
+from operator import and_, or_, add
 from elhep_cores.cores.rtlink_csr import RtLinkCSR
 from elhep_cores.cores.pulse_extender import PulseExtender
 from elhep_cores.helpers.ddb_manager import HasDdbManager
@@ -63,79 +67,118 @@ class ExternalTriggerInput(TriggerGenerator):
         ]
 
 
+class SerdesTriggerInput(TriggerGenerator):
+
+    """
+    Trigger input sampled with 8X ISERDES
+
+    Registers the vector of 8 samples per rio_phy cycle (bit 0 earliest),
+    which gives edges with sub-cycle resolution to
+    RtioFineCoincidenceTriggerGenerator. RtioCoincidenceTriggerGenerator
+    uses it as a level that is high if any of the samples is.
+
+    If the pad is already used by an RTIO PHY, pass its SERDES in `serdes`
+    (instead of the pad), so that the samples are shared (see the `trig`
+    input of FmcAdc100M10b16chaTdc).
+    """
+
+    def __init__(self, pad=None, pad_n=None, name="serdes_trigger", serdes=None):
+        super().__init__(name)
+
+        # Outputs
+        self.samples = Signal(8)  # CD: rio_phy
+        self.register_trigger(self.samples, "i", "rio_phy")
+
+        # # #
+
+        if serdes is None:
+            serdes = _ISERDESE2_8X(pad, pad_n)
+            self.submodules += serdes
+        self.comb += self.samples.eq(serdes.i)
+
+
 class BaselineTriggerGenerator(TriggerGenerator):
 
-    def __init__(self, data, trigger_level, treshold_length=4, name="baseline_trigger"):
+    """
+    Baseline trigger generator
+
+    Triggers when `treshold_length` consecutive samples cross
+    `trigger_level`. With `baseline` (estimator from
+    elhep_cores.cores.dsp.baseline, with `wsize` wider than unsigned data)
+    the level is relative to the estimated signal baseline.
+
+    `data` is a signal or a list of lanes with several samples per clock
+    (see elhep_cores.cores.dsp.parallel, `baseline` must be a parallel
+    estimator then). `trigger_re_index` and `trigger_fe_index` give the
+    lane of the first crossing in the clock cycle.
+    """
+
+    def __init__(self, data, trigger_level, treshold_length=4, name="baseline_trigger",
+            baseline=None):
         super().__init__(name)
+        lanes = as_lanes(data)
+        p = len(lanes)
+        width = len(lanes[0])
 
         # Outputs
         self.trigger_re = Signal()  # CD: sys
         self.trigger_fe = Signal()  # CD: sys
+        self.trigger_re_index = Signal(max=max(p, 2))  # CD: sys
+        self.trigger_fe_index = Signal(max=max(p, 2))  # CD: sys
 
         self.register_trigger(self.trigger_re, "re", ClockDomain("sys"))
         self.register_trigger(self.trigger_fe, "fe", ClockDomain("sys"))
 
         # # #
 
-        assert len(data) == len(trigger_level), "Trigger level width must be equal to data width"
+        assert width == len(trigger_level), "Trigger level width must be equal to data width"
         
         self.trigger_level = trigger_level
-        # # self.submodules.baseline_generator = baseline_gen = SignalBaseline(len(data))
-        # self.trigger_level_offset = trigger_level_offset = Signal.like(data)
-        # self.comb += [
-        #     baseline_gen.i.eq(data),
-        #     trigger_level_offset.eq(baseline_gen.o)
-        # ]
-
-        data_prev = Signal(len(data) * treshold_length)
-
-        above_comparison_list = [
-            # data_prev[i * len(data):(i + 1) * len(data)] > trigger_level + trigger_level_offset for i in
-            #     range(treshold_length)]
-            data_prev[i * len(data):(i + 1) * len(data)] > trigger_level for i in range(treshold_length)]
-        below_comparison_list = [
-            # data_prev[i * len(data):(i + 1) * len(data)] < trigger_level + trigger_level_offset for i in
-            #     range(treshold_length)]
-            data_prev[i * len(data):(i + 1) * len(data)] < trigger_level for i in range(treshold_length)]
-        data_above = Signal()
-        data_below = Signal()
-
-        self.comb += [
-            data_above.eq(reduce(and_, above_comparison_list)),
-            data_below.eq(reduce(and_, below_comparison_list))
-        ]
-
-        above_prev = Signal()
-        below_prev = Signal()
-
-        self.sync += [
-            data_prev.eq((data_prev << len(data)) | data),
-
-            If(data_above & ~above_prev, self.trigger_re.eq(1)).Else(self.trigger_re.eq(0)),
-            If(data_below & ~below_prev, self.trigger_fe.eq(1)).Else(self.trigger_fe.eq(0)),
-
-            above_prev.eq(data_above),
-            below_prev.eq(data_below)
-        ]
+        if baseline is not None:
+            self.submodules.baseline_generator = baseline
+            level = Signal((max(width, len(baseline.o))+2, True))
+            self.comb += [
+                [i.eq(d) for i, d in zip(as_lanes(baseline.i), lanes)],
+                level.eq(trigger_level + baseline.o)
+            ]
+        else:
+            level = trigger_level
 
+        for direction, negative in [("re", 0), ("fe", 1)]:
+            threshold = ParallelThreshold(p, width, lanes[0].signed, (len(level), level.signed))
+            run = ParallelRunDetector(p, treshold_length)
+            edge = ParallelEdgeDetector(p)
+            self.submodules += threshold, run, edge
+            self.comb += [
+                [i.eq(d) for i, d in zip(threshold.i, lanes)],
+                threshold.level.eq(level),
+                threshold.negative.eq(negative),
+                [i.eq(o) for i, o in zip(run.i, threshold.o)],
+                [i.eq(o) for i, o in zip(edge.i, run.o)],
+                getattr(self, f"trigger_{direction}").eq(edge.any),
+                getattr(self, f"trigger_{direction}_index").eq(edge.index)
+            ]
 
-class RtioBaselineTriggerGenerator(BaselineTriggerGenerator):
 
-    def __init__(self, data, treshold_length=4, name="baseline_trigger"):
-        
-        self.rtlink = rtlink.Interface(rtlink.OInterface(data_width=len(data)))
+class RtioBaselineTriggerGenerator(BaselineTriggerGenerator, HasDdbManager):
 
-        # # #
+    def __init__(self, data, treshold_length=4, name="baseline_trigger", identifier=None,
+            baseline=None):
+        # Level applies to every lane
+        width = len(as_lanes(data)[0])
 
         regs = [
-             ("offset_level", len(data))
+             ("offset_level", width)
         ]
         csr = RtLinkCSR(regs, "baseline_trigger_generator")
         self.submodules.csr = csr
+        self.rtlink = csr.rtlink
+
+        # # #
 
-        trigger_level_sys = Signal.like(data)
+        trigger_level_sys = Signal.like(as_lanes(data)[0])
         
-        cdc = BusSynchronizer(len(data), "rio_phy", "sys")
+        cdc = BusSynchronizer(width, "rio_phy", "sys")
         self.submodules += cdc
 
         self.comb += [
@@ -143,7 +186,108 @@ class RtioBaselineTriggerGenerator(BaselineTriggerGenerator):
             trigger_level_sys.eq(cdc.o)
         ]
             
-        super().__init__(data, trigger_level_sys, treshold_length, name)
+        super().__init__(data, trigger_level_sys, treshold_length, name, baseline)
+
+        if identifier is not None:
+            self.add_rtio_channels(
+                channel=Channel.from_phy(self),
+                device_id=identifier,
+                module="elhep_cores.coredevice.trigger_generators",
+                class_name="RtioBaselineTriggerGenerator",
+                arguments={
+                    "name": name
+                })
+
+
+class ThresholdTriggerBank(TriggerGenerator, HasDdbManager):
+
+    """
+    Threshold trigger bank
+
+    Generates a trigger pulse (`trigger`, one per channel, in the clock
+    domain of the channel data) when the channel data crosses `level`. The
+    channel is then rearmed once the data returns past `level` by more than
+    `hysteresis`. With `negative` set for the channel, data going below the
+    level is detected instead. Triggers are registered as `ch{i}`, so the
+    bank can be used as RtioCoincidenceTriggerGenerator input; `trigger`
+    signals can be used as CircularDAQ `trigger_dclk` directly.
+
+    `cd` is the clock domain of all channels or a list with clock domain of
+    every channel. With `signed` data, level and hysteresis are in two's
+    complement as well. Channel data can be a list of lanes with several
+    samples per clock (see elhep_cores.cores.dsp.parallel), `trigger_index`
+    gives the lane of the crossing then.
+
+    RTIO channel map (RtLinkCSR):
+     * 0: enabled (channel mask)
+     * 1: negative (channel mask)
+     * 2+2*i: level of channel i
+     * 3+2*i: hysteresis of channel i
+    """
+
+    def __init__(self, data, cd, signed=False, name="threshold_trigger", identifier=None):
+        super().__init__(name)
+        n = len(data)
+        width = max(len(as_lanes(d)[0]) for d in data)
+        if isinstance(cd, str):
+            cd = [cd]*n
+        assert len(cd) == n, "Clock domain must be given for every channel"
+
+        self.regs = regs = [
+            ("enabled", n),
+            ("negative", n)
+        ]
+        for i in range(n):
+            regs += [
+                (f"level{i}", width, 2**(width-1)-1 if signed else 2**width-1),
+                (f"hysteresis{i}", width)
+            ]
+        self.submodules.csr = csr = RtLinkCSR(regs, name)
+        self.rtlink = csr.rtlink
+
+        # Outputs
+        self.trigger = [Signal(name=f"trigger{i}") for i in range(n)]
+        self.trigger_index = [Signal(max=max(len(as_lanes(d)), 2), name=f"trigger_index{i}")
+            for i, d in enumerate(data)]
+        for i, (trigger, trigger_cd) in enumerate(zip(self.trigger, cd)):
+            self.register_trigger(trigger, f"ch{i}", trigger_cd)
+
+        # # #
+
+        for i, (d, trigger, trigger_index, trigger_cd) in enumerate(
+                zip(data, self.trigger, self.trigger_index, cd)):
+            lanes = as_lanes(d)
+            channel = ClockDomainsRenamer(trigger_cd)(
+                ParallelHysteresisTrigger(len(lanes), width, signed))
+            self.submodules += channel
+
+            # Configuration is static while triggering
+            level_reg = getattr(csr, f"level{i}")
+            hysteresis_reg = getattr(csr, f"hysteresis{i}")
+            level_raw = Signal(width, reset=level_reg.reset.value)
+            self.specials += [
+                MultiReg(csr.enabled[i], channel.enabled, trigger_cd),
+                MultiReg(csr.negative[i], channel.negative, trigger_cd),
+                MultiReg(level_reg, level_raw, trigger_cd, reset=level_reg.reset.value),
+                MultiReg(hysteresis_reg, channel.hysteresis, trigger_cd)
+            ]
+            self.comb += [
+                [x.eq(sample) for x, sample in zip(channel.i, lanes)],
+                channel.level.eq(level_raw),
+                trigger.eq(channel.any),
+                trigger_index.eq(channel.index)
+            ]
+
+        if identifier is not None:
+            self.add_rtio_channels(
+                channel=Channel.from_phy(csr),
+                device_id=identifier,
+                module="elhep_cores.coredevice.trigger_generators",
+                class_name="ThresholdTriggerBank",
+                arguments={
+                    "name": name,
+                    "channels": n
+                })
 
 
 class RtioTriggerGenerator(TriggerGenerator, HasDdbManager):
@@ -175,16 +319,62 @@ class RtioTriggerGenerator(TriggerGenerator, HasDdbManager):
 
 class RtioCoincidenceTriggerGenerator(TriggerGenerator):
 
-    def __init__(self, name, generators, reset_pulse_length=50, pulse_max_length=255):
+    """
+    Coincidence trigger generator
+
+    Every input trigger is extended to `pulse_length` cycles and combined
+    into the output trigger according to the runtime selected mode:
+     * MODE_AND: all inputs enabled in `mask` are active at once
+     * MODE_MAJORITY: at least `threshold` inputs enabled in `mask` are
+       active at once (N-of-M)
+     * MODE_TRUTH_TABLE: inputs are ORed into `truth_table_groups` groups
+       (with a membership mask per group), the vector of group states
+       addresses a truth table of 2**truth_table_groups bits
+
+    Popcount is computed in a two-stage adder tree: LUT sized chunks are
+    counted and registered in place of the AND product register, so that
+    all the modes have the same latency as the AND mode alone.
+
+    Before being extended, every input passes through (all configured at
+    runtime, with one config word per input, written and read back through
+    `input_config` for the input selected in `input_select`):
+     * delay line of up to `max_input_delay` cycles ([31:27]), to balance
+       input latencies
+     * holdoff ([26:12]): edges are ignored for that many cycles after an
+       accepted one
+     * prescaler ([11:0]): only every (prescale+1)-th edge passing the
+       holdoff is passed on
+    With the word cleared the input is passed on without additional latency.
+
+    RTIO channel map (register index, see `get_layout`):
+     * 0: enabled
+     * 1: pulse length
+     * 2...: mask words (32 inputs each)
+     * then mode, majority threshold, group mask words (mask words for every
+       group), truth table words (32 entries each), input select and input
+       config
+    """
+
+    MODE_AND = 0
+    MODE_MAJORITY = 1
+    MODE_TRUTH_TABLE = 2
+
+    def __init__(self, name, generators, reset_pulse_length=50, pulse_max_length=255,
+            truth_table_groups=0, max_input_delay=31):
         super().__init__(name)
         assert pulse_max_length <= 2**32-1
+        assert truth_table_groups <= 8, "Up to 8 truth table groups are supported"
+        assert max_input_delay <= 31, "Input delay up to 31 cycles is supported"
         self.pulse_max_length = pulse_max_length
+        self.truth_table_groups = truth_table_groups
+        self.max_input_delay = max_input_delay
         
         self.pulse_length = Signal(max=pulse_max_length)
         self.trigger = Signal()
         self.register_trigger(self.trigger, "trigger", "rio_phy")
         
         self.trigger_in_signals = []
+        self.trigger_in_samples = []
         self.trigger_in_labels  = []
 
         for generator in generators:
@@ -202,7 +392,13 @@ class RtioCoincidenceTriggerGenerator(TriggerGenerator):
         else:
             raise ValueError("Invalid clock domain")
 
-        if cd == "rio_phy":
+        if len(signal) > 1:
+            # SERDES samples, bit 0 earliest
+            assert cd == "rio_phy", "SERDES samples must be in rio_phy domain"
+            trigger_in_rio_phy = Signal()
+            self.comb += trigger_in_rio_phy.eq(signal != 0)
+            self.trigger_in_samples.append(signal)
+        elif cd == "rio_phy":
             trigger_in_rio_phy = signal
         else:
             trigger_in_rio_phy = Signal()
@@ -212,35 +408,119 @@ class RtioCoincidenceTriggerGenerator(TriggerGenerator):
                 cdc.i.eq(signal),
                 trigger_in_rio_phy.eq(cdc.o)
             ]
+        if len(signal) == 1:
+            self.trigger_in_samples.append(trigger_in_rio_phy)
       
         self.trigger_in_signals.append(trigger_in_rio_phy)
         self.trigger_in_labels.append(label)
 
+    @staticmethod
+    def _sum_tree(values):
+        while len(values) > 1:
+            values = [values[i] + values[i+1] if i+1 < len(values) else values[i]
+                      for i in range(0, len(values), 2)]
+        return values[0]
+
+    def _add_input_conditioning(self, signal, config):
+        prescale = config[:12]
+        holdoff = config[12:27]
+        delay = config[27:]
+
+        # No reset and a dynamic tap, so that it maps to SRL
+        delay_line = Signal(max(self.max_input_delay, 1), reset_less=True)
+        self.sync.rio_phy += delay_line.eq(Cat(signal, delay_line[:-1]))
+        delayed = Signal()
+        self.comb += delayed.eq(Mux(delay == 0, signal,
+            Array(delay_line[i] for i in range(len(delay_line)))[delay-1]))
+
+        delayed_d = Signal()
+        edge = Signal()
+        holdoff_counter = Signal.like(holdoff)
+        prescale_counter = Signal.like(prescale)
+        accepted = Signal()
+        o = Signal()
+        self.comb += [
+            edge.eq(delayed & ~delayed_d),
+            accepted.eq(edge & (holdoff_counter == 0)),
+            o.eq(accepted & (prescale_counter == 0))
+        ]
+        self.sync.rio_phy += [
+            delayed_d.eq(delayed),
+            If(accepted,
+                holdoff_counter.eq(holdoff),
+                If(prescale_counter >= prescale,
+                    prescale_counter.eq(0)
+                ).Else(
+                    prescale_counter.eq(prescale_counter+1)
+                )
+            ).Elif(holdoff_counter != 0,
+                holdoff_counter.eq(holdoff_counter-1)
+            )
+        ]
+        return o
+
     def _add_logic(self):
         self.pulses = []
+        self.input_configs = []
+        self.input_select = Signal(max=max(len(self.trigger_in_signals), 2))
 
         for idx, signal in enumerate(self.trigger_in_signals):
+            config = Signal(32)
+            self.input_configs.append(config)
             pe = ClockDomainsRenamer("rio_phy")(PulseExtender(self.pulse_max_length))
             setattr(self.submodules, f"pe_{idx}", pe)
             self.comb += [
-                pe.i.eq(signal),
+                pe.i.eq(self._add_input_conditioning(signal, config)),
                 pe.length.eq(self.pulse_length)
             ]
             self.pulses.append(pe.o)
         
-        self.mask = Signal(len(self.pulses))
+        n = len(self.pulses)
+        self.mask = Signal(n)
         self.enabled = Signal()
+        self.mode = Signal(2)
+        self.threshold = Signal(max=n+1)
+        self.group_masks = [Signal(n) for _ in range(self.truth_table_groups)]
+        self.truth_table = Signal(2**self.truth_table_groups)
 
-        product_elements = [(self.pulses[i] | ~self.mask[i]) for i in range(len(self.pulses))]
+        # Stage 1: AND product, popcount of LUT sized chunks and group states
+        product_elements = [(self.pulses[i] | ~self.mask[i]) for i in range(n)]
         product_elements.append(self.enabled)
         product = reduce(and_, product_elements)
 
+        masked = [self.pulses[i] & self.mask[i] for i in range(n)]
+        chunk_counts = []
+        for chunk in divide_chunks(masked, 6):
+            count = Signal(max=len(chunk)+1)
+            self.sync.rio_phy += count.eq(self._sum_tree(chunk))
+            chunk_counts.append(count)
+
+        groups = Signal(max(self.truth_table_groups, 1))
+        for idx, group_mask in enumerate(self.group_masks):
+            self.sync.rio_phy += groups[idx].eq(
+                reduce(or_, [self.pulses[i] & group_mask[i] for i in range(n)]))
+
         trigger_int = Signal()
-        trigger_int_d = Signal()
+        self.sync.rio_phy += trigger_int.eq(product)
+
+        # Stage 2: decision and rising edge
+        popcount = Signal(max=n+1)
+        decision = Signal()
+        decision_d = Signal()
+        self.comb += [
+            popcount.eq(self._sum_tree(chunk_counts)),
+            Case(self.mode, {
+                self.MODE_AND: decision.eq(trigger_int),
+                self.MODE_MAJORITY: decision.eq(self.enabled & (popcount >= self.threshold)),
+                self.MODE_TRUTH_TABLE: decision.eq(self.enabled &
+                    (Array(self.truth_table[i] for i in range(len(self.truth_table)))[groups]
+                     if self.truth_table_groups else 0)),
+                "default": decision.eq(0)
+            })
+        ]
         self.sync.rio_phy += [
-            self.trigger.eq(trigger_int & ~trigger_int_d),
-            trigger_int_d.eq(trigger_int),
-            trigger_int.eq(product)
+            self.trigger.eq(decision & ~decision_d),
+            decision_d.eq(decision)
         ]
 
     @staticmethod
@@ -255,13 +535,45 @@ class RtioCoincidenceTriggerGenerator(TriggerGenerator):
         rows = [signal[i*row_width:(i+1)*row_width] for i in range(rows_num)]
         return Array(rows)  
 
-    def _add_rtlink(self):
-        # Address 0: enabled
-        # Address 1: pulse length
-        # Address 2: mask
+    def get_layout(self):
+        """Returns register index of every register (list for multi-word ones)"""
+        mask_words = (len(self.mask)+31)//32
+        layout = {"enabled": 0, "pulse_length": 1}
+        adr = 2
+        layout["mask"] = list(range(adr, adr+mask_words))
+        adr += mask_words
+        layout["mode"] = adr
+        layout["threshold"] = adr+1
+        adr += 2
+        layout["group_masks"] = []
+        for _ in self.group_masks:
+            layout["group_masks"].append(list(range(adr, adr+mask_words)))
+            adr += mask_words
+        table_words = (len(self.truth_table)+31)//32 if self.truth_table_groups else 0
+        layout["truth_table"] = list(range(adr, adr+table_words))
+        adr += table_words
+        layout["input_select"] = adr
+        layout["input_config"] = adr+1
+        return layout
+
+    def get_regs(self):
+        """Returns registers in order of `get_layout`"""
+        regs = [self.enabled, self.pulse_length]
+        regs += list(self.signal_to_array(self.mask))
+        regs += [self.mode, self.threshold]
+        for group_mask in self.group_masks:
+            regs += list(self.signal_to_array(group_mask))
+        if self.truth_table_groups:
+            regs += list(self.signal_to_array(self.truth_table))
+        # Config words are accessed indirectly, so that the address space
+        # does not grow with the number of inputs
+        regs += [self.input_select, Array(self.input_configs)[self.input_select]]
+        return regs
 
-        mask_adr_no = (len(self.mask)+31)//32
-        adr_width = len(Signal(max=mask_adr_no+1))+2
+    def _add_rtlink(self):
+        regs = self.get_regs()
+        adr_width = len(Signal(max=len(regs)))+1
+        assert adr_width <= 8, "Too many registers for RTIO address space"
 
         self.rtlink = rtlink.Interface(
             rtlink.OInterface(data_width=32, address_width=adr_width),
@@ -274,36 +586,257 @@ class RtioCoincidenceTriggerGenerator(TriggerGenerator):
             rtlink_wen.eq(self.rtlink.o.address[0]),
         ]
 
-        mask_array = self.signal_to_array(self.mask)
-
         self.sync.rio_phy += [
             self.rtlink.i.stb.eq(0),
             If(self.rtlink.o.stb,
-                # Write
-                If(rtlink_wen & (rtlink_address == 0),
-                    self.enabled.eq(self.rtlink.o.data[0])
-                ).
-                Elif(rtlink_wen & (rtlink_address == 1),
-                    self.pulse_length.eq(self.rtlink.o.data)
-                ).
-                Elif(rtlink_wen & (rtlink_address >= 2),
-                    mask_array[rtlink_address-2].eq(self.rtlink.o.data)
-                ).
-                # Readout
-                Elif(~rtlink_wen & (rtlink_address == 0),
-                    self.rtlink.i.data.eq(self.enabled),
-                    self.rtlink.i.stb.eq(1)
-                ).
-                Elif(~rtlink_wen & (rtlink_address == 1),
-                    self.rtlink.i.data.eq(self.pulse_length),
-                    self.rtlink.i.stb.eq(1)
-                ).
-                Elif(~rtlink_wen & (rtlink_address >= 2),
-                    self.rtlink.i.data.eq(mask_array[rtlink_address-2]),
-                    self.rtlink.i.stb.eq(1)
+                If(rtlink_wen,
+                    # Write
+                    Case(rtlink_address, {
+                        idx: reg.eq(self.rtlink.o.data) for idx, reg in enumerate(regs)
+                    })
+                ).Else(
+                    # Readout
+                    self.rtlink.i.stb.eq(1),
+                    Case(rtlink_address, {
+                        idx: self.rtlink.i.data.eq(reg) for idx, reg in enumerate(regs)
+                    })
                 )
             )
         ]
 
     def get_mask_mapping(self):
         return self.list_to_chunks(self.trigger_in_labels, 32)
+
+
+class _TriggerTimestamps(Module):
+
+    """Timestamped RTIO input of `trigger` with `fine` as fine timestamp"""
+
+    def __init__(self, trigger, fine, fine_ts_width):
+        self.rtlink = rtlink.Interface(
+            rtlink.OInterface(data_width=1),
+            rtlink.IInterface(data_width=1, timestamped=True, fine_ts_width=fine_ts_width))
+
+        # # #
+
+        self.comb += [
+            self.rtlink.i.stb.eq(trigger),
+            self.rtlink.i.data.eq(1),
+            self.rtlink.i.fine_ts.eq(fine)
+        ]
+
+
+class RtioFineCoincidenceTriggerGenerator(RtioCoincidenceTriggerGenerator):
+
+    """
+    Coincidence trigger generator with sub-cycle resolution
+
+    Alternative to RtioCoincidenceTriggerGenerator (selected at elaboration
+    time, same inputs and mask mapping) that compares edge timestamps
+    instead of overlapping extended pulses. Inputs registered as SERDES
+    samples (e.g. SerdesTriggerInput) are timestamped with resolution of
+    rio_phy period / `serdes_width` (1 ns for 8X SERDES at 125 MHz), single
+    bit inputs with rio_phy period.
+
+    Age of the last rising edge is tracked for every input. Trigger is
+    generated in the cycle an enabled input gets a new edge if the edges of
+    all the enabled inputs are at most `window` (in units of the resolution)
+    apart. `trigger_fine` is the position of the edge completing the
+    coincidence within the rio_phy cycle it came in, `trigger` follows that
+    cycle by `latency` cycles.
+
+    Every trigger is timestamped at full resolution through `timestamps`,
+    which is a separate RTIO channel (timestamped input with `fine_ts`).
+    RTIO timestamp is that of the edge completing the coincidence, delayed
+    by `latency` rio_phy cycles. `trigger_fine` is relative to rio_phy and
+    not to ADC samples, so it is not meant for `trigger_fine_ts_dclk` of
+    CircularDAQ; match windows with trigger timestamps instead.
+
+    RTIO channel map (register index, see `get_layout`):
+     * 0: enabled
+     * 1: window (up to `max_window`)
+     * 2...: mask words (32 inputs each)
+    """
+
+    latency = 3
+
+    def __init__(self, name, generators, serdes_width=8, max_window=255):
+        self.serdes_width = serdes_width
+        self.max_window = max_window
+        self.trigger_fine = Signal(max=serdes_width)
+        super().__init__(name, generators)
+
+        self.submodules.timestamps = _TriggerTimestamps(self.trigger, self.trigger_fine,
+            log2_int(serdes_width))
+
+    @staticmethod
+    def _min_tree(values):
+        while len(values) > 1:
+            values = [Mux(values[i] < values[i+1], values[i], values[i+1])
+                      if i+1 < len(values) else values[i]
+                      for i in range(0, len(values), 2)]
+        return values[0]
+
+    def _add_logic(self):
+        w = self.serdes_width
+        n = len(self.trigger_in_samples)
+        self.mask = Signal(n)
+        self.enabled = Signal()
+        self.window = Signal(max=self.max_window+1)
+
+        # Saturated age means no edge within reach of the window
+        age_max = 2**bits_for(self.max_window + 2*w) - 1
+        ages = []
+        new = Signal(n)
+        for idx, samples in enumerate(self.trigger_in_samples):
+            assert len(samples) in (1, w), "Unsupported number of samples"
+
+            # Stage 1: rising edge and its age at the end of the cycle
+            samples_d = Signal()
+            edges = Signal(len(samples))
+            hit = Signal()
+            hit_age = Signal(max=w+1)
+            self.comb += edges.eq(samples & ~Cat(samples_d, samples[:-1]))
+            self.sync.rio_phy += [
+                samples_d.eq(samples[-1]),
+                hit.eq(edges != 0)
+            ]
+            if len(samples) > 1:
+                encoder = PriorityEncoder(w)
+                self.submodules += encoder
+                self.comb += encoder.i.eq(edges)
+                self.sync.rio_phy += hit_age.eq(w - encoder.o)
+            else:
+                self.sync.rio_phy += hit_age.eq(w)
+
+            # Stage 2: age of the last edge
+            age = Signal(max=age_max+1, reset=age_max)
+            self.sync.rio_phy += [
+                new[idx].eq(hit),
+                If(hit,
+                    age.eq(hit_age)
+                ).Elif(age >= age_max - w,
+                    age.eq(age_max)
+                ).Else(
+                    age.eq(age + w)
+                )
+            ]
+            ages.append(age)
+
+        # Stage 3: decision, new edges are the youngest ones
+        newest = Signal(max=w+1)
+        limit = Signal(max=self.max_window+w+1)
+        decision = Signal()
+        self.comb += [
+            newest.eq(self._min_tree(
+                [Mux(new[i] & self.mask[i], ages[i], w) for i in range(n)])),
+            limit.eq(self.window + newest),
+            decision.eq(self.enabled & ((new & self.mask) != 0) &
+                reduce(and_, [~self.mask[i] | (ages[i] <= limit) for i in range(n)]))
+        ]
+        self.sync.rio_phy += [
+            self.trigger.eq(decision),
+            self.trigger_fine.eq(w - newest)
+        ]
+
+    def get_layout(self):
+        """Returns register index of every register (list for mask words)"""
+        mask_words = (len(self.mask)+31)//32
+        return {"enabled": 0, "window": 1, "mask": list(range(2, 2+mask_words))}
+
+    def get_regs(self):
+        """Returns registers in order of `get_layout`"""
+        return [self.enabled, self.window] + list(self.signal_to_array(self.mask))
+
+
+class TriggerScalers(Module, HasDdbManager):
+
+    """
+    Scaler bank for coincidence trigger generator
+
+    Counts rising edges of every input of `generator` (in order of
+    `trigger_in_labels`) and of its output trigger. Counters are latched and
+    restarted every `gate` rio_phy cycles (counting is stopped while gate is
+    0). Scalers only observe the trigger signals.
+
+    RTIO channel map:
+     * 0: gate period in rio_phy cycles
+     * 1: read latched counters
+
+    Read request is answered with a burst of RTIO input words: gate
+    sequence number, latched counters and the gate sequence number again.
+    The two sequence numbers differ if the counters were latched during the
+    burst.
+    """
+
+    def __init__(self, generator, identifier=None):
+        signals = generator.trigger_in_signals + [generator.trigger]
+        self.labels = generator.trigger_in_labels + [generator.name]
+        n = len(signals)
+        self.burst_length = n + 2
+
+        self.rtlink = rtlink_iface = rtlink.Interface(
+            rtlink.OInterface(data_width=32, address_width=1),
+            rtlink.IInterface(data_width=32, timestamped=False))
+
+        # # #
+
+        gate = Signal(32)
+        gate_counter = Signal(32)
+        gate_end = Signal()
+        sequence = Signal(32)
+        self.comb += gate_end.eq((gate != 0) & (gate_counter == gate-1))
+        self.sync.rio_phy += [
+            If(gate_end | (gate == 0),
+                gate_counter.eq(0)
+            ).Else(
+                gate_counter.eq(gate_counter+1)
+            ),
+            If(gate_end, sequence.eq(sequence+1))
+        ]
+
+        latched = []
+        for signal in signals:
+            signal_d = Signal()
+            counter = Signal(32)
+            counter_latched = Signal(32)
+            edge = Signal()
+            self.comb += edge.eq(signal & ~signal_d)
+            self.sync.rio_phy += [
+                signal_d.eq(signal),
+                If(gate_end,
+                    counter_latched.eq(counter + edge),
+                    counter.eq(0)
+                ).Elif(gate != 0,
+                    counter.eq(counter + edge)
+                )
+            ]
+            latched.append(counter_latched)
+
+        words = Array([sequence] + latched + [sequence])
+        index = Signal(max=len(words)+1)
+        self.sync.rio_phy += [
+            rtlink_iface.i.stb.eq(0),
+            If(index != 0,
+                rtlink_iface.i.stb.eq(1),
+                rtlink_iface.i.data.eq(words[len(words)-index]),
+                index.eq(index-1)
+            ),
+            If(rtlink_iface.o.stb,
+                If(rtlink_iface.o.address == 0,
+                    gate.eq(rtlink_iface.o.data)
+                ).Elif(index == 0,
+                    index.eq(len(words))
+                )
+            )
+        ]
+
+        if identifier is not None:
+            self.add_rtio_channels(
+                channel=Channel.from_phy(self, ififo_depth=2**log2_int(self.burst_length, need_pow2=False)),
+                device_id=identifier,
+                module="elhep_cores.coredevice.trigger_generators",
+                class_name="TriggerScalers",
+                arguments={
+                    "labels": self.labels
+                })
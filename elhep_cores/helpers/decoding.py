@@ -0,0 +1,452 @@
+import numpy as np
+
+
+def unpack_samples(words, sample_width=10, samples_per_word=3, trigger_id_width=0):
+    """Unpacks words produced by SamplePacker (CircularDAQ with pack_samples)
+
+    Words must start at the window boundary. Returns tuple of:
+     * samples - all samples of all windows, concatenated
+     * window_starts - index of the first sample of each window in samples
+     * trigger_ids - trigger ID of each window (None without trigger ID)
+
+    Samples of the windows can be obtained with
+    `np.split(samples, window_starts[1:])`.
+    """
+    words = np.asarray(words, dtype=np.uint32)
+    flags = words >> 30
+    last = flags != 0
+    # Window starts with the first word or with the word following the last one
+    first = np.concatenate(([True], last[:-1])) if len(words) else last
+
+    if trigger_id_width:
+        trigger_ids = words[first] & np.uint32(2**30-1)
+        data_words = ~first
+    else:
+        trigger_ids = None
+        data_words = np.ones(len(words), dtype=bool)
+
+    shifts = np.arange(samples_per_word, dtype=np.uint32)*sample_width
+    slots = (words[:, None] >> shifts) & np.uint32(2**sample_width-1)
+    valid = np.where(last, flags, samples_per_word)
+    valid[~data_words] = 0
+    samples = slots[np.arange(samples_per_word) < valid[:, None]]
+
+    # Trigger ID words hold no samples, so the window starts at the same
+    # sample index as the word following them
+    word_starts = np.cumsum(valid) - valid
+    window_starts = word_starts[first]
+    return samples, window_starts, trigger_ids
+
+
+# Event framing, see elhep_cores.cores.circular_daq.event_framer (which
+# takes these from here)
+TAG_DATA = 0b00
+TAG_HEADER = 0b01
+TAG_TIMESTAMP = 0b10
+TAG_TRAILER = 0b11
+
+CRC_POLYNOM = 0x1021
+CRC_INIT = 0xFFFF
+_CRC_CHUNK = 10
+
+
+def _crc_table(chunk=_CRC_CHUNK, polynom=CRC_POLYNOM):
+    table = np.zeros(2**chunk, dtype=np.uint32)
+    for i in range(2**chunk):
+        value = i << (16-chunk)
+        for _ in range(chunk):
+            value = ((value << 1) ^ (polynom if value & 0x8000 else 0)) & 0xFFFF
+        table[i] = value
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+
+def crc16_events(payloads, lengths):
+    """Computes CRC-16 of many events at once
+
+    `payloads` is (events x max length) array of 30-bit data payloads,
+    only first `lengths[i]` of row i are included. Returns CRC of each event.
+    """
+    payloads = np.asarray(payloads, dtype=np.uint32)
+    lengths = np.asarray(lengths)
+    value = np.full(len(payloads), CRC_INIT, dtype=np.uint32)
+    mask = np.uint32(2**_CRC_CHUNK-1)
+    for j in range(payloads.shape[1] if payloads.ndim == 2 else 0):
+        active = j < lengths
+        word = payloads[:, j]
+        new = value
+        for shift in range(30-_CRC_CHUNK, -1, -_CRC_CHUNK):
+            idx = ((new >> (16-_CRC_CHUNK)) ^ (word >> shift)) & mask
+            new = ((new << _CRC_CHUNK) & 0xFFFF) ^ _CRC_TABLE[idx]
+        value = np.where(active, new, value)
+    return value
+
+
+def split_events(words):
+    """Splits framed words (CircularDAQ with frame_events) into events
+
+    Only complete events (header, timestamp, data words and trailer) are
+    returned. Returns dictionary of arrays, one entry per event (except for
+    samples):
+     * trigger_id, timestamp - from the header and timestamp words
+     * start, length - position of event data in samples
+     * samples - data payloads of all events, concatenated
+     * length_ok, crc_ok - whether the trailer matches the received data
+    """
+    words = np.asarray(words, dtype=np.uint32)
+    tags = words >> 30
+    payload = words & np.uint32(2**30-1)
+
+    headers = np.flatnonzero(tags == TAG_HEADER)
+    trailers = np.flatnonzero(tags == TAG_TRAILER)
+    # Pair every header with the first trailer following it; events cut by
+    # another header (i.e. with lost trailer) are dropped
+    idx = np.searchsorted(trailers, headers)
+    has_trailer = idx < len(trailers)
+    headers = headers[has_trailer]
+    trailers = trailers[idx[has_trailer]]
+    next_header = np.append(headers[1:], len(words))
+    complete = (trailers < next_header) & (headers+1 < trailers)
+    headers = headers[complete]
+    trailers = trailers[complete]
+    complete = tags[headers+1] == TAG_TIMESTAMP
+    headers = headers[complete]
+    trailers = trailers[complete]
+
+    is_data = tags == TAG_DATA
+    data_before = np.cumsum(is_data) - is_data
+    length = data_before[trailers] - data_before[headers]
+
+    # Data words outside of complete events are not returned
+    in_event = np.zeros(len(words)+1, dtype=np.int32)
+    np.add.at(in_event, headers, 1)
+    np.add.at(in_event, trailers, -1)
+    in_event = np.cumsum(in_event[:-1]) > 0
+    samples = payload[is_data & in_event]
+    start = np.cumsum(length) - length
+
+    rows = np.zeros((len(headers), length.max() if len(length) else 0), dtype=np.uint32)
+    cols = np.arange(rows.shape[1])
+    mask = cols < length[:, None]
+    rows[mask] = samples
+
+    trailer = payload[trailers]
+    return {
+        "trigger_id": payload[headers],
+        "timestamp": payload[headers+1],
+        "start": start,
+        "length": length,
+        "samples": samples,
+        "length_ok": (trailer >> 16) == (length & (2**14-1)),
+        "crc_ok": (trailer & 0xFFFF) == crc16_events(rows, length)
+    }
+
+
+# Event builder, see elhep_cores.cores.circular_daq.event_builder
+TAG_BLOCK = 0b10
+
+
+def split_built_events(words):
+    """Splits words produced by EventBuilder into events and blocks
+
+    Only complete events (header to trailer) are returned. Returns tuple of
+    two dictionaries of arrays; events (one entry per event):
+     * trigger_id - from the header
+     * overflow - mask of overflowed sources from the trailer
+     * first_block, blocks - range of event blocks in blocks
+    and blocks (one entry per block, in order of arrival):
+     * event - index of the event the block belongs to
+     * source - source index
+     * start, length - position of block data in payloads
+     * payloads - data payloads of all blocks, concatenated (see join_parts)
+    """
+    words = np.asarray(words, dtype=np.uint32)
+    tags = words >> 30
+    payload = words & np.uint32(2**30-1)
+
+    headers = np.flatnonzero(tags == TAG_HEADER)
+    trailers = np.flatnonzero(tags == TAG_TRAILER)
+    idx = np.searchsorted(trailers, headers)
+    has_trailer = idx < len(trailers)
+    headers = headers[has_trailer]
+    trailers = trailers[idx[has_trailer]]
+    next_header = np.append(headers[1:], len(words))
+    complete = trailers < next_header
+    headers = headers[complete]
+    trailers = trailers[complete]
+
+    in_event = np.zeros(len(words)+1, dtype=np.int32)
+    np.add.at(in_event, headers, 1)
+    np.add.at(in_event, trailers, -1)
+    in_event = np.cumsum(in_event[:-1]) > 0
+
+    blocks = np.flatnonzero((tags == TAG_BLOCK) & in_event)
+    is_data = (tags == TAG_DATA) & in_event
+    data_before = np.cumsum(is_data) - is_data
+    # Block data ends at the next non-data word
+    markers = np.flatnonzero(tags != TAG_DATA)
+    block_end = markers[np.searchsorted(markers, blocks, side="right")]
+    length = data_before[block_end] - data_before[blocks]
+    event = np.searchsorted(headers, blocks, side="right") - 1
+    block_count = np.bincount(event, minlength=len(headers))
+
+    return {
+        "trigger_id": payload[headers],
+        "overflow": payload[trailers],
+        "first_block": np.cumsum(block_count) - block_count,
+        "blocks": block_count
+    }, {
+        "event": event,
+        "source": payload[blocks] & np.uint32(0x1F),
+        "start": data_before[blocks],
+        "length": length,
+        "payloads": payload[is_data]
+    }
+
+
+def join_parts(payloads, parts, signed_width=None):
+    """Joins samples split into `parts` 30-bit payloads (least significant
+    first) by EventBuilder; with `signed_width` samples are sign extended
+    from that many bits"""
+    payloads = np.asarray(payloads, dtype=np.uint64).reshape(-1, parts)
+    samples = np.zeros(len(payloads), dtype=np.uint64)
+    for i in range(parts):
+        samples |= payloads[:, i] << np.uint64(30*i)
+    if signed_width is None:
+        return samples
+    samples = samples.astype(np.int64)
+    sign = np.int64(1) << np.int64(signed_width-1)
+    return ((samples & ((sign << 1) - 1)) ^ sign) - sign
+
+
+def decode_samples(words, sample_width, trigger_id_width=0, signed=False, with_stb=False,
+        chunk=1 << 14):
+    """Decodes raw CircularDAQ words (one sample per word)
+
+    Word holds the sample in [sample_width-1:0] and trigger ID of the window
+    right above it. With `with_stb` the words are preceded by the strobe bit
+    (bit 0), as captured before the RTIO input; words with strobe deasserted
+    are dropped. With `signed` samples are sign extended.
+
+    Returns structured array with fields trigger_id and sample.
+
+    Words are processed in chunks of `chunk`, which keeps temporaries in
+    cache.
+    """
+    words = np.asarray(words)
+    if with_stb:
+        words = np.compress((words & 1) != 0, words) >> words.dtype.type(1)
+    if sample_width + trigger_id_width <= 32 and words.dtype.itemsize <= 4:
+        words = words.astype(np.uint32, copy=False).view(np.int32)
+    else:
+        words = words.astype(np.uint64, copy=False).view(np.int64)
+    bits = 8*words.dtype.itemsize
+
+    out = np.empty(len(words), dtype=[("trigger_id", np.int32), ("sample", words.dtype)])
+    buffer = np.empty(min(chunk, len(words)), dtype=words.dtype)
+    for start in range(0, len(words), chunk):
+        w = words[start:start+chunk]
+        o = out[start:start+chunk]
+        b = buffer[:len(w)]
+        if signed:
+            # Arithmetic right shift sign extends the sample
+            np.left_shift(w, bits - sample_width, out=b)
+            b >>= bits - sample_width
+        else:
+            np.bitwise_and(w, (1 << sample_width) - 1, out=b)
+        o["sample"] = b
+        if trigger_id_width:
+            np.right_shift(w, sample_width, out=b)
+            b &= (1 << trigger_id_width) - 1
+            o["trigger_id"] = b
+        else:
+            o["trigger_id"] = 0
+    return out
+
+
+def decode_tdc_gpx2(frames, stop_width=20, ref_index_width=2, ref_period=None,
+        ref_index_start=0, chunk=1 << 14):
+    """Decodes raw TDC GPX2 frames (TdcGpx2ChannelPhy.data_o)
+
+    Frame holds the reference index in its MSBs and the stop value (time
+    since the reference clock edge, in LSBs of the TDC) in the lower
+    `stop_width` bits. Reference index rolls over every 2**ref_index_width
+    reference periods; it is unwrapped assuming that frames are in order
+    and no more than one rollover happens between consecutive frames.
+    `ref_index_start` is the unwrapped reference index preceding the first
+    frame (e.g. last ref_index of the previous block).
+
+    Returns structured array with fields ref_index (unwrapped), stop and,
+    if `ref_period` (reference period in stop LSBs) is given, time
+    (ref_index*ref_period + stop).
+
+    Frames are processed in chunks of `chunk`, which keeps temporaries in
+    cache. Frames given as 32-bit words are processed without widening them
+    if stop and reference index fit in 32 bits.
+    """
+    frames = np.asarray(frames)
+    if stop_width + ref_index_width <= 32 and frames.dtype.itemsize <= 4:
+        frames = frames.astype(np.uint32, copy=False).view(np.int32)
+    else:
+        frames = frames.view(np.int64) if frames.dtype == np.uint64 else frames.astype(np.int64)
+    fields = [("ref_index", np.int64), ("stop", np.int32)]
+    if ref_period is not None:
+        fields.append(("time", np.int64))
+    out = np.empty(len(frames), dtype=fields)
+
+    ref_mask = (1 << ref_index_width) - 1
+    prev = ref_index_start & ref_mask
+    wraps = ref_index_start >> ref_index_width
+    size = min(chunk, len(frames))
+    ref_index = np.empty(size, dtype=np.int64)
+    stop = np.empty(size, dtype=frames.dtype)
+    rollover = np.empty(size, dtype=np.bool_)
+    rollovers = np.empty(size, dtype=np.int64)
+    for start in range(0, len(frames), chunk):
+        f = frames[start:start+chunk]
+        o = out[start:start+chunk]
+        n = len(f)
+        ref, s, r = ref_index[:n], stop[:n], rollover[:n]
+
+        np.right_shift(f, stop_width, out=ref)
+        ref &= ref_mask
+        r[0] = ref[0] < prev
+        np.less(ref[1:], ref[:-1], out=r[1:])
+        prev = ref[-1]
+        if wraps:
+            ref += wraps << ref_index_width
+        # Reference index rolls over rarely if it is wide, a few slices are
+        # then cheaper than the cumulative sum
+        count = np.count_nonzero(r)
+        if 0 < count <= 16:
+            for p in np.flatnonzero(r):
+                ref[p:] += 1 << ref_index_width
+        elif count:
+            c = rollovers[:n]
+            np.cumsum(r, out=c)
+            c <<= ref_index_width
+            ref += c
+        wraps += count
+        o["ref_index"] = ref
+
+        np.bitwise_and(f, (1 << stop_width) - 1, out=s)
+        o["stop"] = s
+        if ref_period is not None:
+            ref *= ref_period
+            ref += s
+            o["time"] = ref
+    return out
+
+
+def decode_cfd(words, fine_width=8, sample_start=0):
+    """Decodes list-mode words of ConstantFractionDiscriminator
+
+    Word holds the sample counter in its MSBs and the interpolated position
+    of the zero crossing within the sample in the lower `fine_width` bits.
+    Sample counter is unwrapped assuming that words are in order and that
+    the counter does not roll over more than once between consecutive
+    pulses. `sample_start` is the unwrapped sample preceding the first word
+    (e.g. last sample of the previous block).
+
+    Returns structured array with fields sample (unwrapped), fine and time
+    (in sample periods).
+    """
+    words = np.asarray(words).astype(np.int64) & 0xFFFFFFFF
+    out = np.empty(len(words), dtype=[("sample", np.int64), ("fine", np.int32), ("time", np.float64)])
+    if not len(words):
+        return out
+    counter_width = 32 - fine_width
+    counter = words >> fine_width
+    previous = np.concatenate(([sample_start & ((1 << counter_width) - 1)], counter[:-1]))
+    wraps = np.cumsum(counter < previous) + (sample_start >> counter_width)
+    out["sample"] = (wraps << counter_width) + counter
+    out["fine"] = words & ((1 << fine_width) - 1)
+    out["time"] = out["sample"] + out["fine"] / (1 << fine_width)
+    return out
+
+
+def decode_pulse_features(words):
+    """Decodes pulse feature records (see PulseFeatureExtractor)
+
+    Words must start at a record boundary, incomplete record at the end is
+    ignored. Returns structured array with fields start (sample counter of
+    the pulse start), amplitude, peak_index, charge, tot (time over
+    threshold) and pileup.
+    """
+    words = np.asarray(words).astype(np.uint32)
+    records = words[:len(words) // 4 * 4].reshape(-1, 4)
+    out = np.empty(len(records), dtype=[("start", np.uint32), ("amplitude", np.int16),
+        ("peak_index", np.uint16), ("charge", np.int32), ("tot", np.uint16), ("pileup", bool)])
+    out["start"] = records[:, 0]
+    out["amplitude"] = (records[:, 1] & 0xFFFF).astype(np.uint16).view(np.int16)
+    out["peak_index"] = records[:, 1] >> 16
+    out["charge"] = records[:, 2].view(np.int32)
+    out["tot"] = records[:, 3] & 0xFFFF
+    out["pileup"] = (records[:, 3] >> 16) & 1
+    return out
+
+
+def decode_trapezoidal_energy(words, energy_shift=0, gain=1.0):
+    """Decodes list-mode words of TrapezoidalShaper
+
+    Word holds the energy (height of the trapezoid shifted right by
+    `energy_shift`) in bits [30:0] and the pile-up flag in bit 31. Energy is
+    divided by `gain` (k * (M + 1) * 2**pz_frac for pulse amplitude in data
+    units).
+
+    Returns structured array with fields energy and pileup.
+    """
+    words = np.asarray(words).astype(np.int64) & 0xFFFFFFFF
+    out = np.empty(len(words), dtype=[("energy", np.float64), ("pileup", np.bool_)])
+    out["energy"] = ((words & 0x7FFFFFFF) << energy_shift) / gain
+    out["pileup"] = (words >> 31) != 0
+    return out
+
+
+def decode_pedestals(words, samples):
+    """Decodes results of PedestalAccumulator
+
+    Every lane is given by 4 words: sum (low, high) and sum of squares
+    (low, high) of `samples` samples.
+
+    Returns structured array with fields mean and rms, one entry per lane.
+    """
+    words = np.asarray(words).astype(np.int64).reshape(-1, 4) & 0xFFFFFFFF
+    out = np.empty(len(words), dtype=[("mean", np.float64), ("rms", np.float64)])
+    if not samples:
+        out["mean"] = np.nan
+        out["rms"] = np.nan
+        return out
+    total = words[:, 0].astype(np.float64) + words[:, 1].astype(np.float64) * 2.0**32
+    total_squares = words[:, 2].astype(np.float64) + words[:, 3].astype(np.float64) * 2.0**32
+    out["mean"] = total / samples
+    out["rms"] = np.sqrt(np.maximum(total_squares / samples - out["mean"]**2, 0))
+    return out
+
+
+def benchmark(n=1 << 24, repeat=5):
+    """Measures decoding throughput in words per second"""
+    import time
+    rng = np.random.default_rng(0)
+    results = {}
+    words = rng.integers(0, 2**32, n, dtype=np.uint64).astype(np.uint32)
+    frames = np.sort(rng.integers(0, 2**44, n, dtype=np.uint64))
+    for name, fn in [
+            ("decode_samples", lambda: decode_samples(words, 10, 8, signed=True)),
+            ("decode_samples (stb)", lambda: decode_samples(words, 10, 8, signed=True, with_stb=True)),
+            ("decode_tdc_gpx2", lambda: decode_tdc_gpx2(frames, 20, 24)),
+            ("decode_tdc_gpx2 (time)", lambda: decode_tdc_gpx2(frames, 20, 24, ref_period=100000))]:
+        best = float("inf")
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - t0)
+        results[name] = n / best
+    return results
+
+
+if __name__ == "__main__":
+    for name, rate in benchmark().items():
+        print(f"{name}: {rate/1e6:.0f} Mwords/s")
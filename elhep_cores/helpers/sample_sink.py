@@ -0,0 +1,131 @@
+import json
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class MemmapSink:
+
+    """Host sink appending sample chunks to a memory-mapped .npy file
+
+    File layout: `path` is a regular .npy file holding a one-dimensional
+    array of `capacity` elements of `dtype`, preallocated when the sink is
+    opened. Samples are appended in order of arrival, only the first
+    `samples_written` elements are valid. When the sink is closed, the
+    statistics (including `samples_written`) are stored next to it in
+    `<path>.json`.
+
+    `put` never blocks: chunks are copied into a bounded queue and written by
+    a background thread, which coalesces queued chunks into writes of up to
+    `batch_size` elements. Chunks that do not fit in the queue or in the file
+    are dropped and counted.
+    """
+
+    def __init__(self, path, capacity, dtype=np.int32, queue_size=1024, batch_size=1 << 16):
+        self.path = path
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.batch_size = batch_size
+        self.array = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype,
+                                               shape=(capacity,))
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.samples_written = 0
+        self.chunks_received = 0
+        self.chunks_written = 0
+        self.writes = 0
+        self.dropped_chunks = 0
+        self.dropped_samples = 0
+        self.max_queue_depth = 0
+        self.write_time = 0.0
+        self.opened_at = time.monotonic()
+        self.closed_at = None
+
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def put(self, chunk):
+        chunk = np.array(chunk, dtype=self.dtype)
+        with self.lock:
+            self.chunks_received += 1
+            try:
+                self.queue.put_nowait(chunk)
+            except queue.Full:
+                self.dropped_chunks += 1
+                self.dropped_samples += len(chunk)
+                return
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def _writer(self):
+        while True:
+            chunks = [self.queue.get()]
+            size = len(chunks[0]) if chunks[0] is not None else 0
+            while chunks[-1] is not None and size < self.batch_size:
+                try:
+                    chunk = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                chunks.append(chunk)
+                if chunk is not None:
+                    size += len(chunk)
+            stop = chunks[-1] is None
+            chunks = [c for c in chunks if c is not None]
+            if chunks:
+                self._write(chunks)
+            if stop:
+                return
+
+    def _write(self, chunks):
+        t0 = time.monotonic()
+        batch = np.concatenate(chunks)
+        start = self.samples_written
+        n = min(len(batch), self.capacity - start)
+        self.array[start:start+n] = batch[:n]
+        with self.lock:
+            self.samples_written += n
+            self.writes += 1
+            self.chunks_written += len(chunks)
+            if n < len(batch):
+                # Out of space; partially written chunk counts as dropped
+                lost = np.cumsum([len(c) for c in chunks]) > n
+                self.chunks_written -= int(lost.sum())
+                self.dropped_chunks += int(lost.sum())
+                self.dropped_samples += len(batch) - n
+            self.write_time += time.monotonic() - t0
+
+    def stats(self):
+        """Returns sink statistics as a dictionary"""
+        with self.lock:
+            end = self.closed_at if self.closed_at is not None else time.monotonic()
+            elapsed = end - self.opened_at
+            return {
+                "path": self.path,
+                "capacity": self.capacity,
+                "samples_written": self.samples_written,
+                "chunks_received": self.chunks_received,
+                "chunks_written": self.chunks_written,
+                "writes": self.writes,
+                "dropped_chunks": self.dropped_chunks,
+                "dropped_samples": self.dropped_samples,
+                "queue_depth": self.queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "elapsed": elapsed,
+                "throughput": self.samples_written / elapsed if elapsed else 0.0,
+                "write_throughput": self.samples_written / self.write_time if self.write_time else 0.0
+            }
+
+    def close(self):
+        """Writes out all queued chunks, flushes the file and stores statistics"""
+        if self.closed_at is not None:
+            return self.stats()
+        self.queue.put(None)
+        self.thread.join()
+        self.array.flush()
+        self.closed_at = time.monotonic()
+        stats = self.stats()
+        with open(self.path + ".json", "w") as f:
+            json.dump(stats, f, indent=2)
+        return stats